@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class AnalysisCache:
+    """In-process LRU with TTLs for ready-to-send analysis responses.
+
+    Sits in front of the video_cache table. Entries are bounded both by
+    count and by the byte size reported on ``put``, and expire ``ttl``
+    seconds after they were stored. Keys are tuples starting with the
+    video id.
+
+    Each entry also records the version of the video's analysis it was
+    built from. ``load_version(video_id)`` returns a value that changes
+    whenever the analysis is rewritten; hits are checked against it at
+    most every ``revalidate_seconds``, so rewrites by other workers are
+    picked up. Writes in this process should call ``invalidate_video``.
+    """
+
+    def __init__(self, load_version=None, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=3600,
+                 revalidate_seconds=5, clock=time.monotonic):
+        self.load_version = load_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.revalidate_seconds = revalidate_seconds
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale = 0
+
+    def get(self, key):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at, version, checked_at = entry
+            if now >= expires_at:
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if self.load_version is None or now - checked_at < self.revalidate_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        # Read the version without holding the lock; it is a database query
+        current = self.load_version(key[0])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[3] != current:
+                if entry is not None:
+                    del self._entries[key]
+                    self._bytes -= entry[1]
+                    self.stale += 1
+                self.misses += 1
+                return None
+            self._entries[key] = entry[:4] + (now,)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size, version=None):
+        """Store ``value``, built from analysis ``version`` of the video"""
+        if size > self.max_bytes:
+            return
+        now = self.clock()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size, now + self.ttl, version, now)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[1]
+                self.evictions += 1
+
+    def invalidate_video(self, video_id):
+        """Drop every entry whose key starts with ``video_id``"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == video_id]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale": self.stale
+            }
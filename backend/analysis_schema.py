@@ -0,0 +1,285 @@
+"""Schema, parsing and validation for Gemini's video analysis output.
+
+The analysis is requested in JSON mode with ``ANALYSIS_SCHEMA`` as the
+response schema. Whatever comes back is still run through
+``extract_json``, which also copes with fenced or chatty replies, and
+``validate_analysis``, which checks each section on its own. Sections
+that fail can then be asked for again with ``section_schema`` and
+``repair_prompt``, without redoing the whole analysis.
+"""
+import json
+import re
+import threading
+
+
+SECTIONS = ("briefing", "characters", "theme_alerts", "recaps", "scenes")
+
+# Sections an analysis can't be cached without
+REQUIRED_SECTIONS = ("briefing", "scenes")
+
+
+def _object(properties, required):
+    return {
+        "type": "OBJECT",
+        "properties": properties,
+        "required": list(required),
+        "propertyOrdering": list(properties)
+    }
+
+
+_STRING = {"type": "STRING"}
+_NUMBER = {"type": "NUMBER"}
+
+SECTION_SCHEMAS = {
+    "briefing": _STRING,
+    "characters": {"type": "ARRAY", "items": _object({
+        "name": _STRING,
+        "role": _STRING,
+        "description": _STRING,
+        "importance": {"type": "INTEGER"}
+    }, ("name", "description", "importance"))},
+    "theme_alerts": {"type": "ARRAY", "items": _object({
+        "timestamp": _NUMBER,
+        "theme": _STRING,
+        "emotion": _STRING,
+        "description": _STRING
+    }, ("timestamp", "theme", "description"))},
+    "recaps": {"type": "ARRAY", "items": _object({
+        "timestamp_start": _NUMBER,
+        "timestamp_end": _NUMBER,
+        "summary": _STRING
+    }, ("timestamp_start", "timestamp_end", "summary"))},
+    "scenes": {"type": "ARRAY", "items": _object({
+        "scene_start": _NUMBER,
+        "scene_end": _NUMBER,
+        "scene_title": _STRING,
+        "what_happened": _STRING
+    }, ("scene_start", "scene_end", "what_happened"))}
+}
+
+
+def section_schema(sections=SECTIONS):
+    """Response schema for an object holding just ``sections``, in the usual order"""
+    ordered = [s for s in SECTIONS if s in sections]
+    return _object({s: SECTION_SCHEMAS[s] for s in ordered}, ordered)
+
+
+# Briefing first, so streamed responses can show it while the rest is generated
+ANALYSIS_SCHEMA = section_schema()
+
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_decoder = json.JSONDecoder()
+
+
+def _as_object(value):
+    """``value`` if it is an object with at least one analysis section, else None"""
+    # Occasionally the object comes back wrapped in a one-element list
+    if isinstance(value, list) and len(value) == 1:
+        value = value[0]
+    if isinstance(value, dict) and any(section in value for section in SECTIONS):
+        return value
+    return None
+
+
+def extract_json(text):
+    """The analysis object in a model reply, or None if there isn't one.
+
+    Tries, in order: the whole text, the contents of ```json fences, the
+    first decodable object starting at any "{", and finally the outermost
+    braces with trailing commas removed. Only objects with at least one
+    analysis section count, so a nested character or scene is never
+    mistaken for the whole answer.
+    """
+    if isinstance(text, dict):
+        return text
+    if not isinstance(text, str):
+        return None
+    text = text.strip().lstrip("\ufeff")
+    candidates = [text] + [match.strip() for match in _FENCE_RE.findall(text)]
+    for candidate in candidates:
+        try:
+            found = _as_object(json.loads(candidate))
+        except ValueError:
+            continue
+        if found is not None:
+            return found
+
+    start = text.find("{")
+    while start != -1:
+        try:
+            found = _as_object(_decoder.raw_decode(text, start)[0])
+        except ValueError:
+            found = None
+        if found is not None:
+            return found
+        start = text.find("{", start + 1)
+
+    end = text.rfind("}")
+    start = text.find("{")
+    if start != -1 and end > start:
+        try:
+            return _as_object(json.loads(_TRAILING_COMMA_RE.sub(r"\1", text[start:end + 1])))
+        except ValueError:
+            pass
+    return None
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value.strip().rstrip("s"))
+        except ValueError:
+            return None
+    return None
+
+
+def _text(value):
+    return value.strip() if isinstance(value, str) and value.strip() else None
+
+
+def _clean_character(item):
+    name = _text(item.get("name"))
+    if name is None:
+        return None
+    importance = _number(item.get("importance"))
+    return {
+        "name": name,
+        "role": _text(item.get("role")) or "",
+        "description": _text(item.get("description")) or "",
+        "importance": max(1, min(3, int(importance))) if importance is not None else 3
+    }
+
+
+def _clean_theme_alert(item):
+    timestamp = _number(item.get("timestamp"))
+    theme = _text(item.get("theme"))
+    if timestamp is None or theme is None:
+        return None
+    return {
+        "timestamp": timestamp,
+        "theme": theme,
+        "emotion": _text(item.get("emotion")) or "",
+        "description": _text(item.get("description")) or ""
+    }
+
+
+def _clean_recap(item):
+    start = _number(item.get("timestamp_start"))
+    end = _number(item.get("timestamp_end"))
+    summary = _text(item.get("summary"))
+    if start is None or end is None or summary is None or end < start:
+        return None
+    return {"timestamp_start": start, "timestamp_end": end, "summary": summary}
+
+
+def _clean_scene(item):
+    start = _number(item.get("scene_start"))
+    end = _number(item.get("scene_end"))
+    what_happened = _text(item.get("what_happened"))
+    if start is None or end is None or what_happened is None or end <= start:
+        return None
+    return {
+        "scene_start": start,
+        "scene_end": end,
+        "scene_title": _text(item.get("scene_title")) or "",
+        "what_happened": what_happened
+    }
+
+
+_ITEM_CLEANERS = {
+    "characters": _clean_character,
+    "theme_alerts": _clean_theme_alert,
+    "recaps": _clean_recap,
+    "scenes": _clean_scene
+}
+
+
+def _clean_list(value, clean):
+    if not isinstance(value, list):
+        return [], "missing" if value is None else "not a list"
+    items = [clean(item) if isinstance(item, dict) else None for item in value]
+    kept = [item for item in items if item is not None]
+    if value and not kept:
+        return [], "no valid entries"
+    return kept, None
+
+
+def validate_analysis(data, sections=SECTIONS, expected_scenes=None):
+    """Check and normalize ``sections`` of a parsed analysis.
+
+    Returns ``(analysis, invalid)``: ``analysis`` holds every requested
+    section, cleaned (bad entries dropped, numeric strings converted,
+    importance clamped to 1-3) or empty if unusable; ``invalid`` maps each
+    section that should be asked for again to the reason. Empty
+    characters, theme_alerts and recaps are valid (a lecture or a
+    landscape video may have none); scenes must not be empty and are
+    flagged if there are fewer than ``expected_scenes``.
+    """
+    data = data if isinstance(data, dict) else {}
+    analysis = {}
+    invalid = {}
+    for section in sections:
+        if section == "briefing":
+            analysis[section] = _text(data.get(section)) or ""
+            if not analysis[section]:
+                invalid[section] = "missing or empty"
+            continue
+        analysis[section], reason = _clean_list(data.get(section), _ITEM_CLEANERS[section])
+        if reason is None and section == "scenes" and not analysis[section]:
+            reason = "empty"
+        if reason is None and section == "scenes" and expected_scenes and len(analysis[section]) < expected_scenes:
+            reason = f"{len(analysis[section])} of {expected_scenes} scenes"
+        if reason is not None:
+            invalid[section] = reason
+    if "scenes" in analysis:
+        analysis["scenes"].sort(key=lambda scene: scene["scene_start"])
+    return analysis, invalid
+
+
+def repair_prompt(prompt, invalid):
+    """The original prompt plus a request for only the sections in ``invalid``"""
+    problems = "; ".join(f"{section}: {reason}" for section, reason in invalid.items())
+    keys = ", ".join(f'"{section}"' for section in SECTIONS if section in invalid)
+    return (f"{prompt}\n\n    A previous answer to this request had missing or invalid sections ({problems}). "
+            f"Respond with a JSON object containing only these keys: {keys}.\n    ")
+
+
+class TokenUsage:
+    """Gemini token counts summed over the calls made for one analysis"""
+
+    def __init__(self):
+        self.calls = 0
+        self.repairs = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.total_tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, metadata):
+        """Add one response's ``usageMetadata``"""
+        metadata = metadata or {}
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += metadata.get("promptTokenCount", 0)
+            self.output_tokens += metadata.get("candidatesTokenCount", 0)
+            self.total_tokens += metadata.get("totalTokenCount", 0)
+
+    def add_repair(self):
+        with self._lock:
+            self.repairs += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "gemini_calls": self.calls,
+                "repairs": self.repairs,
+                "prompt_tokens": self.prompt_tokens,
+                "output_tokens": self.output_tokens,
+                "total_tokens": self.total_tokens
+            }
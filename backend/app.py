@@ -1,35 +1,173 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled, NoTranscriptFound
-import requests
 from dotenv import load_dotenv
 import os
+import re
+import time
+import atexit
+import base64
+import binascii
 import sqlite3
 import json
+import hashlib
+import contextvars
+import queue
+import threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
+from analysis_cache import AnalysisCache
+from analysis_schema import (ANALYSIS_SCHEMA, REQUIRED_SECTIONS, TokenUsage, extract_json, repair_prompt,
+                             section_schema, validate_analysis)
+from catalog import Catalog
+from compression import EncodedBody, MIN_COMPRESS_BYTES, compress, etag_matches, negotiate_encoding
+from db import transaction, query_one, query_all
+from http_client import http_client, UpstreamError
+from jobs import JobManager, QueueFullError
+from log import configure_logging, get_logger, fields, annotate, stage, start_trace, end_trace, current_trace, add_stage_observer
+from profiling import RequestProfiler, SlowRequests
+from metrics import StageMetrics, configure_metrics, collect, render, add_ratio, counter, gauge, histogram, gauge_callback
+from rate_limiter import TokenBucketLimiter, RateLimitTimeout, INTERACTIVE, CHARS_PER_TOKEN, current_lane, estimate_tokens
+from scene_index import SceneIndex
+from singleflight import SingleFlight, DbSingleFlight, CoalescingTimeout, LeaderFailed
+from stream_json import IncrementalJSONParser
+from title_resolver import TitleResolver
+from transcript import Transcript
+from transcript_store import load_transcript, save_transcript
+from write_behind import WriteBehindBuffer
+from youtube_title import TitleFetcher, OEMBED_URL, WATCH_URL
 
 app = Flask(__name__)
-CORS(app, origins=["https://klarity-frontend.vercel.app"], supports_credentials=True)
+
+# The frontend reads ETag to revalidate analyses with If-None-Match, so both
+# origins must expose it; flask-cors only applies the first config that matches
+CORS_ALLOW_HEADERS = ["Content-Type", "Authorization", "If-None-Match"]
+CORS_EXPOSE_HEADERS = ["ETag", "X-Request-ID"]
+
+CORS(app, origins=["https://klarity-frontend.vercel.app"], supports_credentials=True,
+     allow_headers=CORS_ALLOW_HEADERS, expose_headers=CORS_EXPOSE_HEADERS)
 
 CORS(app, resources={
     r"/*": {
         "origins": ["http://localhost:3000"],
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "allow_headers": CORS_ALLOW_HEADERS,
+        "expose_headers": CORS_EXPOSE_HEADERS
     }
 })
 
 # Load environment variables
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+GEMINI_API_URL = os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent")
+
+# Transcripts come from YouTube unless this is set to a URL template like
+# http://host/transcripts/{video_id} serving [{"text", "start", "duration"}, ...]
+# (used by bench_load.py's stub server)
+TRANSCRIPT_SOURCE_URL = os.getenv("TRANSCRIPT_SOURCE_URL")
+
+# Long transcripts are analyzed in windows of this many characters, at most
+# MAP_REDUCE_CONCURRENCY at a time, instead of being truncated
+MAP_REDUCE_ENABLED = os.getenv("MAP_REDUCE_ENABLED", "1").lower() in ("1", "true", "yes")
+# Transcripts are split into windows of about this many tokens. Most videos
+# fit in one; only very long ones are analyzed in parallel parts.
+MAP_REDUCE_WINDOW_TOKENS = int(os.getenv("MAP_REDUCE_WINDOW_TOKENS", "32000"))
+MAP_REDUCE_WINDOW_CHARS = MAP_REDUCE_WINDOW_TOKENS * CHARS_PER_TOKEN
+MAP_REDUCE_CONCURRENCY = int(os.getenv("MAP_REDUCE_CONCURRENCY", "4"))
+
+# Stored transcripts are reused forever unless a max age in seconds is set
+TRANSCRIPT_MAX_AGE = int(os.getenv("TRANSCRIPT_MAX_AGE")) if os.getenv("TRANSCRIPT_MAX_AGE") else None
+
+configure_logging()
+log = get_logger("app")
+
+# Per-stage latency for everything wrapped in stage(), plus request, cache
+# and upstream counters; served on /metrics
+configure_metrics()
+add_stage_observer(StageMetrics())
+http_requests = counter("klarity_http_requests_total", "Requests handled", ("method", "endpoint", "status"))
+http_request_duration = histogram("klarity_http_request_duration_seconds", "Request handling time", ("endpoint",))
+http_in_flight = gauge("klarity_http_requests_in_flight", "Requests being handled", ("endpoint",))
+cache_lookups = counter("klarity_cache_lookups_total", "Cache lookups by cache and result", ("cache", "result"))
+transcript_fetches = counter("klarity_transcript_fetches_total", "Transcript downloads from YouTube by outcome", ("outcome",))
+gemini_rate_limit_wait = histogram("klarity_gemini_rate_limit_wait_seconds", "Time spent waiting for Gemini quota")
+gemini_tokens = counter("klarity_gemini_tokens_total", "Gemini tokens used, successful or not", ("kind",))
+analysis_tokens = histogram("klarity_analysis_tokens", "Gemini tokens spent per successful analysis",
+                            buckets=(1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000))
+analysis_repairs = counter("klarity_analysis_repairs_total", "Analysis sections asked for again after failing validation", ("section",))
 
-# Debug: Check if API key is loaded
-print(f"GEMINI_API_KEY loaded: {'Yes' if GEMINI_API_KEY else 'No'}")
-if GEMINI_API_KEY:
-    print(f"API Key length: {len(GEMINI_API_KEY)}")
-else:
-    print("WARNING: GEMINI_API_KEY is not set in environment variables!")
+# Sampled profiling of the heavier endpoints: PROFILE_SAMPLE_RATE of their
+# requests, plus any request sent with "X-Profile: <PROFILE_ADMIN_TOKEN>"
+profiler = RequestProfiler(
+    directory=os.getenv("PROFILE_DIR", "profiles"),
+    endpoints=os.getenv("PROFILE_ENDPOINTS", "process_video,get_history,get_recommendations").split(","),
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    admin_token=os.getenv("PROFILE_ADMIN_TOKEN") or None,
+    interval=int(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000.0
+)
+slow_requests = SlowRequests(
+    size=int(os.getenv("SLOW_REQUESTS_TOP_N", "20")),
+    window=int(os.getenv("SLOW_REQUESTS_WINDOW", "3600"))
+)
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+def endpoint_label():
+    # The URL rule, not the path, so ids in paths don't create new series
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+@app.before_request
+def begin_request_trace():
+    # Reuse a well-formed id from a proxy so log lines can be joined across services
+    request_id = request.headers.get('X-Request-ID', '')
+    g.trace_token = start_trace(request_id if REQUEST_ID_PATTERN.match(request_id) else None)
+    g.metrics_endpoint = endpoint_label()
+    http_in_flight.inc(endpoint=g.metrics_endpoint)
+    if profiler.should_profile(request.endpoint, request.headers.get('X-Profile')):
+        g.profiling = True
+        profiler.start()
+
+@app.after_request
+def tag_request_id(response):
+    trace = current_trace()
+    if trace is not None:
+        response.headers['X-Request-ID'] = trace.request_id
+        annotate(status=response.status_code, bytes=response.content_length)
+    return response
+
+@app.teardown_request
+def log_request_summary(exc):
+    """One line per request: id, route, outcome fields and per-stage milliseconds"""
+    if g.pop('summary_deferred', False):
+        # A stream_with_context response tears down again once the stream ends; log then
+        return
+    token = g.pop('trace_token', None)
+    if token is None:
+        return
+    trace = end_trace(token)
+    endpoint = g.pop('metrics_endpoint', 'unmatched')
+    status = 500 if exc is not None else trace.fields.get("status", 500)
+    http_in_flight.dec(endpoint=endpoint)
+    http_request_duration.observe(trace.elapsed(), endpoint=endpoint)
+    http_requests.inc(method=request.method, endpoint=endpoint, status=status)
+    summary = {"request_id": trace.request_id, "method": request.method, "path": request.path}
+    summary.update(trace.fields)
+    if exc is not None:
+        summary["error"] = type(exc).__name__
+    summary["duration_ms"] = round(trace.elapsed() * 1000, 1)
+    if trace.stages:
+        summary["stages"] = {name: round(seconds * 1000, 1) for name, seconds in trace.stages.items()}
+    if g.pop('profiling', False):
+        profile = profiler.finish(f"{request.endpoint}-{trace.request_id}")
+        if profile:
+            summary["profile"] = os.path.basename(profile)
+    if request.endpoint in profiler.endpoints:
+        slow_requests.record(trace.elapsed(), summary)
+    log.info("request", extra=fields(**summary))
+
+if not GEMINI_API_KEY:
+    log.warning("GEMINI_API_KEY is not set in environment variables")
 
 # REAL MOVIES with ACTUAL PROVIDED POSTER IMAGES + SUMMARIES
 FREE_MOVIES = {
@@ -145,222 +283,406 @@ FREE_MOVIES = {
     ]
 }
 
+# The catalog never changes at runtime, so its lookups and response bodies are built once
+catalog = Catalog(FREE_MOVIES)
+
+def save_video_scenes(conn, video_id, scenes):
+    """Replace a video's rows in video_scenes with the parsed Gemini scenes"""
+    rows = []
+    for scene in scenes:
+        if not isinstance(scene, dict) or not scene.get('what_happened'):
+            continue
+        try:
+            scene_start = int(float(scene['scene_start']))
+            scene_end = int(float(scene['scene_end']))
+        except (KeyError, TypeError, ValueError):
+            continue
+        rows.append((video_id, scene_start, scene_end, scene['what_happened'], scene.get('scene_title')))
+    conn.execute("DELETE FROM video_scenes WHERE video_id = ?", (video_id,))
+    conn.executemany("""
+        INSERT INTO video_scenes (video_id, scene_start, scene_end, what_happened, scene_title)
+        VALUES (?, ?, ?, ?, ?)
+    """, rows)
+
+def save_video_characters(conn, video_id, characters):
+    """Replace a video's rows in video_characters with the parsed Gemini characters"""
+    rows = []
+    for character in characters:
+        if not isinstance(character, dict) or not character.get('name'):
+            continue
+        try:
+            importance = int(character.get('importance', 1))
+        except (TypeError, ValueError):
+            importance = 1
+        rows.append((video_id, character['name'], character.get('role') or '',
+                     character.get('description'), importance))
+    conn.execute("DELETE FROM video_characters WHERE video_id = ?", (video_id,))
+    conn.executemany("""
+        INSERT INTO video_characters (video_id, character_name, character_role, character_description, importance_level)
+        VALUES (?, ?, ?, ?, ?)
+    """, rows)
+
 # Initialize SQLite database
 def init_db():
-    conn = sqlite3.connect("cache.db")
-    cursor = conn.cursor()
-    
-    # Create user_complexity table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_complexity (
-            user_id TEXT PRIMARY KEY,
-            clicks INTEGER DEFAULT 0,
-            complexity_score REAL DEFAULT 1.0
-        )
-    """)
-    
-    # Create video_cache table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS video_cache (
-            video_id TEXT PRIMARY KEY,
-            briefing TEXT,
-            theme_alerts TEXT,
-            recaps TEXT,
-            characters TEXT,
-            rating TEXT,
-            complexity TEXT
-        )
-    """)
-    
-    # Add characters column to existing video_cache table if it doesn't exist
-    try:
-        cursor.execute("ALTER TABLE video_cache ADD COLUMN characters TEXT")
-        print("Added characters column to video_cache table")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            print("Characters column already exists in video_cache table")
-        else:
-            print(f"Error adding characters column: {e}")
-    
-    # Create movie_titles_cache table for YouTube video titles
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS movie_titles_cache (
-            video_id TEXT PRIMARY KEY,
-            title TEXT,
-            cached_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    # Create user_history table for tracking watched videos
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            video_id TEXT NOT NULL,
-            video_title TEXT,
-            watched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES user_complexity(user_id)
-        )
-    """)
-    
-    # Create video_scenes table for "what just happened" answers
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS video_scenes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            video_id TEXT NOT NULL,
-            scene_start INTEGER NOT NULL,
-            scene_end INTEGER NOT NULL,
-            what_happened TEXT NOT NULL,
-            scene_title TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (video_id) REFERENCES video_cache(video_id)
-        )
-    """)
-    
-    # Create video_characters table for character information
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS video_characters (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            video_id TEXT NOT NULL,
-            character_name TEXT NOT NULL,
-            character_role TEXT NOT NULL,
-            character_description TEXT,
-            importance_level INTEGER DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (video_id) REFERENCES video_cache(video_id)
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        
+        # Create user_complexity table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_complexity (
+                user_id TEXT PRIMARY KEY,
+                clicks INTEGER DEFAULT 0,
+                complexity_score REAL DEFAULT 1.0
+            )
+        """)
+        
+        # Create video_cache table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS video_cache (
+                video_id TEXT PRIMARY KEY,
+                briefing TEXT,
+                theme_alerts TEXT,
+                recaps TEXT,
+                characters TEXT,
+                rating TEXT,
+                complexity TEXT
+            )
+        """)
+        
+        # Add characters column to existing video_cache table if it doesn't exist
+        try:
+            cursor.execute("ALTER TABLE video_cache ADD COLUMN characters TEXT")
+            log.info("Added characters column to video_cache table")
+        except sqlite3.OperationalError as e:
+            if "duplicate column name" not in str(e):
+                log.error("Error adding characters column: %s", e)
+        
+        # Tag cached analyses with the prompt version that produced them
+        try:
+            cursor.execute("ALTER TABLE video_cache ADD COLUMN prompt_version TEXT")
+            log.info("Added prompt_version column to video_cache table")
+        except sqlite3.OperationalError as e:
+            if "duplicate column name" not in str(e):
+                log.error("Error adding prompt_version column: %s", e)
+        
+        # Create movie_titles_cache table for YouTube video titles
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS movie_titles_cache (
+                video_id TEXT PRIMARY KEY,
+                title TEXT,
+                cached_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Create user_history table for tracking watched videos
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                video_title TEXT,
+                watched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                view_count INTEGER NOT NULL DEFAULT 1,
+                FOREIGN KEY (user_id) REFERENCES user_complexity(user_id)
+            )
+        """)
+        
+        # History keeps one row per (user, video): watched_at is the last view
+        try:
+            cursor.execute("ALTER TABLE user_history ADD COLUMN view_count INTEGER NOT NULL DEFAULT 1")
+            log.info("Added view_count column to user_history table")
+        except sqlite3.OperationalError as e:
+            if "duplicate column name" not in str(e):
+                log.error("Error adding view_count column: %s", e)
+        
+        # Compact the one-row-per-view history written before the unique index existed
+        has_unique_index = cursor.execute("""
+            SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_user_history_user_video'
+        """).fetchone()
+        if not has_unique_index:
+            cursor.execute("""
+                UPDATE user_history SET
+                    view_count = (SELECT SUM(h.view_count) FROM user_history h
+                                  WHERE h.user_id = user_history.user_id AND h.video_id = user_history.video_id),
+                    watched_at = (SELECT MAX(h.watched_at) FROM user_history h
+                                  WHERE h.user_id = user_history.user_id AND h.video_id = user_history.video_id),
+                    video_title = COALESCE((SELECT h.video_title FROM user_history h
+                                            WHERE h.user_id = user_history.user_id AND h.video_id = user_history.video_id
+                                            AND h.video_title NOT LIKE 'Movie #%'
+                                            ORDER BY h.id DESC LIMIT 1), video_title)
+                WHERE id IN (SELECT MAX(id) FROM user_history GROUP BY user_id, video_id HAVING COUNT(*) > 1)
+            """)
+            removed = cursor.execute("""
+                DELETE FROM user_history
+                WHERE id NOT IN (SELECT MAX(id) FROM user_history GROUP BY user_id, video_id)
+            """).rowcount
+            if removed:
+                log.info("Compacted %d duplicate user_history rows", removed)
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_history_user_video ON user_history (user_id, video_id)")
+        # Covers the keyset-paginated history read: (user_id, watched_at, id) order, no table lookups
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_user_history_user_watched
+            ON user_history (user_id, watched_at, id, video_id, video_title, view_count)
+        """)
+        
+        # Create video_scenes table for "what just happened" answers
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS video_scenes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                video_id TEXT NOT NULL,
+                scene_start INTEGER NOT NULL,
+                scene_end INTEGER NOT NULL,
+                what_happened TEXT NOT NULL,
+                scene_title TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (video_id) REFERENCES video_cache(video_id)
+            )
+        """)
+        
+        # Create video_characters table for character information
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS video_characters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                video_id TEXT NOT NULL,
+                character_name TEXT NOT NULL,
+                character_role TEXT NOT NULL,
+                character_description TEXT,
+                importance_level INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (video_id) REFERENCES video_cache(video_id)
+            )
+        """)
+        
+        # Composite indexes so per-video scene and character lookups are index seeks.
+        # They are not covering: rows are read from the table for their text, which
+        # is one lookup per scene and only happens when SceneIndex loads a video.
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_video_scenes_video_start ON video_scenes (video_id, scene_start)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_video_characters_video_importance ON video_characters (video_id, importance_level)")
+        
+        # Backfill characters for videos cached before they were stored in video_characters
+        cursor.execute("""
+            SELECT video_id, characters FROM video_cache
+            WHERE characters IS NOT NULL
+            AND video_id NOT IN (SELECT DISTINCT video_id FROM video_characters)
+        """)
+        for video_id, characters_json in cursor.fetchall():
+            try:
+                save_video_characters(conn, video_id, json.loads(characters_json))
+            except (json.JSONDecodeError, TypeError):
+                continue
+        
+        # Raw transcripts, so re-analysis never downloads from YouTube again.
+        # Text is zlib-compressed; starts and durations are packed float64 arrays.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS transcripts (
+                video_id TEXT NOT NULL,
+                language TEXT NOT NULL,
+                entry_count INTEGER NOT NULL,
+                text_blob BLOB NOT NULL,
+                starts_blob BLOB NOT NULL,
+                durations_blob BLOB NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (video_id, language)
+            )
+        """)
+        
+        # Shared Gemini rate limit state: bucket levels and the queue of waiting callers
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limit_waiters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                limiter TEXT NOT NULL,
+                lane INTEGER NOT NULL,
+                enqueued_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_rate_limit_waiters_queue ON rate_limit_waiters (limiter, lane, id)")
+        
+        # Async analysis jobs, shared so any worker can answer /job_status
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_jobs (
+                job_id TEXT PRIMARY KEY,
+                video_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                params TEXT,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                status_code INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                owner TEXT,
+                lease_expires_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_jobs_owner ON analysis_jobs (owner, status)")
+        
+        # Create analysis_locks table so only one worker analyzes a video at a time
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_locks (
+                lock_key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                acquired_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                error TEXT,
+                status_code INTEGER
+            )
+        """)
+        
+        # A failed leader leaves its error on the lock row for followers to return
+        for column, column_type in (("error", "TEXT"), ("status_code", "INTEGER")):
+            try:
+                cursor.execute(f"ALTER TABLE analysis_locks ADD COLUMN {column} {column_type}")
+                log.info("Added %s column to analysis_locks table", column)
+            except sqlite3.OperationalError as e:
+                if "duplicate column name" not in str(e):
+                    log.error("Error adding %s column: %s", column, e)
 
 init_db()
 
+def cache_video_title(video_id, title):
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO movie_titles_cache (video_id, title) VALUES (?, ?)",
+                     (video_id, title))
+
+PLACEHOLDER_TITLE_PREFIX = "Movie #"
+
+# oEmbed first, then the watch page streamed only as far as the title;
+# both URLs can be pointed at a local stub for benchmarks
+title_fetcher = TitleFetcher(
+    oembed_url=os.getenv("YOUTUBE_OEMBED_URL", OEMBED_URL),
+    watch_url=os.getenv("YOUTUBE_WATCH_URL", WATCH_URL)
+)
+
+def fetch_youtube_title(video_id):
+    """Fetch a video's title from YouTube; returns None if not found"""
+    with stage("title"):
+        title, source, bytes_read = title_fetcher.fetch(video_id)
+    log.debug("Title lookup", extra=fields(video_id=video_id, source=source, bytes_read=bytes_read, found=bool(title)))
+    return title
+
+def resolve_video_title(video_id):
+    """Title from YouTube, else from our curated movie database, else a generic label"""
+    title = fetch_youtube_title(video_id)
+    if title:
+        return title
+
+    # Use actual titles from our curated movie database as backup
+    title = catalog.title(video_id)
+    if title:
+        return title
+
+    # Final fallback for unknown videos
+    return f"Video {video_id[:8]}"
+
 def get_youtube_video_title(video_id):
     """Fetch video title from YouTube with caching and fallback"""
     try:
         # First check cache
-        conn = sqlite3.connect("cache.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT title FROM movie_titles_cache WHERE video_id = ?", (video_id,))
-        cached = cursor.fetchone()
-        if cached and cached[0] and not cached[0].startswith("Movie #"):
-            conn.close()
+        cached = query_one("SELECT title FROM movie_titles_cache WHERE video_id = ?", (video_id,))
+        if cached and cached[0] and not cached[0].startswith(PLACEHOLDER_TITLE_PREFIX):
+            cache_lookups.inc(cache="title", result="hit")
             return cached[0]
-        
-        # Try to fetch real title from YouTube
-        try:
-            youtube_url = f"https://www.youtube.com/watch?v={video_id}"
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            
-            print(f"Fetching YouTube title for video: {video_id}")
-            response = requests.get(youtube_url, headers=headers, timeout=10)
-            
-            if response.status_code == 200:
-                # Extract title from HTML
-                import re
-                # Look for the title in the HTML - YouTube stores it in several places
-                title_match = re.search(r'"title":"([^"]+)"', response.text)
-                if not title_match:
-                    title_match = re.search(r'<title>([^<]+)</title>', response.text)
-                    if title_match:
-                        title = title_match.group(1)
-                        # Remove " - YouTube" suffix if present
-                        title = title.replace(" - YouTube", "").strip()
-                    else:
-                        title = None
-                else:
-                    title = title_match.group(1)
-                    # Decode unicode escapes
-                    title = title.encode().decode('unicode_escape')
-                
-                if title and len(title.strip()) > 0:
-                    print(f"Successfully fetched YouTube title: {title}")
-                    # Cache the real title
-                    cursor.execute("INSERT OR REPLACE INTO movie_titles_cache (video_id, title) VALUES (?, ?)", 
-                                  (video_id, title))
-                    conn.commit()
-                    conn.close()
-                    return title
-                    
-        except Exception as e:
-            print(f"Error fetching YouTube title for {video_id}: {str(e)}")
-        
-        # Use actual titles from our curated movie database as backup
-        for genre in FREE_MOVIES:
-            for movie in FREE_MOVIES[genre]:
-                if movie["id"] == video_id:
-                    title = movie["title"]
-                    # Cache the title
-                    cursor.execute("INSERT OR REPLACE INTO movie_titles_cache (video_id, title) VALUES (?, ?)", 
-                                  (video_id, title))
-                    conn.commit()
-                    conn.close()
-                    return title
-        
-        # Final fallback for unknown videos
-        title = f"Video {video_id[:8]}"
-        cursor.execute("INSERT OR REPLACE INTO movie_titles_cache (video_id, title) VALUES (?, ?)", 
-                      (video_id, title))
-        conn.commit()
-        conn.close()
-        
+        cache_lookups.inc(cache="title", result="miss")
+
+        title = resolve_video_title(video_id)
+        cache_video_title(video_id, title)
         return title
-        
-    except Exception as e:
-        print(f"Error in get_youtube_video_title for {video_id}: {str(e)}")
+
+    except Exception:
+        log.exception("Error in get_youtube_video_title for %s", video_id)
         return f"Video {video_id[:8]}"
 
+def save_resolved_titles(titles):
+    """Write a batch of resolved titles to the title cache and to history rows still showing a placeholder"""
+    with stage("db_title_write"), transaction() as conn:
+        conn.executemany("INSERT OR REPLACE INTO movie_titles_cache (video_id, title) VALUES (?, ?)",
+                         titles.items())
+        conn.executemany("UPDATE user_history SET video_title = ? WHERE video_id = ? AND video_title LIKE ?",
+                         [(title, video_id, PLACEHOLDER_TITLE_PREFIX + "%") for video_id, title in titles.items()])
+    log.info("Resolved %d video titles", len(titles))
+
+# History reads never wait on YouTube: placeholder titles are resolved
+# here in the background and show up on a later read
+title_resolver = TitleResolver(
+    resolve_video_title,
+    save_resolved_titles,
+    max_workers=int(os.getenv("TITLE_RESOLVER_WORKERS", "8"))
+)
+
 def add_to_history(user_id, video_id, video_title):
-    """Add a watched video to user's history"""
+    """Record a view in the user's history; written by the write-behind buffer"""
     try:
-        conn = sqlite3.connect("cache.db")
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO user_history (user_id, video_id, video_title)
-            VALUES (?, ?, ?)
-        """, (user_id, video_id, video_title))
-        conn.commit()
-        conn.close()
+        watched_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        write_buffer.put("history", (user_id, video_id), (video_title, 1, watched_at))
         return True
-    except Exception as e:
-        print(f"Error adding to history: {str(e)}")
+    except Exception:
+        log.exception("Error adding to history")
         return False
 
-def get_user_history(user_id):
-    """Get user's watch history with thumbnails"""
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+def encode_history_cursor(watched_at, row_id):
+    return base64.urlsafe_b64encode(json.dumps([watched_at, row_id]).encode()).decode()
+
+def decode_history_cursor(cursor):
+    """Inverse of encode_history_cursor; raises ValueError for a malformed cursor"""
     try:
-        conn = sqlite3.connect("cache.db")
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT video_id, video_title, watched_at
-            FROM user_history
-            WHERE user_id = ?
-            ORDER BY watched_at DESC
-            LIMIT 20
-        """, (user_id,))
-        history = cursor.fetchall()
+        watched_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if not isinstance(watched_at, str) or not isinstance(row_id, int):
+        raise ValueError("Invalid cursor")
+    return watched_at, row_id
+
+def get_user_history(user_id, limit=HISTORY_PAGE_SIZE, cursor=None):
+    """Get one page of the user's watch history, most recent first.
+
+    Returns ``(history, next_cursor)``; pass ``next_cursor`` back to get
+    the following page, it is None on the last page. Raises ValueError
+    for a malformed cursor. Placeholder titles
+    are swapped for any title already in the title cache; the rest are
+    handed to the background title resolver.
+    """
+    if cursor:
+        watched_at, row_id = decode_history_cursor(cursor)
+        after = "AND (h.watched_at, h.id) < (?, ?)"
+        params = (user_id, watched_at, row_id, limit + 1)
+    else:
+        after = ""
+        params = (user_id, limit + 1)
+    try:
+        rows = query_all(f"""
+            SELECT h.id, h.video_id, h.video_title, h.watched_at, h.view_count, c.title
+            FROM user_history h
+            LEFT JOIN movie_titles_cache c ON c.video_id = h.video_id
+            WHERE h.user_id = ? {after}
+            ORDER BY h.watched_at DESC, h.id DESC
+            LIMIT ?
+        """, params)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_history_cursor(rows[-1][3], rows[-1][0])
         
         # Enhance history with thumbnails and YouTube links
         enhanced_history = []
-        for row in history:
-            video_id = row[0]
-            title = row[1]
-            watched_at = row[2]
-            
-            # If the title starts with "Movie #", fetch the real YouTube title
-            if title and title.startswith("Movie #"):
-                print(f"Refreshing title for video {video_id}: {title}")
-                real_title = get_youtube_video_title(video_id)
-                if real_title and not real_title.startswith("Movie #"):
-                    title = real_title
-                    # Update the database with the real title
-                    cursor.execute("UPDATE user_history SET video_title = ? WHERE video_id = ? AND user_id = ?", 
-                                  (real_title, video_id, user_id))
-                    conn.commit()
-                    print(f"Updated title for video {video_id}: {real_title}")
+        unresolved = []
+        for _, video_id, title, watched_at, view_count, cached_title in rows:
+            if title and title.startswith(PLACEHOLDER_TITLE_PREFIX):
+                if cached_title and not cached_title.startswith(PLACEHOLDER_TITLE_PREFIX):
+                    title = cached_title
+                else:
+                    unresolved.append(video_id)
             
             # Generate YouTube thumbnail URL (high quality, fallback to medium quality)
             thumbnail_url = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
@@ -370,15 +692,18 @@ def get_user_history(user_id):
                 'video_id': video_id,
                 'title': title,
                 'watched_at': watched_at,
+                'view_count': view_count,
                 'thumbnail': thumbnail_url,
                 'youtube_url': youtube_url
             })
+
+        if unresolved:
+            title_resolver.request(unresolved)
         
-        conn.close()
-        return enhanced_history
-    except Exception as e:
-        print(f"Error fetching history: {str(e)}")
-        return []
+        return enhanced_history, next_cursor
+    except Exception:
+        log.exception("Error fetching history")
+        return [], None
 
 def get_video_id(url):
     # Handle URLs without protocol
@@ -403,75 +728,16 @@ def get_video_id(url):
     return None
 
 def chunk_transcript(transcript, chunk_duration=150):
-    chunks = []
-    current_chunk = []
-    current_duration = 0
-    current_start = 0
-    for entry in transcript:
-        duration = entry['duration']
-        if current_duration + duration <= chunk_duration:
-            current_chunk.append(entry)
-            current_duration += duration
-        else:
-            chunks.append({
-                'start': current_start,
-                'end': current_start + current_duration,
-                'text': ' '.join([e['text'] for e in current_chunk])
-            })
-            current_chunk = [entry]
-            current_start += current_duration
-            current_duration = duration
-    if current_chunk:
-        chunks.append({
-            'start': current_start,
-            'end': current_start + current_duration,
-            'text': ' '.join([e['text'] for e in current_chunk])
-        })
-    return chunks
+    """Split a transcript into ~chunk_duration second windows using the entries' real start times.
 
-def get_gemini_response(transcript_chunks, complexity_score):
-    print("=== ENTERING get_gemini_response ===")
-    
-    # Check if API key is available
-    if not GEMINI_API_KEY:
-        print("ERROR: GEMINI_API_KEY is not set!")
-        return {"error": "Gemini API key not configured"}
-    
-    print(f"API key available: True (length: {len(GEMINI_API_KEY)})")
-    
-    # Combine transcript chunks for analysis
-    full_transcript = ' '.join([chunk['text'] for chunk in transcript_chunks])  # Use all chunks for better scene detection
-    
-    print(f"Transcript chunks processed: {len(transcript_chunks)}")
-    print(f"Full transcript length: {len(full_transcript)} chars")
-    print(f"Full transcript preview (first 200 chars): {full_transcript[:200]}...")
-    
-    # Calculate video duration from transcript chunks
-    video_duration = transcript_chunks[-1]['end'] if transcript_chunks else 300  # Default to 5 minutes if no chunks
-    scene_duration = max(60, video_duration // 6)  # Aim for 6 scenes, minimum 60 seconds each
-    
-    print(f"Video duration: {video_duration} seconds")
-    print(f"Scene duration: {scene_duration} seconds")
-    
-    # Create scene time ranges
-    scenes = []
-    current_time = 0
-    scene_number = 1
-    
-    while current_time < video_duration:
-        scene_end = min(current_time + scene_duration, video_duration)
-        scenes.append({
-            "scene_number": scene_number,
-            "start": current_time,
-            "end": scene_end
-        })
-        current_time = scene_end
-        scene_number += 1
-    
-    scenes_json = json.dumps(scenes, indent=2)
-    print(f"Generated {len(scenes)} scenes: {scenes_json}")
-    
-    prompt = f"""
+    Accepts a Transcript or a list of {"text", "start", "duration"} entries.
+    """
+    return Transcript.from_entries(transcript).chunk_by_time(chunk_duration)
+
+# Prompt for analyzing a transcript (or one window of it). Cached analyses
+# are tagged with PROMPT_VERSION, so editing the template or switching model
+# retires them automatically.
+ANALYSIS_PROMPT_TEMPLATE = """
     Analyze this video transcript and provide a comprehensive JSON response with the following structure:
     {{
         "briefing": "A brief overview of what the video is about (2-3 sentences)",
@@ -515,7 +781,7 @@ def get_gemini_response(transcript_chunks, complexity_score):
     - Rate importance from 1-3 (1 = most important/main characters, 2 = important supporting characters, 3 = minor but relevant characters)
     - Only include characters that are actually relevant to understanding this video content
 
-    SCENES: Create a "scenes" array with exactly {len(scenes)} entries covering these time ranges:
+    SCENES: Create a "scenes" array with exactly {scene_count} entries covering these time ranges:
     {scenes_json}
 
     For each scene, provide:
@@ -523,10 +789,95 @@ def get_gemini_response(transcript_chunks, complexity_score):
     2. scene_title: A brief descriptive title for what happens in this scene
     3. what_happened: A clear, direct answer to "what just happened?" that a user would want to know if they clicked during this time period
 
-    Transcript: {full_transcript[:4000]}
+    {part_note}Transcript: {transcript_text}
     """
+
+# Bumped when a pipeline change makes analyses cached before it worth redoing.
+# 2: streamed analyses only saw the first few thousand characters of transcript.
+ANALYSIS_REVISION = 2
+
+PROMPT_VERSION = hashlib.sha1(
+    f"{ANALYSIS_PROMPT_TEMPLATE}{GEMINI_API_URL}{ANALYSIS_REVISION}".encode()).hexdigest()[:12]
+
+def build_scene_ranges(start, end, scene_duration):
+    """Split [start, end) into consecutive scene time ranges"""
+    scenes = []
+    current_time = start
+    scene_number = 1
     
-    print(f"Prompt created (length: {len(prompt)} chars)")
+    while current_time < end:
+        scene_end = min(current_time + scene_duration, end)
+        scenes.append({
+            "scene_number": scene_number,
+            "start": current_time,
+            "end": scene_end
+        })
+        current_time = scene_end
+        scene_number += 1
+    return scenes
+
+def build_analysis_prompt(transcript_text, scenes, scene_duration, part_note=""):
+    scenes_json = json.dumps(scenes, indent=2)
+    
+    return ANALYSIS_PROMPT_TEMPLATE.format(
+        scene_duration=scene_duration,
+        scene_count=len(scenes),
+        scenes_json=scenes_json,
+        part_note=part_note,
+        transcript_text=transcript_text
+    )
+
+# Every Gemini call in every worker draws from one shared quota. Calls run in
+# the interactive lane unless wrapped in use_lane(BATCH), as the warm-up CLI does.
+gemini_limiter = TokenBucketLimiter(
+    "gemini",
+    requests_per_minute=float(os.getenv("GEMINI_RPM", "60")),
+    tokens_per_minute=float(os.getenv("GEMINI_TPM", "1000000")),
+    batch_reserve=float(os.getenv("GEMINI_BATCH_RESERVE", "0.2"))
+)
+GEMINI_RATE_LIMIT_ENABLED = os.getenv("GEMINI_RATE_LIMIT_ENABLED", "1").lower() in ("1", "true", "yes")
+GEMINI_RATE_LIMIT_TIMEOUT = float(os.getenv("GEMINI_RATE_LIMIT_TIMEOUT", "30"))
+
+def acquire_gemini_capacity(prompt):
+    """Wait for shared Gemini quota; returns an error dict if it doesn't free up in time"""
+    if not GEMINI_RATE_LIMIT_ENABLED:
+        return None
+    # Batch work may queue behind interactive traffic indefinitely
+    timeout = GEMINI_RATE_LIMIT_TIMEOUT if current_lane() == INTERACTIVE else None
+    try:
+        waited = gemini_limiter.acquire(estimate_tokens(prompt), timeout=timeout)
+    except RateLimitTimeout as e:
+        log.warning("Gemini rate limit wait timed out: %s", e)
+        return {"error": str(e), "upstream": UpstreamError("gemini", "rate_limited", str(e)).to_dict()}
+    gemini_rate_limit_wait.observe(waited)
+    if waited > 0:
+        current = current_trace()
+        if current is not None:
+            current.add_stage("rate_limit_wait", waited)
+        log.debug("Waited %.2fs for Gemini rate limit", waited)
+    return None
+
+def record_token_usage(metadata, usage=None):
+    """Count a response's usageMetadata in the metrics and in ``usage`` if given"""
+    if not metadata:
+        return
+    gemini_tokens.inc(metadata.get('promptTokenCount', 0), kind="prompt")
+    gemini_tokens.inc(metadata.get('candidatesTokenCount', 0), kind="output")
+    if usage is not None:
+        usage.add(metadata)
+
+def json_mode_config(response_schema):
+    return {"responseMimeType": "application/json", "responseSchema": response_schema}
+
+def call_gemini(prompt, response_schema=None, usage=None):
+    """Send a prompt to Gemini and return the text part, or {"error": ...}.
+
+    With ``response_schema`` the call is made in JSON mode, so the text is
+    JSON matching the schema. Token usage is added to ``usage`` if given.
+    """
+    limited = acquire_gemini_capacity(prompt)
+    if limited:
+        return limited
     
     # Updated headers and request format for current Gemini API
     headers = {
@@ -545,232 +896,999 @@ def get_gemini_response(transcript_chunks, complexity_score):
             }
         ]
     }
-    
-    print(f"Request headers prepared: {list(headers.keys())}")
-    print(f"Request data structure: {list(data.keys())}")
-    print(f"API URL: {GEMINI_API_URL}")
+    if response_schema is not None:
+        data["generationConfig"] = json_mode_config(response_schema)
     
     try:
-        print("Making HTTP request to Gemini API...")
-        response = requests.post(GEMINI_API_URL, headers=headers, json=data, timeout=30)
-        
-        print(f"HTTP response received!")
-        print(f"Status code: {response.status_code}")
-        print(f"Response headers: {dict(response.headers)}")
+        with stage("gemini"):
+            response = http_client.post(GEMINI_API_URL, headers=headers, json=data, timeout=30)
+        log.debug("Gemini responded", extra=fields(status=response.status_code, bytes=len(response.content)))
         
         if response.status_code != 200:
-            print(f"ERROR: Non-200 status code received")
-            print(f"Response text: {response.text}")
+            log.error("Gemini returned status %d: %s", response.status_code, response.text[:500])
             return {"error": f"Gemini API returned status {response.status_code}: {response.text}"}
         
-        print("Parsing JSON response...")
         result = response.json()
-        print("JSON parsing successful!")
-        print(f"Response structure keys: {list(result.keys()) if isinstance(result, dict) else 'Not a dict'}")
+        record_token_usage(result.get('usageMetadata'), usage)
         
         if 'candidates' in result:
-            print(f"Found {len(result['candidates'])} candidates")
             if len(result['candidates']) > 0:
                 candidate = result['candidates'][0]
-                print(f"Candidate structure keys: {list(candidate.keys()) if isinstance(candidate, dict) else 'Not a dict'}")
                 
                 if 'content' in candidate:
                     content = candidate['content']
-                    print(f"Content structure keys: {list(content.keys()) if isinstance(content, dict) else 'Not a dict'}")
                     
                     if 'parts' in content and len(content['parts']) > 0:
                         text_response = content['parts'][0]['text']
-                        print(f"Text response extracted successfully!")
-                        print(f"Response length: {len(text_response)} chars")
-                        print(f"Response preview (first 300 chars): {text_response[:300]}...")
-                        print("=== get_gemini_response SUCCESS ===")
+                        log.debug("Gemini text received", extra=fields(chars=len(text_response)))
                         return text_response
                     else:
-                        print(f"ERROR: No parts in content or parts is empty")
-                        print(f"Content structure: {content}")
+                        log.error("Gemini response has no parts in content")
                         return {"error": f"No parts in content: {content}"}
                 else:
-                    print(f"ERROR: No content in candidate")
-                    print(f"Candidate structure: {candidate}")
+                    log.error("Gemini response has no content in candidate")
                     return {"error": f"No content in candidate: {candidate}"}
             else:
-                print("ERROR: No candidates found in response")
+                log.error("Gemini response has no candidates")
                 return {"error": "No candidates in response"}
         else:
-            print("ERROR: No candidates key in response")
-            print(f"Full response: {result}")
+            log.error("Gemini response has no candidates key")
             return {"error": f"No candidates key in response: {result}"}
             
-    except requests.exceptions.Timeout:
-        print("ERROR: Request timed out")
-        return {"error": "Gemini API request timed out"}
-    except requests.exceptions.ConnectionError:
-        print("ERROR: Connection error")
-        return {"error": "Failed to connect to Gemini API"}
+    except UpstreamError as e:
+        log.error("Gemini request failed (%s) after %d attempt(s): %s", e.reason, e.attempts, e)
+        if e.reason == "timeout":
+            message = "Gemini API request timed out"
+        elif e.reason == "connection":
+            message = "Failed to connect to Gemini API"
+        else:
+            message = f"Gemini API error: {str(e)}"
+        return {"error": message, "upstream": e.to_dict()}
     except json.JSONDecodeError as e:
-        print(f"ERROR: JSON decode error: {e}")
-        print(f"Response text: {response.text}")
+        log.error("Gemini response is not JSON: %s", e)
         return {"error": f"JSON decode error: {e}"}
     except Exception as e:
-        print(f"ERROR: Unexpected error: {str(e)}")
-        print(f"Error type: {type(e)}")
+        log.exception("Unexpected error calling Gemini")
         return {"error": f"Gemini API error: {str(e)}"}
+
+def stream_gemini(prompt, usage=None):
+    """Yield text fragments of a Gemini analysis as they are generated.
+
+    Uses streamGenerateContent with server-sent events, in JSON mode with
+    ANALYSIS_SCHEMA. Raises UpstreamError or VideoProcessingError if the
+    stream can't be started.
+    """
+    headers = {
+        "x-goog-api-key": GEMINI_API_KEY,
+        "Content-Type": "application/json"
+    }
+    limited = acquire_gemini_capacity(prompt)
+    if limited:
+        raise VideoProcessingError(limited['error'], 503, limited['upstream'])
+    
+    data = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": json_mode_config(ANALYSIS_SCHEMA)}
+    stream_url = GEMINI_API_URL.replace(":generateContent", ":streamGenerateContent") + "?alt=sse"
+    
+    with stage("gemini_connect"):
+        response = http_client.post(stream_url, headers=headers, json=data, timeout=30, stream=True)
+    try:
+        if response.status_code != 200:
+            raise VideoProcessingError(f"Gemini API returned status {response.status_code}: {response.text}", 500)
+        metadata = None
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            event = json.loads(line[5:])
+            # Each event carries the running totals; the last one is the bill
+            metadata = event.get('usageMetadata') or metadata
+            for candidate in event.get('candidates', [])[:1]:
+                for part in candidate.get('content', {}).get('parts', []):
+                    if part.get('text'):
+                        yield part['text']
+        record_token_usage(metadata, usage)
+    finally:
+        response.close()
+
+# Sections that fail validation are asked for again at most this many times
+GEMINI_REPAIR_ATTEMPTS = int(os.getenv("GEMINI_REPAIR_ATTEMPTS", "1"))
+
+def repair_sections(prompt, analysis, invalid, expected_scenes, usage):
+    """Re-ask Gemini for just the ``invalid`` sections of ``analysis``.
+
+    Returns the analysis, or {"error": ...} if a section it can't be cached
+    without is still missing or empty. Sections that stay invalid otherwise,
+    including scenes that are fewer than expected, keep whatever valid
+    entries they had.
+    """
+    for _ in range(GEMINI_REPAIR_ATTEMPTS):
+        if not invalid:
+            break
+        log.info("Re-requesting invalid analysis sections", extra=fields(sections=invalid))
+        for section in invalid:
+            analysis_repairs.inc(section=section)
+        if usage is not None:
+            usage.add_repair()
+        text = call_gemini(repair_prompt(prompt, invalid), section_schema(invalid), usage)
+        if isinstance(text, dict):
+            break
+        repaired, still_invalid = validate_analysis(extract_json(text), invalid, expected_scenes)
+        for section, value in repaired.items():
+            if section not in still_invalid or len(value) > len(analysis[section]):
+                analysis[section] = value
+        invalid = still_invalid
+
+    missing = {section: reason for section, reason in invalid.items()
+               if section in REQUIRED_SECTIONS and not analysis[section]}
+    if missing:
+        return {"error": "Gemini returned an unusable analysis: " + "; ".join(f"{s} {r}" for s, r in missing.items())}
+    if invalid:
+        log.warning("Keeping analysis with invalid sections", extra=fields(sections=invalid))
+    return analysis
+
+def request_analysis(prompt, expected_scenes=None, usage=None):
+    """Ask Gemini for an analysis in JSON mode and return it validated, or {"error": ...}"""
+    text = call_gemini(prompt, ANALYSIS_SCHEMA, usage)
+    if isinstance(text, dict):
+        return text
+    analysis, invalid = validate_analysis(extract_json(text), expected_scenes=expected_scenes)
+    return repair_sections(prompt, analysis, invalid, expected_scenes, usage)
+
+def get_gemini_response(transcript_chunks, complexity_score, usage=None):
+    """Analyze a transcript in one Gemini call; returns the analysis dict or {"error": ...}"""
+    # Check if API key is available
+    if not GEMINI_API_KEY:
+        log.error("GEMINI_API_KEY is not set")
+        return {"error": "Gemini API key not configured"}
+    
+    scenes, _ = video_scene_ranges(transcript_chunks)
+    prompt = build_video_prompt(transcript_chunks)
+    
+    return request_analysis(prompt, len(scenes), usage)
+
+def stream_analysis(transcript_chunks, on_partial, usage=None):
+    """Single-call analysis streamed from Gemini; returns the validated analysis or {"error": ...}.
+
+    ``on_partial(section, value)`` is called with the briefing and with each
+    list item as soon as it has been parsed, before validation.
+    """
+    if not GEMINI_API_KEY:
+        log.error("GEMINI_API_KEY is not set")
+        return {"error": "Gemini API key not configured"}
+    
+    scenes, _ = video_scene_ranges(transcript_chunks)
+    prompt = build_video_prompt(transcript_chunks)
+    parser = IncrementalJSONParser()
+    result = {}
+    try:
+        for fragment in stream_gemini(prompt, usage):
+            for event in parser.feed(fragment):
+                if event[0] == "field":
+                    _, key, value = event
+                    result[key] = value
+                    on_partial(key, value)
+                elif event[0] == "item":
+                    _, key, value = event
+                    result.setdefault(key, []).append(value)
+                    on_partial(key, value)
+                else:
+                    result.setdefault(event[1], [])
+    except UpstreamError as e:
+        log.error("Gemini stream failed (%s) after %d attempt(s): %s", e.reason, e.attempts, e)
+        return {"error": f"Gemini API error: {str(e)}", "upstream": e.to_dict()}
+    except VideoProcessingError as e:
+        return e.to_dict()
+    
+    if not parser.done:
+        return {"error": "Gemini stream ended before the analysis was complete"}
+    analysis, invalid = validate_analysis(result, expected_scenes=len(scenes))
+    return repair_sections(prompt, analysis, invalid, len(scenes), usage)
+
+def video_scene_ranges(transcript_chunks):
+    """Scene time ranges for a whole video, and their length in seconds"""
+    # Calculate video duration from transcript chunks
+    video_duration = transcript_chunks[-1]['end'] if transcript_chunks else 300  # Default to 5 minutes if no chunks
+    scene_duration = max(60, video_duration // 6)  # Aim for 6 scenes, minimum 60 seconds each
+    return build_scene_ranges(0, video_duration, scene_duration), scene_duration
+
+def build_video_prompt(transcript_chunks):
+    """Build the single-prompt analysis request for a whole chunked transcript"""
+    # Combine transcript chunks for analysis
+    full_transcript = ' '.join([chunk['text'] for chunk in transcript_chunks])  # Use all chunks for better scene detection
+    video_duration = transcript_chunks[-1]['end'] if transcript_chunks else 300
+    
+    # Create scene time ranges
+    scenes, scene_duration = video_scene_ranges(transcript_chunks)
+    
+    prompt = build_analysis_prompt(full_transcript, scenes, scene_duration)
+    log.debug("Built analysis prompt", extra=fields(
+        chunks=len(transcript_chunks), transcript_chars=len(full_transcript),
+        video_duration=video_duration, prompt_chars=len(prompt)))
     
-    print("=== get_gemini_response END (shouldn't reach here) ===")
-    return {"error": "Unexpected end of function"}
+    return prompt
+
+def split_transcript_windows(transcript_chunks, window_chars):
+    """Group consecutive chunks into windows of at most ``window_chars`` characters"""
+    windows = []
+    current = []
+    current_chars = 0
+    for chunk in transcript_chunks:
+        chunk_chars = len(chunk['text']) + 1
+        if current and current_chars + chunk_chars > window_chars:
+            windows.append(current)
+            current = []
+            current_chars = 0
+        current.append(chunk)
+        current_chars += chunk_chars
+    if current:
+        windows.append(current)
+    return windows
+
+def window_ranges(windows, video_duration):
+    """[start, end) of each window, widened so together they cover the whole video"""
+    ranges = []
+    for i, window in enumerate(windows):
+        start = 0 if i == 0 else window[0]['start']
+        end = windows[i + 1][0]['start'] if i + 1 < len(windows) else video_duration
+        ranges.append((start, max(end, start)))
+    return ranges
+
+def clip_scene_ranges(scenes, start, end):
+    """The parts of ``scenes`` that fall within [start, end)"""
+    pieces = []
+    for scene in scenes:
+        piece_start = max(scene['start'], start)
+        piece_end = min(scene['end'], end)
+        if piece_end > piece_start:
+            pieces.append({"scene_number": scene['scene_number'], "start": piece_start, "end": piece_end})
+    return pieces
+
+def merge_scene_pieces(pieces, scenes):
+    """Join the per-window pieces of each whole-video scene range into one scene"""
+    starts = [scene['start'] for scene in scenes]
+    grouped = {}
+    for piece in sorted(pieces, key=lambda p: p.get('scene_start', 0)):
+        middle = (piece.get('scene_start', 0) + piece.get('scene_end', 0)) / 2
+        index = max(0, bisect_right(starts, middle) - 1)
+        grouped.setdefault(index, []).append(piece)
+    merged = []
+    for index in sorted(grouped):
+        scene = scenes[index]
+        parts = grouped[index]
+        merged.append({
+            "scene_start": scene['start'],
+            "scene_end": scene['end'],
+            "scene_title": next((p['scene_title'] for p in parts if p.get('scene_title')), ''),
+            "what_happened": ' '.join(p['what_happened'] for p in parts if p.get('what_happened'))
+        })
+    return merged
+
+def merge_window_analyses(analyses, briefing, scenes):
+    """Combine per-window analyses into one briefing/characters/recaps/scenes result"""
+    characters = {}
+    theme_alerts = []
+    recaps = []
+    scene_pieces = []
+    for analysis in analyses:
+        for character in analysis.get('characters') or []:
+            name = str(character.get('name', '')).strip()
+            if not name:
+                continue
+            key = name.lower()
+            existing = characters.get(key)
+            if existing is None:
+                characters[key] = dict(character)
+            elif character.get('importance', 3) < existing.get('importance', 3):
+                existing['importance'] = character['importance']
+        theme_alerts.extend(analysis.get('theme_alerts') or [])
+        recaps.extend(analysis.get('recaps') or [])
+        scene_pieces.extend(analysis.get('scenes') or [])
+
+    ordered_characters = sorted(characters.values(), key=lambda c: c.get('importance', 3))
+    return {
+        "briefing": briefing,
+        "characters": ordered_characters[:6],
+        "theme_alerts": sorted(theme_alerts, key=lambda t: t.get('timestamp', 0)),
+        "recaps": sorted(recaps, key=lambda r: r.get('timestamp_start', 0)),
+        "scenes": merge_scene_pieces(scene_pieces, scenes)
+    }
+
+def reduce_briefings(briefings, usage=None):
+    """Ask Gemini for one overview from the per-window briefings"""
+    if len(briefings) == 1:
+        return briefings[0]
+    parts = "\n".join(f"{i + 1}. {b}" for i, b in enumerate(briefings))
+    prompt = f"""
+    These are summaries of consecutive parts of one video, in order:
+    {parts}
+
+    Write a brief overview of what the whole video is about (2-3 sentences). Respond with the overview text only.
+    """
+    response = call_gemini(prompt, usage=usage)
+    if isinstance(response, dict):
+        log.warning("Briefing reduce failed, using first window: %s", response.get('error'))
+        return briefings[0]
+    return response.strip()
+
+def get_gemini_response_map_reduce(transcript_chunks, complexity_score, usage=None):
+    """Analyze a long transcript window by window, in parallel, and merge the results.
+
+    Each window covers at most MAP_REDUCE_WINDOW_CHARS of transcript, so the
+    whole video is analyzed instead of just its opening minutes. Windows run
+    on at most MAP_REDUCE_CONCURRENCY threads. The video's scene ranges are
+    the same as for a single-call analysis: each window describes the parts
+    of them it covers, and the parts are joined again when merging.
+    """
+    if not GEMINI_API_KEY:
+        log.error("GEMINI_API_KEY is not set")
+        return {"error": "Gemini API key not configured"}
+    
+    windows = split_transcript_windows(transcript_chunks, MAP_REDUCE_WINDOW_CHARS)
+    video_duration = transcript_chunks[-1]['end'] if transcript_chunks else 300
+    video_scenes, scene_duration = video_scene_ranges(transcript_chunks)
+    bounds = window_ranges(windows, video_duration)
+    log.debug("Map-reduce analysis", extra=fields(windows=len(windows), video_duration=video_duration))
+    
+    def analyze_window(index, window):
+        window_start, window_end = bounds[index]
+        scenes = clip_scene_ranges(video_scenes, window_start, window_end)
+        part_note = (f"This is part {index + 1} of {len(windows)} of the transcript, covering "
+                     f"{window_start} to {window_end} seconds. Only describe this part; use absolute "
+                     f"timestamps within that range.\n\n    ")
+        text = ' '.join(chunk['text'] for chunk in window)
+        prompt = build_analysis_prompt(text, scenes, scene_duration, part_note)
+        return request_analysis(prompt, len(scenes), usage)
+    
+    with ThreadPoolExecutor(max_workers=min(MAP_REDUCE_CONCURRENCY, len(windows))) as executor:
+        # Copy the caller's context so windows stay in its rate limit lane
+        futures = [executor.submit(contextvars.copy_context().run, analyze_window, i, window)
+                   for i, window in enumerate(windows)]
+        results = [future.result() for future in futures]
+    
+    analyses = [r for r in results if 'error' not in r]
+    errors = [r for r in results if 'error' in r]
+    if not analyses:
+        log.error("All %d map-reduce windows failed", len(windows))
+        return errors[0]
+    if errors:
+        log.warning("%d of %d map-reduce windows failed, merging the rest", len(errors), len(windows))
+    
+    briefings = [a['briefing'] for a in analyses if a.get('briefing')]
+    briefing = reduce_briefings(briefings, usage) if briefings else ''
+    return merge_window_analyses(analyses, briefing, video_scenes)
+
+def complexity_from_clicks(click_count):
+    return max(1.0, 5.0 - (click_count * 0.1))
 
 def update_complexity_score(user_id, click_count):
-    conn = sqlite3.connect("cache.db")
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO user_complexity (user_id, clicks, complexity_score) VALUES (?, ?, ?)",
-                   (user_id, click_count, max(1.0, 5.0 - (click_count * 0.1))))
-    conn.commit()
-    conn.close()
+    """Queue the user's new click count and return the resulting complexity score"""
+    score = complexity_from_clicks(click_count)
+    write_buffer.put("complexity", user_id, (click_count, score))
+    return score
+
+def merge_history_views(old, new):
+    """Two pending views of one video: add the counts, keep the newest time and a known title"""
+    return (new[0] or old[0], old[1] + new[1], max(old[2], new[2]))
+
+def flush_pending_writes(batch):
+    """Write one batch from the write-behind buffer in a single transaction"""
+    with stage("db_flush"), transaction() as conn:
+        conn.executemany("INSERT OR REPLACE INTO user_complexity (user_id, clicks, complexity_score) VALUES (?, ?, ?)",
+                         [(user_id, clicks, score) for user_id, (clicks, score) in batch.get("complexity", [])])
+        conn.executemany("""
+            INSERT INTO user_history (user_id, video_id, video_title, view_count, watched_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, video_id) DO UPDATE SET
+                view_count = view_count + excluded.view_count,
+                watched_at = MAX(watched_at, excluded.watched_at),
+                video_title = COALESCE(excluded.video_title, video_title)
+        """, [(user_id, video_id, title, views, watched_at)
+              for (user_id, video_id), (title, views, watched_at) in batch.get("history", [])])
+
+# History views and click counts are buffered and written in batches off
+# the request path; repeated writes for the same key collapse into one
+write_buffer = WriteBehindBuffer(
+    flush_pending_writes,
+    flush_interval=int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "200")) / 1000.0,
+    max_batch=int(os.getenv("WRITE_BEHIND_BATCH", "200")),
+    max_pending=int(os.getenv("WRITE_BEHIND_MAX_PENDING", "5000"))
+)
+write_buffer.register("complexity")
+write_buffer.register("history", merge_history_views)
+atexit.register(write_buffer.close)
+
+class VideoProcessingError(Exception):
+    """Error raised by the analysis pipeline, carrying the HTTP status to return"""
+
+    def __init__(self, message, status_code=500, upstream=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.upstream = upstream
+
+    def to_dict(self):
+        data = {"error": str(self)}
+        if self.upstream:
+            data["upstream"] = self.upstream
+        return data
+
+def load_scene_rows(video_id):
+    return query_all("""
+        SELECT scene_start, scene_end, scene_title, what_happened
+        FROM video_scenes
+        WHERE video_id = ?
+        ORDER BY scene_start
+    """, (video_id,))
+
+def load_analysis_version(video_id):
+    # INSERT OR REPLACE gives the row a new rowid, so it changes whenever the analysis is rewritten
+    row = query_one("SELECT rowid FROM video_cache WHERE video_id = ?", (video_id,))
+    return row[0] if row else None
+
+# Scene timelines for /what_happened, loaded once per video and searched in memory
+scene_index = SceneIndex(
+    load_scene_rows,
+    load_analysis_version,
+    max_videos=int(os.getenv("SCENE_INDEX_MAX_VIDEOS", "512")),
+    max_bytes=int(os.getenv("SCENE_INDEX_MAX_BYTES", str(32 * 1024 * 1024)))
+)
+
+def get_video_scenes(video_id):
+    rows = load_scene_rows(video_id)
+    return [{"scene_start": row[0], "scene_end": row[1], "scene_title": row[2], "what_happened": row[3]}
+            for row in rows]
+
+def decode_analysis_row(row, scenes):
+    """Analysis dict from a (briefing, theme_alerts, recaps, characters, ...) video_cache row"""
+    return {
+        "briefing": row[0],
+        "theme_alerts": json.loads(row[1]) if row[1] else [],
+        "recaps": json.loads(row[2]) if row[2] else [],
+        "characters": json.loads(row[3]) if row[3] else [],
+        "scenes": scenes
+    }
+
+def get_cached_analysis(video_id):
+    """Return the cached analysis for a video, or None on a miss, stale or corrupted row"""
+    cached = query_one("SELECT briefing, theme_alerts, recaps, characters, prompt_version FROM video_cache WHERE video_id = ?", (video_id,))
+    if not cached:
+        return None
+    if cached[4] != PROMPT_VERSION:
+        log.info("Cached analysis for %s is from prompt version %s, re-analyzing", video_id, cached[4])
+        return None
+    try:
+        return decode_analysis_row(cached, get_video_scenes(video_id))
+    except Exception as e:
+        log.error("Error parsing cached analysis for %s: %s", video_id, e)
+        # Treat a corrupted cache row as a miss so the video is processed again
+        return None
+
+# In-memory tier in front of video_cache holding serialized responses
+analysis_cache = AnalysisCache(
+    load_analysis_version,
+    max_entries=int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "1024")),
+    max_bytes=int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=int(os.getenv("ANALYSIS_CACHE_TTL", "3600")),
+    revalidate_seconds=float(os.getenv("ANALYSIS_CACHE_REVALIDATE_SECONDS", "5"))
+)
+
+def complexity_bucket(complexity_score):
+    return max(1, min(5, int(complexity_score)))
+
+def analysis_cache_key(video_id, complexity_score):
+    return (video_id, PROMPT_VERSION, complexity_bucket(complexity_score))
+
+def get_user_complexity(user_id):
+    pending = write_buffer.pending("complexity", user_id)
+    if pending:
+        return pending[1]
+    score = query_one("SELECT complexity_score FROM user_complexity WHERE user_id = ?", (user_id,))
+    return score[0] if score else 1.0
+
+def download_transcript(video_id):
+    """Transcript entries for a video from YouTube, or from TRANSCRIPT_SOURCE_URL when set"""
+    if TRANSCRIPT_SOURCE_URL:
+        response = http_client.get(TRANSCRIPT_SOURCE_URL.format(video_id=video_id), timeout=10)
+        response.raise_for_status()
+        return response.json()
+    return YouTubeTranscriptApi.get_transcript(video_id)
+
+def fetch_transcript(video_id):
+    """Return a video's transcript, from the transcripts table if we have it.
+
+    Only downloads from YouTube on a miss, and stores what it downloads.
+    Raises VideoProcessingError if no transcript is available.
+    """
+    stored = load_transcript(video_id, max_age=TRANSCRIPT_MAX_AGE)
+    if stored is not None:
+        annotate(transcript="stored")
+        cache_lookups.inc(cache="transcript", result="hit")
+        return stored
+    
+    annotate(transcript="youtube")
+    cache_lookups.inc(cache="transcript", result="miss")
+    try:
+        with stage("transcript_fetch"):
+            transcript_list = Transcript.from_entries(download_transcript(video_id))
+    except TranscriptsDisabled:
+        log.info("Transcripts disabled for %s", video_id)
+        transcript_fetches.inc(outcome="disabled")
+        raise VideoProcessingError("Transcripts are disabled for this video", 400)
+    except NoTranscriptFound:
+        log.info("No transcript found for %s", video_id)
+        transcript_fetches.inc(outcome="not_found")
+        raise VideoProcessingError("No transcript found for this video", 400)
+    except Exception as e:
+        log.error("Transcript fetch failed for %s: %s", video_id, e)
+        transcript_fetches.inc(outcome="error")
+        raise VideoProcessingError(f"Failed to fetch transcript: {str(e)}", 400)
+    transcript_fetches.inc(outcome="ok")
+    
+    try:
+        save_transcript(video_id, transcript_list)
+    except Exception as e:
+        # Storing is an optimization; the analysis can go ahead without it
+        log.error("Error storing transcript for %s: %s", video_id, e)
+    return transcript_list
+
+def encode_analysis_row(video_id, analysis):
+    """The video_cache row for an analysis, with its list fields as JSON text"""
+    return (
+        video_id,
+        analysis.get('briefing', ''),
+        json.dumps(analysis.get('theme_alerts', [])),
+        json.dumps(analysis.get('recaps', [])),
+        json.dumps(analysis.get('characters', [])),
+        analysis.get('rating', ''),
+        analysis.get('complexity', ''),
+        PROMPT_VERSION
+    )
+
+def write_analysis(conn, video_id, analysis):
+    """Write an analysis to video_cache, video_scenes and video_characters on an open transaction"""
+    conn.execute("""
+        INSERT OR REPLACE INTO video_cache 
+        (video_id, briefing, theme_alerts, recaps, characters, rating, complexity, prompt_version) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, encode_analysis_row(video_id, analysis))
+    save_video_scenes(conn, video_id, analysis.get('scenes') or [])
+    save_video_characters(conn, video_id, analysis.get('characters') or [])
+
+def store_analysis(video_id, analysis):
+    """Cache a finished analysis in one transaction"""
+    store_analyses([(video_id, analysis)])
+
+def store_analyses(items):
+    """Cache many (video_id, analysis) pairs in a single transaction"""
+    with stage("db_write"), transaction() as conn:
+        for video_id, analysis in items:
+            write_analysis(conn, video_id, analysis)
+    for video_id, _ in items:
+        scene_index.invalidate(video_id)
+        analysis_cache.invalidate_video(video_id)
+
+def cached_video_ids(video_ids):
+    """Return the subset of video_ids that have an up-to-date cached analysis"""
+    found = set()
+    video_ids = list(video_ids)
+    # Stay well under SQLite's bound-parameter limit
+    for i in range(0, len(video_ids), 500):
+        batch = video_ids[i:i + 500]
+        placeholders = ",".join("?" * len(batch))
+        rows = query_all(f"""
+            SELECT video_id FROM video_cache
+            WHERE prompt_version = ? AND video_id IN ({placeholders})
+        """, [PROMPT_VERSION] + batch)
+        found.update(row[0] for row in rows)
+    return found
+
+def generate_analysis(chunked_transcript, complexity_score, usage=None, on_partial=None):
+    """Run the Gemini analysis, using map-reduce for transcripts longer than one window.
+
+    With ``on_partial``, a single-call analysis is streamed and its parts
+    passed to ``on_partial(section, value)`` as Gemini produces them.
+    """
+    transcript_chars = sum(len(chunk['text']) + 1 for chunk in chunked_transcript)
+    if MAP_REDUCE_ENABLED and transcript_chars > MAP_REDUCE_WINDOW_CHARS:
+        return get_gemini_response_map_reduce(chunked_transcript, complexity_score, usage)
+    if on_partial is not None:
+        return stream_analysis(chunked_transcript, on_partial, usage)
+    return get_gemini_response(chunked_transcript, complexity_score, usage)
+
+def report_token_usage(video_id, usage):
+    """Record what a successful analysis cost"""
+    analysis_tokens.observe(usage.total_tokens)
+    annotate(tokens=usage.total_tokens, gemini_calls=usage.calls)
+    log.info("Analysis complete", extra=fields(video_id=video_id, **usage.as_dict()))
+
+def run_analysis(video_id, complexity_score, report, on_partial=None):
+    """Fetch the transcript, run it through Gemini and cache the analysis"""
+
+    # Fetch transcript
+    report("transcript")
+    with stage("transcript"):
+        transcript_list = fetch_transcript(video_id)
+
+    # Process transcript
+    with stage("chunk"):
+        chunked_transcript = chunk_transcript(transcript_list)
+
+    # Call Gemini API
+    report("llm")
+    usage = TokenUsage()
+    with stage("llm"):
+        gemini_response = generate_analysis(chunked_transcript, complexity_score, usage, on_partial)
+
+    if isinstance(gemini_response, dict) and 'error' in gemini_response:
+        log.error("Analysis of %s failed: %s", video_id, gemini_response['error'])
+        upstream = gemini_response.get('upstream')
+        # Rate limiting upstream is temporary, so tell clients to retry later
+        status_code = 503 if upstream and upstream['reason'] in ('rate_limited', 'concurrency_limit') else 500
+        raise VideoProcessingError(gemini_response['error'], status_code, upstream)
+
+    report_token_usage(video_id, usage)
+
+    # Cache the response
+    store_analysis(video_id, gemini_response)
+
+    return gemini_response
+
+# Concurrent analyses of the same video share one transcript fetch and one
+# Gemini call: first across threads in this worker, then across workers via
+# a lock row in cache.db
+video_flight = SingleFlight()
+video_db_flight = DbSingleFlight(
+    lease_seconds=int(os.getenv("COALESCE_LEASE_SECONDS", "30")),
+    max_hold=int(os.getenv("COALESCE_MAX_HOLD_SECONDS", "600")),
+    failure_ttl=int(os.getenv("COALESCE_FAILURE_TTL_SECONDS", "10"))
+)
+
+def analyze_video(video_id, user_id, complexity_score, on_stage=None, on_partial=None):
+    """Run the analysis for a video, coalescing with any in-flight analysis of it.
+
+    ``on_stage`` is called with "transcript" and "llm" as the pipeline
+    progresses. ``on_partial`` gets parts of the analysis as they are
+    generated, but only if this call leads and the video fits in one Gemini
+    call (see generate_analysis). Raises VideoProcessingError on failure.
+    """
+    def report(stage):
+        if on_stage:
+            on_stage(stage)
+
+    def lead():
+        try:
+            result, shared = video_db_flight.do(
+                video_id,
+                lambda: run_analysis(video_id, complexity_score, report, on_partial),
+                lambda: get_cached_analysis(video_id)
+            )
+        except LeaderFailed as e:
+            annotate(coalesced="cross_process")
+            raise VideoProcessingError(str(e), e.status_code)
+        if shared:
+            annotate(coalesced="cross_process")
+        return result
+
+    result, shared = video_flight.do(video_id, lead)
+    if shared:
+        annotate(coalesced="in_process")
+
+    # Add to history
+    video_title = get_youtube_video_title(video_id)
+    add_to_history(user_id, video_id, video_title)
+
+    return result
+
+def run_analysis_job(job):
+    return analyze_video(job.video_id, job.user_id, job.params["complexity_score"],
+                         on_stage=lambda stage: job_manager.set_stage(job, stage))
+
+job_manager = JobManager(
+    run_analysis_job,
+    max_workers=int(os.getenv("JOB_WORKERS", "4")),
+    max_queue=int(os.getenv("JOB_QUEUE_SIZE", "64")),
+    lease_seconds=int(os.getenv("JOB_LEASE_SECONDS", "60"))
+)
+
+def lookup_cached_analysis(video_id, complexity_score):
+    """(EncodedBody, title) for a cached analysis, from the in-process tier or video_cache; None on a miss"""
+    with stage("cache_lookup"):
+        cache_key = analysis_cache_key(video_id, complexity_score)
+        cached = analysis_cache.get(cache_key)
+        if cached is not None:
+            result = "l1_hit"
+        else:
+            # Read before the row, so a rewrite in between only makes the entry look stale
+            version = load_analysis_version(video_id)
+            analysis = get_cached_analysis(video_id)
+            if analysis is not None:
+                encoded = EncodedBody(json.dumps(analysis).encode())
+                cached = (encoded, get_youtube_video_title(video_id))
+                analysis_cache.put(cache_key, cached, encoded.size(), version)
+                result = "l2_hit"
+            else:
+                result = "miss"
+    annotate(cache=result)
+    cache_lookups.inc(cache="analysis", result=result)
+    return cached
+
+def wants_async(data):
+    """Async mode is requested with {"async": true} or ?async=1"""
+    if data.get('async') is True:
+        return True
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+def encoded_json_response(encoded):
+    """Send a cached EncodedBody in the client's preferred coding, or 304 if its copy is current.
+
+    If-None-Match is honoured on POST too: the frontend posts to
+    /process_video_stream, gets cache hits back as JSON and sends the
+    ETag it kept when it asks for the same video again.
+    """
+    if etag_matches(request.headers.get('If-None-Match'), encoded.etag):
+        response = Response(status=304)
+        response.set_etag(encoded.etag)
+    else:
+        body, etag, encoding = encoded.get(negotiate_encoding(request.accept_encodings))
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress other sizeable responses on the fly when the client accepts it"""
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype == 'text/event-stream'):
+        return response
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes differ from what a strong ETag promised
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
 
 @app.route('/process_video', methods=['POST'])
 def process_video():
-    conn = None
     try:
-        print("=== STARTING VIDEO PROCESSING ===")
-        print(f"Request method: {request.method}")
-        print(f"Request headers: {dict(request.headers)}")
-        
         # Validate request data
         data = request.get_json()
-        print(f"Received JSON data: {data}")
         
         if not data:
-            print("ERROR: No JSON data received")
             return jsonify({"error": "Invalid JSON data"}), 400
             
         youtube_url = data.get('youtube_url')
         user_id = data.get('user_id', 'default_user')
         
-        print(f"Processing video URL: '{youtube_url}'")
-        print(f"URL type: {type(youtube_url)}")
-        print(f"URL length: {len(youtube_url) if youtube_url else 'None'}")
-        print(f"User ID: {user_id}")
-        
         if not youtube_url:
-            print("ERROR: No YouTube URL provided")
             return jsonify({"error": "No YouTube URL provided"}), 400
 
-        # Test URL parsing with detailed debugging
-        print(f"Testing URL parsing for: {youtube_url}")
-        video_id = get_video_id(youtube_url)
-        print(f"Extracted video ID: {video_id}")
+        with stage("video_id"):
+            video_id = get_video_id(youtube_url)
         
         if not video_id:
-            print("ERROR: Invalid YouTube URL - get_video_id returned None")
-            # Let's also test the URL parsing step by step
-            from urllib.parse import urlparse, parse_qs
-            parsed_url = urlparse(youtube_url)
-            print(f"Parsed URL hostname: {parsed_url.hostname}")
-            print(f"Parsed URL path: {parsed_url.path}")
-            print(f"Parsed URL query: {parsed_url.query}")
+            log.info("Could not extract a video id", extra=fields(url=youtube_url[:200]))
             return jsonify({"error": "Invalid YouTube URL. Please use a valid YouTube URL like: https://www.youtube.com/watch?v=VIDEO_ID"}), 400
 
-        print(f"Successfully extracted video ID: {video_id}")
+        annotate(video_id=video_id)
 
-        # Initialize database connection
-        conn = sqlite3.connect("cache.db")
-        cursor = conn.cursor()
-        
-        # Check cache
-        print("Checking cache for video...")
-        cursor.execute("SELECT briefing, theme_alerts, recaps, characters FROM video_cache WHERE video_id = ?", (video_id,))
-        cached = cursor.fetchone()
-        if cached:
-            print("Found cached data, returning cached response")
-            try:
-                result = {
-                    "briefing": cached[0],
-                    "theme_alerts": json.loads(cached[1]) if cached[1] else [],
-                    "recaps": json.loads(cached[2]) if cached[2] else [],
-                    "characters": json.loads(cached[3]) if cached[3] else []
-                }
-                
-                # Add to history
-                video_title = get_youtube_video_title(video_id)
-                add_to_history(user_id, video_id, video_title)
-                
-                return jsonify(result)
-            except Exception as e:
-                print(f"Error parsing cached data: {e}")
-                # Continue to process video if cache is corrupted
-        
         # Get user complexity score
-        cursor.execute("SELECT complexity_score FROM user_complexity WHERE user_id = ?", (user_id,))
-        score = cursor.fetchone()
-        complexity_score = score[0] if score else 1.0
-        
-        print(f"User complexity score: {complexity_score}")
+        complexity_score = get_user_complexity(user_id)
         
-        # Fetch transcript
-        print("Fetching transcript...")
+        # Check cache - hits are always answered inline, even in async mode
+        cached = lookup_cached_analysis(video_id, complexity_score)
+        if cached is not None:
+            encoded, video_title = cached
+            
+            # Add to history
+            add_to_history(user_id, video_id, video_title)
+            
+            return encoded_json_response(encoded)
+
+        if wants_async(data):
+            try:
+                job = job_manager.submit(video_id, user_id, {"complexity_score": complexity_score})
+            except QueueFullError as e:
+                return jsonify({"error": str(e)}), 503
+            annotate(job_id=job.job_id)
+            return jsonify({
+                "job_id": job.job_id,
+                "status": job.status,
+                "status_url": f"/job_status/{job.job_id}"
+            }), 202
+
         try:
-            transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
-            print(f"Transcript fetched successfully. {len(transcript_list)} entries")
-        except TranscriptsDisabled:
-            print("ERROR: Transcripts disabled for this video")
-            return jsonify({"error": "Transcripts are disabled for this video"}), 400
-        except NoTranscriptFound:
-            print("ERROR: No transcript found")
-            return jsonify({"error": "No transcript found for this video"}), 400
-        except Exception as e:
-            print(f"ERROR: Transcript fetch failed: {e}")
-            return jsonify({"error": f"Failed to fetch transcript: {str(e)}"}), 400
-        
-        # Process transcript
-        print("Processing transcript...")
-        chunked_transcript = chunk_transcript(transcript_list)
-        print(f"Transcript chunked into {len(chunked_transcript)} chunks")
-        
-        # Call Gemini API
-        print("Calling Gemini API...")
-        gemini_response = get_gemini_response(chunked_transcript, complexity_score)
-        
-        if isinstance(gemini_response, dict) and 'error' in gemini_response:
-            print(f"ERROR: Gemini API call failed: {gemini_response['error']}")
-            return jsonify(gemini_response), 500
-        
-        print("Gemini API call successful")
-        
-        # Cache the response
-        print("Caching response...")
-        cursor.execute("""
-            INSERT OR REPLACE INTO video_cache 
-            (video_id, briefing, theme_alerts, recaps, characters, rating, complexity) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            video_id,
-            gemini_response.get('briefing', ''),
-            json.dumps(gemini_response.get('theme_alerts', [])),
-            json.dumps(gemini_response.get('recaps', [])),
-            json.dumps(gemini_response.get('characters', [])),
-            gemini_response.get('rating', ''),
-            gemini_response.get('complexity', '')
-        ))
-        
-        conn.commit()
-        print("Response cached successfully")
-        
-        # Add to history
-        video_title = get_youtube_video_title(video_id)
-        add_to_history(user_id, video_id, video_title)
+            gemini_response = analyze_video(video_id, user_id, complexity_score)
+        except VideoProcessingError as e:
+            return jsonify(e.to_dict()), e.status_code
+        except CoalescingTimeout as e:
+            return jsonify({"error": str(e)}), e.status_code
         
         return jsonify(gemini_response)
         
     except Exception as e:
-        print(f"CRITICAL ERROR in process_video: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Unhandled error in process_video")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
+@app.route('/job_status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report progress (queued/transcript/llm/done) and the result of an analysis job"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+# Streamed array items are sent one at a time under these event names
+STREAM_ITEM_EVENTS = {
+    "characters": "character",
+    "scenes": "scene",
+    "theme_alerts": "theme_alert",
+    "recaps": "recap"
+}
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_cached_analysis(result):
+    yield sse_event("briefing", result.get("briefing", ""))
+    for key in ("characters", "scenes", "theme_alerts", "recaps"):
+        for item in result.get(key) or []:
+            yield sse_event(STREAM_ITEM_EVENTS[key], item)
+    yield sse_event("done", result)
+
+def stream_new_analysis(video_id, user_id, complexity_score):
+    """Run the analysis and send each part of the result as soon as it is available.
+
+    The analysis runs through analyze_video on a helper thread, so it is
+    coalesced and cached exactly like /process_video, and it still finishes
+    and is cached if the client goes away. Parts are streamed as Gemini
+    generates them when this request leads a single-call analysis;
+    otherwise they are all sent once the analysis is done.
+    """
+    events = queue.Queue()
     
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed")
+    def run():
+        try:
+            result = analyze_video(
+                video_id, user_id, complexity_score,
+                on_stage=lambda name: events.put(("status", name)),
+                on_partial=lambda section, value: events.put((STREAM_ITEM_EVENTS.get(section, section), value)))
+            events.put(("result", result))
+        except VideoProcessingError as e:
+            events.put(("error", e.to_dict()))
+        except CoalescingTimeout as e:
+            events.put(("error", {"error": str(e)}))
+        except Exception as e:
+            log.exception("Error in stream_new_analysis")
+            events.put(("error", {"error": f"Internal server error: {str(e)}"}))
+    
+    # The copied context carries the request trace, so stage timings still reach its summary
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), name=f"stream-{video_id}", daemon=True).start()
+    
+    streamed = False
+    while True:
+        event, data = events.get()
+        if event == "result":
+            if streamed:
+                yield sse_event("done", data)
+            else:
+                yield from stream_cached_analysis(data)
+            return
+        if event == "error":
+            yield sse_event("error", data)
+            return
+        streamed = streamed or event != "status"
+        yield sse_event(event, data)
+
+def prefers_json_hits():
+    """True if the client listed application/json in Accept, so cache hits can skip the event stream"""
+    return any(mimetype == 'application/json' for mimetype, _ in request.accept_mimetypes)
+
+@app.route('/process_video_stream', methods=['GET', 'POST'])
+def process_video_stream():
+    """Server-sent events version of /process_video.
+
+    Sends the briefing first, then one event per character and per scene in
+    order, then the remaining sections, and finally a "done" event with the
+    full analysis. Accepts JSON (POST) or query parameters (GET, for
+    EventSource). Clients that also accept application/json get cached
+    analyses as a plain JSON response instead, with the same ETag, 304 and
+    compression handling as /process_video.
+    """
+    data = request.get_json(silent=True) if request.method == 'POST' else request.args
+    if not data:
+        return jsonify({"error": "Invalid JSON data"}), 400
+    
+    youtube_url = data.get('youtube_url')
+    user_id = data.get('user_id', 'default_user')
+    if not youtube_url:
+        return jsonify({"error": "No YouTube URL provided"}), 400
+    
+    with stage("video_id"):
+        video_id = get_video_id(youtube_url)
+    if not video_id:
+        return jsonify({"error": "Invalid YouTube URL. Please use a valid YouTube URL like: https://www.youtube.com/watch?v=VIDEO_ID"}), 400
+    
+    annotate(video_id=video_id)
+    complexity_score = get_user_complexity(user_id)
+    cached = lookup_cached_analysis(video_id, complexity_score)
+    if cached is not None:
+        encoded, video_title = cached
+        add_to_history(user_id, video_id, video_title)
+        if prefers_json_hits():
+            return encoded_json_response(encoded)
+        events = stream_cached_analysis(json.loads(encoded.body))
+    else:
+        if not GEMINI_API_KEY:
+            return jsonify({"error": "Gemini API key not configured"}), 500
+        events = stream_new_analysis(video_id, user_id, complexity_score)
+    
+    # Keeps the request context, and so the trace, open until the stream ends
+    g.summary_deferred = True
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/pipeline_stats', methods=['GET'])
+def pipeline_stats():
+    """Job queue and request coalescing counters for this worker"""
+    return jsonify({
+        "jobs": job_manager.stats(),
+        "coalescing": {
+            "in_process": {
+                "leaders": video_flight.leaders,
+                "coalesced": video_flight.coalesced,
+                "in_flight": video_flight.in_flight()
+            },
+            "cross_process": video_db_flight.stats()
+        },
+        "http_hosts": http_client.stats(),
+        "scene_index": scene_index.stats(),
+        "analysis_cache": analysis_cache.stats(),
+        "gemini_rate_limit": gemini_limiter.stats(),
+        "title_resolver": title_resolver.stats(),
+        "title_fetch": title_fetcher.stats(),
+        "write_behind": write_buffer.stats()
+    })
+
+gauge_callback("klarity_write_behind_pending", "Writes buffered and not yet flushed", (),
+               lambda: {(): write_buffer.stats()["pending"]})
+gauge_callback("klarity_title_resolver_queued", "Video titles waiting to be resolved", (),
+               lambda: {(): title_resolver.stats()["queued"]})
+gauge_callback("klarity_job_queue_depth", "Analysis jobs waiting for a worker", (),
+               lambda: {(): job_manager.stats()["queue_depth"]})
+gauge_callback("klarity_analysis_cache_bytes", "Bytes held by the in-memory analysis cache", (),
+               lambda: {(): analysis_cache.stats()["bytes"]})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, summed over all workers when METRICS_DIR is set"""
+    snapshot = collect()
+    add_ratio(snapshot, "klarity_cache_lookups_total", "klarity_cache_hit_ratio",
+              "Share of lookups answered from cache", "cache", lambda labels: labels["result"].endswith("hit"))
+    return Response(render(snapshot), mimetype="text/plain; version=0.0.4")
+
+@app.route('/slow_requests', methods=['GET'])
+def get_slow_requests():
+    """This worker's slowest recent requests to the profiled endpoints, with their stage breakdown"""
+    if profiler.admin_token and request.headers.get('X-Profile') != profiler.admin_token:
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify({
+        "window_seconds": slow_requests.window,
+        "requests": slow_requests.top(),
+        "profiled": profiler.profiled,
+        "sample_rate": profiler.sample_rate
+    })
 
 @app.route('/update_clicks', methods=['POST'])
 def update_clicks():
@@ -786,87 +1904,38 @@ def update_clicks():
         if not isinstance(click_count, int) or click_count < 0:
             return jsonify({"error": "Invalid click count"}), 400
             
-        update_complexity_score(user_id, click_count)
-        
-        conn = sqlite3.connect("cache.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT complexity_score FROM user_complexity WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            score = result[0]
-        else:
-            # Fallback if user not found
-            score = 1.0
+        score = update_complexity_score(user_id, click_count)
             
-        conn.close()
         return jsonify({"complexity_score": score})
         
-    except Exception as e:
-        print(f"Error in update_clicks: {str(e)}")
+    except Exception:
+        log.exception("Error in update_clicks")
         return jsonify({"error": "Internal server error", "complexity_score": 1.0}), 500
 
+def cacheable_json_response(body, etag, cache_control, status=200):
+    """JSON response with a strong ETag that answers 304 when the client's copy matches"""
+    response = Response(body, status=status, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
 @app.route('/get_recommendations', methods=['GET'])
 def get_recommendations():
     try:
         user_id = request.args.get('user_id', 'default_user')
         
-        conn = sqlite3.connect("cache.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT complexity_score FROM user_complexity WHERE user_id = ?", (user_id,))
-        score = cursor.fetchone()
-        complexity_score = score[0] if score else 1.0
-        conn.close()
+        complexity_score = get_user_complexity(user_id)
 
-        # Use simple algorithm for recommendations based on complexity score
-        # Higher complexity = more complex movies (later in the list)
-        try:
-            index = min(int(complexity_score) - 1, len(FREE_MOVIES["action"]) - 1)
-            index = max(0, index)  # Ensure index is not negative
-            
-            recommendations = {
-                "action": FREE_MOVIES["action"][index],
-                "comedy": FREE_MOVIES["comedy"][index],
-                "thriller": FREE_MOVIES["thriller"][index],
-                "horror": FREE_MOVIES["horror"][index]
-            }
-        except Exception as e:
-            print(f"Error creating recommendations: {str(e)}")
-            recommendations = {
-                "action": FREE_MOVIES["action"][0], 
-                "comedy": FREE_MOVIES["comedy"][0],
-                "thriller": FREE_MOVIES["thriller"][0], 
-                "horror": FREE_MOVIES["horror"][0]
-            }
-
-        # Return all movies for browsing by genre (Netflix-style)
-        genres_expanded = {}
-        for genre, movies in FREE_MOVIES.items():
-            # Get different movies than recommendation to avoid duplicates
-            rec_id = recommendations[genre]["id"] if genre in recommendations else None
-            available_movies = [m for m in movies if m["id"] != rec_id]
-            if available_movies:
-                genres_expanded[genre] = available_movies  # All movies except the recommended one
-            else:
-                genres_expanded[genre] = movies[1:]  # Skip first movie if it's the recommended one
-
-        return jsonify({
-            "complexity_score": complexity_score,
-            "recommendations": recommendations,
-            "genres": genres_expanded
-        })
+        # Bodies differ per user, so clients and caches must revalidate each time
+        body, etag = catalog.recommendations(complexity_score)
+        return cacheable_json_response(body, etag, 'no-cache')
         
-    except Exception as e:
-        print(f"Error in get_recommendations: {str(e)}")
+    except Exception:
+        log.exception("Error in get_recommendations")
         return jsonify({
             "error": "Internal server error",
             "complexity_score": 1.0,
-            "recommendations": {
-                "action": FREE_MOVIES["action"][0],
-                "comedy": FREE_MOVIES["comedy"][0], 
-                "thriller": FREE_MOVIES["thriller"][0],
-                "horror": FREE_MOVIES["horror"][0]
-            },
+            "recommendations": {genre: movies[0] for genre, movies in FREE_MOVIES.items()},
             "genres": {genre: [movies[0]] for genre, movies in FREE_MOVIES.items()}
         }), 500
 
@@ -874,14 +1943,24 @@ def get_recommendations():
 def get_history():
     try:
         user_id = request.args.get('user_id', 'default_user')
-        history = get_user_history(user_id)
+        try:
+            limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+        except ValueError:
+            return jsonify({"error": "limit must be an integer", "history": []}), 400
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+        try:
+            with stage("history_query"):
+                history, next_cursor = get_user_history(user_id, limit, request.args.get('cursor'))
+        except ValueError as e:
+            return jsonify({"error": str(e), "history": []}), 400
         
         return jsonify({
-            "history": history
+            "history": history,
+            "next_cursor": next_cursor
         })
         
-    except Exception as e:
-        print(f"Error in get_history: {str(e)}")
+    except Exception:
+        log.exception("Error in get_history")
         return jsonify({
             "error": "Internal server error",
             "history": []
@@ -890,36 +1969,20 @@ def get_history():
 @app.route('/get_movie_details/<movie_id>', methods=['GET'])
 def get_movie_details(movie_id):
     """Get detailed information about a specific movie"""
-    try:
-        # Search for the movie in all genres
-        for genre in FREE_MOVIES:
-            for movie in FREE_MOVIES[genre]:
-                if movie["id"] == movie_id:
-                    return jsonify({
-                        "movie": movie,
-                        "genre": genre,
-                        "status": "success"
-                    })
-        
-        # Movie not found
+    details = catalog.details.get(movie_id)
+    if details is None:
         return jsonify({
             "error": "Movie not found",
             "status": "error"
         }), 404
-        
-    except Exception as e:
-        print(f"Error getting movie details: {str(e)}")
-        return jsonify({
-            "error": "Failed to get movie details",
-            "status": "error"
-        }), 500
+
+    body, etag = details
+    return cacheable_json_response(body, etag, 'public, max-age=3600')
 
 @app.route('/test_gemini', methods=['POST'])
 def test_gemini():
     """Test endpoint to verify Gemini API is working"""
     try:
-        print("=== TESTING GEMINI API DIRECTLY ===")
-        
         # Create a simple test transcript
         test_transcript_chunks = [
             {
@@ -939,13 +2002,9 @@ def test_gemini():
             }
         ]
         
-        print(f"Test transcript created with {len(test_transcript_chunks)} chunks")
-        
         # Call Gemini API with test data
         response = get_gemini_response(test_transcript_chunks, 1.0)
         
-        print(f"Test response received, type: {type(response)}")
-        
         if isinstance(response, dict) and 'error' in response:
             return jsonify({
                 "success": False,
@@ -960,7 +2019,7 @@ def test_gemini():
         })
         
     except Exception as e:
-        print(f"Error in test_gemini: {str(e)}")
+        log.exception("Error in test_gemini")
         return jsonify({
             "success": False,
             "error": str(e),
@@ -993,19 +2052,13 @@ def get_characters():
         if not video_id:
             return jsonify({"error": "video_id is required"}), 400
         
-        conn = sqlite3.connect("cache.db")
-        cursor = conn.cursor()
-        
-        cursor.execute("""
+        characters = query_all("""
             SELECT character_name, character_role, character_description, importance_level
             FROM video_characters
             WHERE video_id = ?
             ORDER BY importance_level ASC, character_name ASC
         """, (video_id,))
         
-        characters = cursor.fetchall()
-        conn.close()
-        
         character_list = []
         for row in characters:
             character_list.append({
@@ -1021,7 +2074,7 @@ def get_characters():
         })
     
     except Exception as e:
-        print(f"Error in get_characters: {str(e)}")
+        log.exception("Error in get_characters")
         return jsonify({
             "success": False,
             "error": str(e),
@@ -1041,31 +2094,18 @@ def what_happened():
         
         if not video_id or timestamp is None:
             return jsonify({"error": "video_id and timestamp are required"}), 400
+        if not isinstance(timestamp, (int, float)):
+            return jsonify({"error": "timestamp must be a number"}), 400
         
-        print(f"Looking for 'what happened' at timestamp {timestamp} for video {video_id}")
+        annotate(video_id=video_id)
         
         # Find the scene that contains this timestamp
-        conn = sqlite3.connect("cache.db")
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT scene_start, scene_end, scene_title, what_happened
-            FROM video_scenes
-            WHERE video_id = ? AND scene_start <= ? AND scene_end > ?
-            ORDER BY scene_start
-            LIMIT 1
-        """, (video_id, timestamp, timestamp))
-        
-        scene = cursor.fetchone()
-        conn.close()
+        scene = scene_index.lookup(video_id, timestamp)
         
         if scene:
             return jsonify({
                 "success": True,
-                "scene_start": scene[0],
-                "scene_end": scene[1],
-                "scene_title": scene[2],
-                "what_happened": scene[3],
+                **scene,
                 "timestamp": timestamp
             })
         else:
@@ -1078,12 +2118,47 @@ def what_happened():
             })
     
     except Exception as e:
-        print(f"Error in what_happened: {str(e)}")
+        log.exception("Error in what_happened")
         return jsonify({
             "success": False,
             "error": str(e),
             "what_happened": "Unable to retrieve scene information at this time."
         })
 
+@app.route('/what_happened_batch', methods=['POST'])
+def what_happened_batch():
+    """Get 'what just happened' answers for many timestamps at once, for prefetching"""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({"error": "Invalid JSON data"}), 400
+        
+        video_id = data.get('video_id')
+        timestamps = data.get('timestamps')
+        
+        if not video_id or not isinstance(timestamps, list):
+            return jsonify({"error": "video_id and a timestamps list are required"}), 400
+        if len(timestamps) > 1000:
+            return jsonify({"error": "At most 1000 timestamps per request"}), 400
+        if not all(isinstance(t, (int, float)) for t in timestamps):
+            return jsonify({"error": "timestamps must be numbers"}), 400
+        
+        scenes = scene_index.lookup_many(video_id, timestamps)
+        return jsonify({
+            "success": True,
+            "results": [
+                {"timestamp": timestamp, **scene} if scene else {"timestamp": timestamp}
+                for timestamp, scene in zip(timestamps, scenes)
+            ]
+        })
+    
+    except Exception as e:
+        log.exception("Error in what_happened_batch")
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "results": []
+        })
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
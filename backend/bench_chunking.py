@@ -0,0 +1,103 @@
+"""Benchmark transcript chunking on large synthetic transcripts.
+
+Usage:
+    python bench_chunking.py
+    python bench_chunking.py --sizes 1000 20000 50000 --repeat 5
+
+Compares the original list-of-dicts chunker with the array-backed
+Transcript chunker, with and without NumPy.
+"""
+import argparse
+import random
+import time
+
+import transcript as transcript_module
+from transcript import Transcript
+
+
+def legacy_chunk_transcript(transcript, chunk_duration=150):
+    """The pre-Transcript chunker, kept here as the benchmark baseline"""
+    chunks = []
+    current_chunk = []
+    current_duration = 0
+    current_start = 0
+    for entry in transcript:
+        duration = entry['duration']
+        if current_duration + duration <= chunk_duration:
+            current_chunk.append(entry)
+            current_duration += duration
+        else:
+            chunks.append({
+                'start': current_start,
+                'end': current_start + current_duration,
+                'text': ' '.join([e['text'] for e in current_chunk])
+            })
+            current_chunk = [entry]
+            current_start += current_duration
+            current_duration = duration
+    if current_chunk:
+        chunks.append({
+            'start': current_start,
+            'end': current_start + current_duration,
+            'text': ' '.join([e['text'] for e in current_chunk])
+        })
+    return chunks
+
+
+WORDS = "the a we you it what right okay so then look over there come on now wait listen".split()
+
+
+def synthetic_entries(count, seed=0):
+    """YouTubeTranscriptApi-style entries with small gaps between captions"""
+    rng = random.Random(seed)
+    entries = []
+    start = 0.0
+    for _ in range(count):
+        duration = rng.uniform(1.0, 5.0)
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        entries.append({"text": text, "start": round(start, 3), "duration": round(duration, 3)})
+        start += duration + rng.uniform(0.0, 1.5)
+    return entries
+
+
+def best_of(repeat, fn):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark transcript chunking")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 20000, 50000], help="entry counts to test")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case; the best time is reported")
+    parser.add_argument("--chunk-duration", type=int, default=150)
+    args = parser.parse_args(argv)
+
+    numpy = transcript_module.np
+    backends = [("numpy", numpy), ("array", None)] if numpy is not None else [("array", None)]
+
+    print(f"{'entries':>8}  {'case':<24}{'best ms':>10}{'chunks':>8}")
+    for size in args.sizes:
+        entries = synthetic_entries(size)
+        legacy_time, legacy_chunks = best_of(args.repeat, lambda: legacy_chunk_transcript(entries, args.chunk_duration))
+        print(f"{size:>8}  {'legacy dicts':<24}{legacy_time * 1000:>10.2f}{len(legacy_chunks):>8}")
+        for name, backend in backends:
+            transcript_module.np = backend
+            try:
+                build_time, transcript = best_of(args.repeat, lambda: Transcript.from_entries(entries))
+                time_time, time_chunks = best_of(args.repeat, lambda: transcript.chunk_by_time(args.chunk_duration))
+                token_time, token_chunks = best_of(args.repeat, lambda: transcript.chunk_by_tokens())
+            finally:
+                transcript_module.np = numpy
+            print(f"{'':>8}  {name + ' build':<24}{build_time * 1000:>10.2f}{'':>8}")
+            print(f"{'':>8}  {name + ' chunk_by_time':<24}{time_time * 1000:>10.2f}{len(time_chunks):>8}")
+            print(f"{'':>8}  {name + ' chunk_by_tokens':<24}{token_time * 1000:>10.2f}{len(token_chunks):>8}")
+            print(f"{'':>8}  {'speedup (chunk only)':<24}{legacy_time / time_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
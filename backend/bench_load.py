@@ -0,0 +1,470 @@
+"""End-to-end load test of the backend against local stand-ins for its upstreams.
+
+Usage:
+    python bench_load.py
+    python bench_load.py --duration 60 --concurrency 32 --mix miss=1,hit=4,what_happened=10,history=3
+    python bench_load.py --workers 4 --gemini-latency-ms 1500 --gemini-error-rate 0.05 --output run.json
+    python bench_load.py --compare baseline.json --output run.json
+
+One stub server stands in for Gemini generateContent, transcript fetching
+(via TRANSCRIPT_SOURCE_URL) and YouTube oEmbed/watch pages, each with its
+own latency and error rate. The app is started in a subprocess against
+the stub with a fresh database: the Flask server for --workers 1,
+gunicorn otherwise. --warm videos are analyzed first so cache hits and
+/what_happened lookups have something to find.
+
+The load phase runs --concurrency client threads for --duration seconds,
+each picking operations by the --mix weights:
+    miss           POST /process_video for a video never seen before
+    hit            POST /process_video for a warmed video
+    what_happened  POST /what_happened at a random time in a warmed video
+    history        GET /get_history for one of --users users
+
+Results (req/s, p50/p95/p99 per operation, and the server's DB lock wait
+and stage times from /metrics) are printed and, with --output, saved as
+JSON. --compare marks operations whose throughput dropped or p95 rose by
+more than --threshold against an earlier result file, and exits 1 if any
+did.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+from bench_titles import QuietServer, synthetic_page
+
+
+OPERATIONS = ("miss", "hit", "what_happened", "history")
+SCENE_RANGE_RE = re.compile(r'"start":\s*([\d.]+),\s*"end":\s*([\d.]+)')
+
+
+class Upstream:
+    """Latency and error injection settings for one stubbed service"""
+
+    def __init__(self, latency_ms, jitter, error_rate, error_status):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Sleep for one call's latency; returns the error status to send, or None"""
+        if self.latency > 0:
+            time.sleep(max(0.0, random.uniform(self.latency * (1 - self.jitter), self.latency * (1 + self.jitter))))
+        failed = random.random() < self.error_rate
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+        return self.error_status if failed else None
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "errors": self.errors}
+
+
+def transcript_entries(seconds, entry_seconds=5):
+    line = "and then the detective walks into the room and asks who left the door open last night"
+    return [{"text": f"{line} ({start})", "start": float(start), "duration": float(entry_seconds)}
+            for start in range(0, seconds, entry_seconds)]
+
+
+def fake_analysis(prompt):
+    """A well-formed analysis covering the scene ranges listed in the prompt"""
+    scenes = [{
+        "scene_start": float(start),
+        "scene_end": float(end),
+        "scene_title": f"Scene {i + 1}",
+        "what_happened": f"Things happen between {start} and {end} seconds."
+    } for i, (start, end) in enumerate(SCENE_RANGE_RE.findall(prompt))]
+    return {
+        "briefing": "A detective story about an open door.",
+        "characters": [{"name": "Detective", "description": "Asks questions", "importance": 1}],
+        "theme_alerts": [],
+        "recaps": [{"timestamp_start": scene["scene_start"], "timestamp_end": scene["scene_end"],
+                    "summary": "The story so far."} for scene in scenes[:1]],
+        "scenes": scenes,
+        "rating": "PG",
+        "complexity": "low"
+    }
+
+
+def make_handler(gemini, transcripts, youtube, transcript_body):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not self.path.startswith("/gemini"):
+                return self._send(404, b"")
+            error = gemini.delay()
+            if error:
+                return self._send(error, json.dumps({"error": {"code": error, "message": "injected"}}).encode())
+            request = json.loads(body)
+            prompt = request["contents"][0]["parts"][0]["text"]
+            json_mode = request.get("generationConfig", {}).get("responseMimeType") == "application/json"
+            if "Respond with the overview text only" in prompt:
+                text = "An overview of the whole video."
+            elif json_mode:
+                text = json.dumps(fake_analysis(prompt))
+            else:
+                text = "```json\n" + json.dumps(fake_analysis(prompt)) + "\n```"
+            # Roughly four characters per token, like the real tokenizer on English
+            usage = {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(text) // 4}
+            usage["totalTokenCount"] = usage["promptTokenCount"] + usage["candidatesTokenCount"]
+            reply = {"candidates": [{"content": {"parts": [{"text": text}]}}], "usageMetadata": usage}
+            self._send(200, json.dumps(reply).encode())
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            query = parse_qs(parsed.query)
+            if parsed.path.startswith("/transcripts/"):
+                error = transcripts.delay()
+                self._send(error or 200, b"" if error else transcript_body)
+            elif parsed.path == "/oembed":
+                error = youtube.delay()
+                video_id = parse_qs(urlparse(query.get("url", [""])[0]).query).get("v", [""])[0]
+                self._send(error or 200, b"" if error else json.dumps({"title": f"Bench video {video_id}"}).encode())
+            elif parsed.path == "/watch":
+                error = youtube.delay()
+                page = b"" if error else synthetic_page(query.get("v", [""])[0], size=64 * 1024)
+                self._send(error or 200, page, "text/html; charset=utf-8")
+            else:
+                self._send(404, b"")
+
+    return StubHandler
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(args, stub_base, workdir):
+    port = free_port()
+    env = dict(
+        os.environ,
+        CACHE_DB_PATH=os.path.join(workdir, "bench.db"),
+        METRICS_DIR=os.path.join(workdir, "metrics"),
+        GEMINI_API_KEY="bench",
+        GEMINI_API_URL=stub_base + "/gemini/models/bench:generateContent",
+        TRANSCRIPT_SOURCE_URL=stub_base + "/transcripts/{video_id}",
+        YOUTUBE_OEMBED_URL=stub_base + "/oembed?url={watch_url}",
+        YOUTUBE_WATCH_URL=stub_base + "/watch?v={video_id}",
+        GEMINI_RPM="1000000",
+        GEMINI_TPM="1000000000",
+        PROFILE_SAMPLE_RATE="0",
+        LOG_LEVEL=args.log_level
+    )
+    here = os.path.dirname(os.path.abspath(__file__))
+    if args.workers > 1:
+        if shutil.which("gunicorn") is None:
+            raise SystemExit("--workers > 1 needs gunicorn on PATH")
+        command = ["gunicorn", "--workers", str(args.workers), "--threads", str(args.threads),
+                   "--bind", f"127.0.0.1:{port}", "app:app"]
+    else:
+        command = [sys.executable, "-c",
+                   f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log_file = open(os.path.join(workdir, "server.log"), "w")
+    process = subprocess.Popen(command, cwd=here, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited with {process.returncode}; see {log_file.name}")
+        try:
+            if requests.get(base + "/metrics", timeout=1).status_code == 200:
+                return process, base
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("Server did not come up within 60s")
+
+
+def parse_metrics(text):
+    """``{(name, frozenset(labels)): value}`` from Prometheus text output"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name_labels, value = line.rsplit(" ", 1)
+        name, _, labels = name_labels.partition("{")
+        pairs = frozenset(re.findall(r'(\w+)="([^"]*)"', labels))
+        samples[(name, pairs)] = float(value.replace("+Inf", "inf"))
+    return samples
+
+
+def scrape(base):
+    return parse_metrics(requests.get(base + "/metrics", timeout=10).text)
+
+
+def stage_totals(before, after):
+    """Per-stage count, total and mean milliseconds between two scrapes"""
+    stages = {}
+    for (name, labels), value in after.items():
+        if name not in ("klarity_stage_duration_seconds_sum", "klarity_stage_duration_seconds_count"):
+            continue
+        stage = dict(labels)["stage"]
+        delta = value - before.get((name, labels), 0.0)
+        entry = stages.setdefault(stage, {"count": 0, "total_ms": 0.0})
+        if name.endswith("_count"):
+            entry["count"] = int(delta)
+        else:
+            entry["total_ms"] = round(delta * 1000, 1)
+    for entry in stages.values():
+        entry["mean_ms"] = round(entry["total_ms"] / entry["count"], 2) if entry["count"] else 0.0
+    return stages
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class LoadClient:
+    def __init__(self, base, warm_ids, users, transcript_seconds):
+        self.base = base
+        self.warm_ids = warm_ids
+        self.users = users
+        self.transcript_seconds = transcript_seconds
+        self._miss_counter = 0
+        self._lock = threading.Lock()
+
+    def _new_video_id(self):
+        with self._lock:
+            self._miss_counter += 1
+            return f"m{os.getpid() % 1000:03d}{self._miss_counter:07d}"
+
+    def request(self, session, operation):
+        user_id = f"bench_user_{random.randrange(self.users)}"
+        if operation == "miss":
+            video_id = self._new_video_id()
+            return session.post(self.base + "/process_video",
+                                json={"youtube_url": f"https://youtu.be/{video_id}", "user_id": user_id}, timeout=120)
+        if operation == "hit":
+            video_id = random.choice(self.warm_ids)
+            return session.post(self.base + "/process_video",
+                                json={"youtube_url": f"https://youtu.be/{video_id}", "user_id": user_id}, timeout=120)
+        if operation == "what_happened":
+            return session.post(self.base + "/what_happened",
+                                json={"video_id": random.choice(self.warm_ids),
+                                      "timestamp": random.uniform(0, self.transcript_seconds)}, timeout=30)
+        return session.get(self.base + "/get_history", params={"user_id": user_id}, timeout=30)
+
+
+def run_load(client, mix, concurrency, duration):
+    operations = [op for op in OPERATIONS if mix.get(op)]
+    weights = [mix[op] for op in operations]
+    results = {op: {"latencies": [], "statuses": {}} for op in operations}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker():
+        session = requests.Session()
+        local = {op: ([], {}) for op in operations}
+        while time.monotonic() < deadline:
+            operation = random.choices(operations, weights)[0]
+            started = time.perf_counter()
+            try:
+                status = str(client.request(session, operation).status_code)
+            except requests.exceptions.RequestException as e:
+                status = type(e).__name__
+            latencies, statuses = local[operation]
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+        with lock:
+            for op, (latencies, statuses) in local.items():
+                results[op]["latencies"].extend(latencies)
+                for status, count in statuses.items():
+                    results[op]["statuses"][status] = results[op]["statuses"].get(status, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    summary = {}
+    total = 0
+    for op, data in results.items():
+        latencies = sorted(data["latencies"])
+        errors = sum(count for status, count in data["statuses"].items() if not status.startswith(("2", "3")))
+        total += len(latencies)
+        summary[op] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "req_per_s": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+            "statuses": data["statuses"]
+        }
+    return summary, round(total / elapsed, 2)
+
+
+def compare(current, baseline, threshold):
+    """Operations that got slower or lost throughput by more than ``threshold``"""
+    regressions = []
+    for op, now in current["operations"].items():
+        before = baseline.get("operations", {}).get(op)
+        if not before:
+            continue
+        if before["req_per_s"] and now["req_per_s"] < before["req_per_s"] * (1 - threshold):
+            regressions.append(f"{op}: req/s {before['req_per_s']} -> {now['req_per_s']}")
+        if before["p95_ms"] and now["p95_ms"] and now["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append(f"{op}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}; expected one of {', '.join(OPERATIONS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the backend against local stub upstreams")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=16, help="client threads")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("miss=1,hit=4,what_happened=10,history=3"),
+                        help="operation weights, e.g. miss=1,hit=4,what_happened=10,history=3")
+    parser.add_argument("--warm", type=int, default=20, help="videos analyzed before the load phase")
+    parser.add_argument("--users", type=int, default=50, help="distinct user ids")
+    parser.add_argument("--transcript-seconds", type=int, default=1200, help="length of stub transcripts")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers (1 runs the Flask server)")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--gemini-latency-ms", type=float, default=500)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--transcript-latency-ms", type=float, default=100)
+    parser.add_argument("--transcript-error-rate", type=float, default=0.0)
+    parser.add_argument("--youtube-latency-ms", type=float, default=50)
+    parser.add_argument("--youtube-error-rate", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency varies by +/- this fraction")
+    parser.add_argument("--log-level", default="WARNING", help="server LOG_LEVEL")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="earlier results JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed relative regression for --compare")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary database and server log")
+    args = parser.parse_args(argv)
+
+    gemini = Upstream(args.gemini_latency_ms, args.jitter, args.gemini_error_rate, 503)
+    transcripts = Upstream(args.transcript_latency_ms, args.jitter, args.transcript_error_rate, 500)
+    youtube = Upstream(args.youtube_latency_ms, args.jitter, args.youtube_error_rate, 500)
+    transcript_body = json.dumps(transcript_entries(args.transcript_seconds)).encode()
+    stub = QuietServer(("127.0.0.1", 0), make_handler(gemini, transcripts, youtube, transcript_body))
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_base = f"http://127.0.0.1:{stub.server_address[1]}"
+
+    workdir = tempfile.mkdtemp(prefix="klarity-bench-")
+    process = None
+    try:
+        process, base = start_app(args, stub_base, workdir)
+        client = LoadClient(base, [f"w{i:010d}" for i in range(args.warm)], args.users, args.transcript_seconds)
+
+        def warm(video_id):
+            requests.post(base + "/process_video", json={"youtube_url": f"https://youtu.be/{video_id}"}, timeout=300)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(warm, client.warm_ids))
+        # Let background title lookups and buffered writes settle first
+        time.sleep(1.0)
+
+        before = scrape(base)
+        results, elapsed = run_load(client, args.mix, args.concurrency, args.duration)
+        time.sleep(1.5)
+        after = scrape(base)
+
+        operations, total_rps = summarize(results, elapsed)
+        stages = stage_totals(before, after)
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "keep")},
+            "elapsed_s": round(elapsed, 2),
+            "req_per_s": total_rps,
+            "operations": operations,
+            "db_lock_wait": stages.get("db_lock_wait", {"count": 0, "total_ms": 0.0, "mean_ms": 0.0}),
+            "stages": stages,
+            "upstream_calls": {"gemini": gemini.stats(), "transcripts": transcripts.stats(), "youtube": youtube.stats()}
+        }
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        stub.shutdown()
+        if args.keep:
+            print(f"Kept {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'operation':<16}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for op, row in operations.items():
+        print(f"{op:<16}{row['requests']:>9}{row['errors']:>8}{row['req_per_s']:>9}"
+              f"{row['p50_ms'] or 0:>10}{row['p95_ms'] or 0:>10}{row['p99_ms'] or 0:>10}")
+    lock = report["db_lock_wait"]
+    print(f"total {total_rps} req/s; DB lock wait {lock['total_ms']}ms over {lock['count']} transactions "
+          f"(mean {lock['mean_ms']}ms)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
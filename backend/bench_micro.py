@@ -0,0 +1,219 @@
+"""Micro-benchmarks for the pure helpers that run on every request.
+
+Usage:
+    python bench_micro.py
+    python bench_micro.py --filter chunk_transcript --repeat 7
+    python bench_micro.py --save-baseline
+    python bench_micro.py --baseline bench_micro_baseline.json --threshold 0.2
+
+Runs offline: the app is imported against a throwaway database and no
+network calls are made. Each benchmark reports the best ops/s over
+--repeat timed batches and the peak memory traced by tracemalloc during
+one call.
+
+With a baseline file (written by --save-baseline on the machine that
+runs the check), a benchmark fails if its ops/s drops or its peak
+allocation grows by more than --threshold. The script exits 1 on any
+failure, and 2 if the baseline file is missing (unless --save-baseline
+is creating it). Baselines are machine-specific, so save one per CI
+runner rather than committing a developer laptop's numbers.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+URL_SHAPES = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "https://www.youtube.com/embed/dQw4w9WgXcQ",
+    "youtube.com/watch?v=dQw4w9WgXcQ",
+    "www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "http://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=10s&list=PL1234567890",
+    "https://vimeo.com/123456"
+]
+TRANSCRIPT_SIZES = (1000, 10000, 50000)
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_micro_baseline.json")
+
+
+def import_app():
+    """Import app.py with a scratch database so benchmarks never touch cache.db"""
+    os.environ["CACHE_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="klarity-micro-"), "bench.db")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import app
+    return app
+
+
+def synthetic_entries(count, seed=1):
+    rng = random.Random(seed)
+    entries = []
+    start = 0.0
+    for i in range(count):
+        duration = rng.uniform(1.5, 6.0)
+        entries.append({"text": f"line {i} of the transcript with a few more words", "start": start, "duration": duration})
+        start += duration + rng.uniform(0, 0.5)
+    return entries
+
+
+def sample_analysis(scene_count=12):
+    return {
+        "briefing": "A detective investigates a series of open doors in a quiet town. " * 3,
+        "characters": [{"name": f"Character {i}", "description": "Does things for reasons " * 4, "importance": i % 5 + 1}
+                       for i in range(6)],
+        "theme_alerts": [{"timestamp": i * 90, "theme": "tension", "description": "Something looms " * 3}
+                         for i in range(5)],
+        "recaps": [{"timestamp_start": i * 300, "timestamp_end": i * 300 + 300, "summary": "Recap text " * 12}
+                   for i in range(6)],
+        "scenes": [{"scene_start": i * 60, "scene_end": i * 60 + 60, "scene_title": f"Scene {i + 1}",
+                    "what_happened": "Events unfold " * 10} for i in range(scene_count)]
+    }
+
+
+def build_benchmarks(app):
+    """``{name: zero-argument callable doing one operation}``"""
+    from compression import EncodedBody
+    from transcript import Transcript
+
+    benchmarks = {}
+
+    def video_ids():
+        for url in URL_SHAPES:
+            app.get_video_id(url)
+    benchmarks["get_video_id/mixed_x9"] = video_ids
+
+    for size in TRANSCRIPT_SIZES:
+        transcript = Transcript.from_entries(synthetic_entries(size))
+        benchmarks[f"chunk_transcript/{size}"] = lambda t=transcript: app.chunk_transcript(t)
+
+    for size in TRANSCRIPT_SIZES[:2]:
+        chunks = app.chunk_transcript(Transcript.from_entries(synthetic_entries(size)))
+        benchmarks[f"build_video_prompt/{size}"] = lambda c=chunks: app.build_video_prompt(c)
+
+    analysis = sample_analysis()
+    row = app.encode_analysis_row("dQw4w9WgXcQ", analysis)
+    scenes = analysis["scenes"]
+    benchmarks["video_cache_row/encode"] = lambda: app.encode_analysis_row("dQw4w9WgXcQ", analysis)
+    benchmarks["video_cache_row/decode"] = lambda: app.decode_analysis_row(row[1:], scenes)
+    benchmarks["analysis_response/encode"] = lambda: EncodedBody(json.dumps(app.decode_analysis_row(row[1:], scenes)).encode())
+
+    movie_ids = list(app.catalog.index) + ["missing_001"]
+
+    def catalog_lookups():
+        for movie_id in movie_ids:
+            app.catalog.get(movie_id)
+            app.catalog.title(movie_id)
+    benchmarks[f"catalog/lookup_x{len(movie_ids)}"] = catalog_lookups
+    benchmarks["catalog/recommendations"] = lambda: app.catalog.recommendations(2.5)
+    return benchmarks
+
+
+def time_benchmark(fn, repeat, min_batch_time):
+    """Best ops/s over ``repeat`` batches, each sized to run at least ``min_batch_time``"""
+    fn()
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_batch_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_batch_time / elapsed) + 1))
+    best = number / elapsed
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = max(best, number / (time.perf_counter() - started))
+    return best
+
+
+def peak_allocation(fn):
+    """Peak bytes traced by tracemalloc while making one call"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        fn()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def check(results, baseline, threshold):
+    """Benchmarks that regressed beyond ``threshold`` against ``baseline``"""
+    failures = []
+    for name, result in results.items():
+        before = baseline.get("benchmarks", {}).get(name)
+        if not before:
+            continue
+        if result["ops_per_s"] < before["ops_per_s"] * (1 - threshold):
+            failures.append(f"{name}: {before['ops_per_s']:.0f} -> {result['ops_per_s']:.0f} ops/s")
+        # Ignore growth of a few hundred bytes; tracemalloc's own bookkeeping moves that much
+        if result["peak_bytes"] > before["peak_bytes"] * (1 + threshold) + 512:
+            failures.append(f"{name}: peak {before['peak_bytes']} -> {result['peak_bytes']} bytes")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark the per-request helpers")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="timed batches per benchmark")
+    parser.add_argument("--min-batch-time", type=float, default=0.1, help="seconds per timed batch")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline results to check against")
+    parser.add_argument("--save-baseline", action="store_true", help="write these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--output", help="also write results JSON here")
+    args = parser.parse_args(argv)
+
+    app = import_app()
+    benchmarks = build_benchmarks(app)
+    if args.filter:
+        benchmarks = {name: fn for name, fn in benchmarks.items() if args.filter in name}
+
+    results = {}
+    print(f"{'benchmark':<32}{'ops/s':>14}{'us/op':>11}{'peak KiB':>11}")
+    for name, fn in benchmarks.items():
+        ops = time_benchmark(fn, args.repeat, args.min_batch_time)
+        peak = peak_allocation(fn)
+        results[name] = {"ops_per_s": round(ops, 1), "peak_bytes": peak}
+        print(f"{name:<32}{ops:>14,.0f}{1e6 / ops:>11.2f}{peak / 1024:>11.1f}")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        # A check that silently passes is worse than none; make the missing file visible
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one", file=sys.stderr)
+        sys.exit(2)
+    with open(args.baseline) as f:
+        failures = check(results, json.load(f), args.threshold)
+    for line in failures:
+        print("REGRESSION " + line)
+    if failures:
+        sys.exit(1)
+    print(f"All benchmarks within {args.threshold:.0%} of {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Benchmark title resolution against a local stub of YouTube.
+
+Usage:
+    python bench_titles.py
+    python bench_titles.py --pages-dir recorded/ --rounds 20
+
+The stub serves /watch?v=<id> from <id>.html files in --pages-dir
+(recorded watch pages), or from synthetic ~1 MB pages when no directory
+is given, and /oembed with a small JSON body. It compares the old
+full-page download + regex against the streaming TitleFetcher, with
+and without oEmbed.
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from http_client import HttpClient
+from youtube_title import TitleFetcher, USER_AGENT
+
+
+def synthetic_page(video_id, size=1024 * 1024):
+    head = (f'<!DOCTYPE html><html><head><meta charset="utf-8">'
+            f'<title>Recorded video {video_id} - YouTube</title></head><body>').encode()
+    filler = b'<script>var ytcfg = {"k": "' + b"x" * 2048 + b'"};</script>\n'
+    player = f'<script>var ytInitialPlayerResponse = {{"videoDetails":{{"title":"Recorded video {video_id}"}}}};</script>'.encode()
+    body = head + filler * max(0, (size - len(head)) // len(filler)) + player
+    return body + b"</body></html>"
+
+
+def make_handler(pages, oembed_enabled):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            for i in range(0, len(body), 64 * 1024):
+                self.wfile.write(body[i:i + 64 * 1024])
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            query = parse_qs(parsed.query)
+            if parsed.path == "/watch":
+                page = pages(query.get("v", [""])[0])
+                self._send(200 if page else 404, page or b"", "text/html; charset=utf-8")
+            elif parsed.path == "/oembed" and oembed_enabled:
+                video_id = parse_qs(urlparse(query.get("url", [""])[0]).query).get("v", [""])[0]
+                body = json.dumps({"title": f"Recorded video {video_id}", "type": "video"}).encode()
+                self._send(200, body, "application/json")
+            else:
+                self._send(404, b"", "text/plain")
+
+    return StubHandler
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Streaming clients hang up once they have the title
+        pass
+
+
+def start_stub(pages, oembed_enabled):
+    server = QuietServer(("127.0.0.1", 0), make_handler(pages, oembed_enabled))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def legacy_fetch(client, url):
+    """The pre-streaming lookup: download the whole page, then regex it"""
+    response = client.get(url, headers={"User-Agent": USER_AGENT}, timeout=10)
+    match = re.search(r'"title":"([^"]+)"', response.text)
+    if match:
+        title = match.group(1).encode().decode('unicode_escape')
+    else:
+        match = re.search(r'<title>([^<]+)</title>', response.text)
+        title = match.group(1).replace(" - YouTube", "").strip() if match else None
+    return title, len(response.content)
+
+
+def run_case(name, fetch, video_ids, rounds):
+    started = time.perf_counter()
+    total_bytes = 0
+    found = 0
+    for _ in range(rounds):
+        for video_id in video_ids:
+            title, bytes_read = fetch(video_id)
+            total_bytes += bytes_read
+            found += 1 if title else 0
+    lookups = rounds * len(video_ids)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<28}{elapsed / lookups * 1000:>10.2f}{total_bytes // lookups:>14}{found:>7}/{lookups}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark YouTube title resolution against a local stub")
+    parser.add_argument("--pages-dir", help="directory of recorded <video_id>.html watch pages")
+    parser.add_argument("--rounds", type=int, default=10, help="passes over the video ids")
+    args = parser.parse_args(argv)
+
+    if args.pages_dir:
+        video_ids = sorted(f[:-5] for f in os.listdir(args.pages_dir) if f.endswith(".html"))
+        recorded = {}
+        for video_id in video_ids:
+            with open(os.path.join(args.pages_dir, video_id + ".html"), "rb") as f:
+                recorded[video_id] = f.read()
+        pages = recorded.get
+    else:
+        video_ids = [f"video{i:03d}" for i in range(5)]
+        cache = {video_id: synthetic_page(video_id) for video_id in video_ids}
+        pages = cache.get
+
+    with_oembed = start_stub(pages, oembed_enabled=True)
+    without_oembed = start_stub(pages, oembed_enabled=False)
+    try:
+        client = HttpClient()
+        base = f"http://127.0.0.1:{without_oembed.server_address[1]}"
+        watch_url = base + "/watch?v={video_id}"
+        streaming = TitleFetcher(client=client, oembed_url=base + "/oembed?url={watch_url}", watch_url=watch_url)
+        oembed_base = f"http://127.0.0.1:{with_oembed.server_address[1]}"
+        oembed = TitleFetcher(client=client, oembed_url=oembed_base + "/oembed?url={watch_url}",
+                              watch_url=oembed_base + "/watch?v={video_id}")
+
+        print(f"{'case':<28}{'ms/lookup':>10}{'bytes/lookup':>14}{'found':>7}")
+        run_case("legacy full page", lambda v: legacy_fetch(client, watch_url.format(video_id=v)), video_ids, args.rounds)
+        run_case("streaming watch page", lambda v: streaming.fetch(v)[::2], video_ids, args.rounds)
+        run_case("oembed", lambda v: oembed.fetch(v)[::2], video_ids, args.rounds)
+    finally:
+        with_oembed.shutdown()
+        without_oembed.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import hashlib
+import json
+
+
+def to_json_bytes(data):
+    return json.dumps(data, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+
+def strong_etag(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+class Catalog:
+    """Static movie catalog compiled once into lookup tables and response bodies.
+
+    ``movies_by_genre`` is the FREE_MOVIES dict. Lookups by id are a dict
+    hit, and every /get_movie_details body and every per-complexity
+    /get_recommendations body (minus the user's score) is serialized and
+    hashed up front, so requests only splice bytes and tags together.
+    """
+
+    def __init__(self, movies_by_genre):
+        self.movies_by_genre = movies_by_genre
+        self.index = {}
+        for genre, movies in movies_by_genre.items():
+            for movie in movies:
+                self.index.setdefault(movie["id"], (movie, genre))
+
+        self.details = {}
+        for movie_id, (movie, genre) in self.index.items():
+            body = to_json_bytes({"genre": genre, "movie": movie, "status": "success"})
+            self.details[movie_id] = (body, strong_etag(body))
+
+        # Levels are positions in the first genre's list (action), as they always have been
+        self.complexity_levels = len(next(iter(movies_by_genre.values())))
+        self._recommendations = []
+        for level in range(self.complexity_levels):
+            tail = self._recommendations_tail(level)
+            self._recommendations.append((tail, strong_etag(tail)))
+
+    def get(self, movie_id):
+        """Return ``(movie, genre)`` or None"""
+        return self.index.get(movie_id)
+
+    def title(self, movie_id):
+        entry = self.index.get(movie_id)
+        return entry[0]["title"] if entry else None
+
+    def _recommendations_tail(self, level):
+        """Serialized "genres" and "recommendations" members for one complexity level"""
+        # Higher complexity = more complex movies (later in the list). If any
+        # genre is too short for the level, every genre gets its first movie.
+        if any(level >= len(movies) for movies in self.movies_by_genre.values()):
+            level = 0
+        recommendations = {}
+        genres = {}
+        for genre, movies in self.movies_by_genre.items():
+            recommended = movies[level]
+            recommendations[genre] = recommended
+            # Browse rows hold every other movie in the genre
+            others = [m for m in movies if m["id"] != recommended["id"]]
+            genres[genre] = others if others else movies[1:]
+        body = to_json_bytes({"genres": genres, "recommendations": recommendations})
+        return body[1:]
+
+    def recommendations(self, complexity_score):
+        """``(body, etag)`` of the /get_recommendations response for a score"""
+        level = max(0, min(int(complexity_score) - 1, self.complexity_levels - 1))
+        tail, tail_etag = self._recommendations[level]
+        score = to_json_bytes(complexity_score)
+        # The score is the only part not covered by the precomputed tag
+        return b'{"complexity_score":' + score + b"," + tail, f"{tail_etag}-{score.decode('ascii')}"
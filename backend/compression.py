@@ -0,0 +1,80 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from catalog import strong_etag
+
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Below this, compression costs more than it saves
+MIN_COMPRESS_BYTES = 1024
+
+
+def available_encodings():
+    """Content codings we can produce, most preferred first"""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def compress(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    raise ValueError(f"Unsupported content coding: {encoding}")
+
+
+def negotiate_encoding(accept_encodings):
+    """Pick a coding from a werkzeug Accept-Encoding header; None means send it uncompressed"""
+    best, best_quality = None, 0
+    for encoding in available_encodings():
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def etag_matches(if_none_match, base_etag):
+    """True if an If-None-Match header names any representation of ``base_etag``"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag.split("-", 1)[0] == base_etag:
+            return True
+    return False
+
+
+class EncodedBody:
+    """A response body stored together with its compressed forms.
+
+    Every coding is produced once, when the body is created, so a cached
+    body is never recompressed on later hits. ETags are strong and
+    distinct per coding: ``<sha1>``, ``<sha1>-gzip`` and ``<sha1>-br``.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = strong_etag(body)
+        self.encoded = {}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            for encoding in available_encodings():
+                self.encoded[encoding] = compress(body, encoding)
+
+    def get(self, encoding):
+        """Return ``(bytes, etag, encoding)``, falling back to identity if ``encoding`` isn't stored"""
+        encoded = self.encoded.get(encoding)
+        if encoded is None:
+            return self.body, self.etag, None
+        return encoded, f"{self.etag}-{encoding}", encoding
+
+    def size(self):
+        return len(self.body) + sum(len(encoded) for encoded in self.encoded.values())
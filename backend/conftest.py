@@ -0,0 +1,18 @@
+import os
+import tempfile
+
+import pytest
+
+# Keep the test run away from the real cache.db; must happen before anything imports db
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="klarity-test-"), "cache.db"))
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """An empty cache.db with the app's schema, private to one test"""
+    import app
+    import db
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "cache.db"))
+    app.init_db()
+    yield
+    db.close_connection()
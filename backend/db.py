@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from log import stage
+
+
+DB_PATH = os.getenv("CACHE_DB_PATH", "cache.db")
+
+# Seconds a connection waits on another writer's lock before "database is locked"
+BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+
+# Tuned for a read-heavy cache shared by several gunicorn workers
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=OFF"
+)
+
+# sqlite3 keeps a per-connection LRU of prepared statements keyed by SQL
+# text, so long-lived connections reuse them across requests
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+
+def _open_connection(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection():
+    """Return this thread's long-lived connection to the cache database.
+
+    Connections are pooled per thread and per process: a worker forked by
+    gunicorn never reuses a handle opened by its parent. Connections run in
+    autocommit mode, so wrap writes in ``transaction()``.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid() and _local.path == DB_PATH:
+        return conn
+    conn = _open_connection(DB_PATH)
+    _local.conn = conn
+    _local.pid = os.getpid()
+    _local.path = DB_PATH
+    return conn
+
+
+def close_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+@contextmanager
+def transaction():
+    """Run a block of writes in one transaction on the pooled connection.
+
+    Uses BEGIN IMMEDIATE so the write lock is taken up front and waits up
+    to BUSY_TIMEOUT, instead of failing with "database is locked" when a
+    deferred read transaction tries to upgrade to a write.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        # Nested use joins the outer transaction
+        yield conn
+        return
+    # Timed separately so write-lock contention between workers is visible
+    with stage("db_lock_wait"):
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+
+def query_one(sql, params=()):
+    return get_connection().execute(sql, params).fetchone()
+
+
+def query_all(sql, params=()):
+    return get_connection().execute(sql, params).fetchall()
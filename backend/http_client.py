@@ -0,0 +1,205 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import counter
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Every attempt, so retried 429s and 5xx show up too; failures without a
+# response are counted under their UpstreamError reason
+upstream_responses = counter("klarity_upstream_responses_total", "Upstream HTTP attempts by host and status", ("host", "status"))
+
+
+class UpstreamError(Exception):
+    """Structured failure of an upstream HTTP call after retries.
+
+    ``reason`` is one of "timeout", "connection", "rate_limited",
+    "server_error" or "concurrency_limit".
+    """
+
+    def __init__(self, host, reason, message, status_code=None, attempts=0, retry_after=None):
+        super().__init__(message)
+        self.host = host
+        self.reason = reason
+        self.status_code = status_code
+        self.attempts = attempts
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        return {
+            "host": self.host,
+            "reason": self.reason,
+            "message": str(self),
+            "status_code": self.status_code,
+            "attempts": self.attempts,
+            "retry_after": self.retry_after
+        }
+
+
+class RetryPolicy:
+    """Jittered exponential backoff for 429/5xx responses and network errors"""
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0, retry_statuses=RETRY_STATUSES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number ``attempt`` (1-based)"""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # Full jitter: uniform in [0, base * 2^(attempt-1)], capped
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+
+def _parse_host_limits(value):
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            host, limit = item.split("=", 1)
+            limits[host.strip()] = int(limit)
+    return limits
+
+
+def _parse_retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _release_on_close(response, semaphore):
+    """Keep a streamed response's connection slot until the caller closes it"""
+    close = response.close
+    lock = threading.Lock()
+    released = False
+
+    def close_and_release():
+        nonlocal released
+        try:
+            close()
+        finally:
+            with lock:
+                if not released:
+                    released = True
+                    semaphore.release()
+
+    response.close = close_and_release
+
+
+class _HostPool:
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.session = requests.Session()
+        # One keep-alive pool per host, sized to the concurrency limit so
+        # connections are reused rather than discarded, and never exceeded
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=limit, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+
+class HttpClient:
+    """Shared, per-host keep-alive sessions with concurrency limits and retries"""
+
+    def __init__(self, default_limit=10, host_limits=None, policy=None, acquire_timeout=30, sleep=time.sleep):
+        self.default_limit = default_limit
+        self.host_limits = host_limits or {}
+        self.policy = policy or RetryPolicy()
+        self.acquire_timeout = acquire_timeout
+        self.sleep = sleep
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, host):
+        with self._lock:
+            pool = self._pools.get(host)
+            if pool is None:
+                pool = _HostPool(self.host_limits.get(host, self.default_limit))
+                self._pools[host] = pool
+            return pool
+
+    def request(self, method, url, policy=None, **kwargs):
+        """Send a request, retrying network errors and 429/5xx responses.
+
+        Returns the response for any other status. Raises UpstreamError when
+        retries are exhausted or the host's concurrency limit can't be
+        acquired in time.
+
+        With ``stream=True`` the body is read after this returns, so the
+        host slot stays taken until the response is closed: callers must
+        close it, or use it as a context manager.
+        """
+        policy = policy or self.policy
+        stream = kwargs.get("stream", False)
+        host = urlparse(url).netloc
+        pool = self._pool(host)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if not pool.semaphore.acquire(timeout=self.acquire_timeout):
+                upstream_responses.inc(host=host, status="concurrency_limit")
+                raise UpstreamError(host, "concurrency_limit",
+                                    f"Timed out waiting for a connection slot to {host}", attempts=attempt - 1)
+            response = None
+            try:
+                response = pool.session.request(method, url, **kwargs)
+                error = None
+            except requests.exceptions.Timeout as e:
+                error = UpstreamError(host, "timeout", f"Request to {host} timed out: {e}", attempts=attempt)
+            except requests.exceptions.ConnectionError as e:
+                error = UpstreamError(host, "connection", f"Failed to connect to {host}: {e}", attempts=attempt)
+            finally:
+                if stream and response is not None:
+                    _release_on_close(response, pool.semaphore)
+                else:
+                    pool.semaphore.release()
+            upstream_responses.inc(host=host, status=response.status_code if response is not None else error.reason)
+
+            retry_after = None
+            if response is not None:
+                if response.status_code not in policy.retry_statuses:
+                    return response
+                retry_after = _parse_retry_after(response)
+                reason = "rate_limited" if response.status_code == 429 else "server_error"
+                error = UpstreamError(host, reason, f"{host} returned status {response.status_code}: {response.text[:500]}",
+                                      status_code=response.status_code, attempts=attempt, retry_after=retry_after)
+                response.close()
+
+            if attempt >= policy.max_attempts:
+                raise error
+            self.sleep(policy.delay(attempt, retry_after))
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {host: {"limit": pool.limit} for host, pool in self._pools.items()}
+
+
+http_client = HttpClient(
+    default_limit=int(os.getenv("HTTP_DEFAULT_HOST_LIMIT", "10")),
+    host_limits=_parse_host_limits(os.getenv("HTTP_HOST_LIMITS", "")),
+    policy=RetryPolicy(
+        max_attempts=int(os.getenv("HTTP_MAX_ATTEMPTS", "3")),
+        base_delay=float(os.getenv("HTTP_BACKOFF_BASE", "0.5")),
+        max_delay=float(os.getenv("HTTP_BACKOFF_MAX", "8"))
+    )
+)
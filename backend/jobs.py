@@ -0,0 +1,254 @@
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from db import transaction, query_one, query_all
+from log import get_logger
+
+
+log = get_logger("jobs")
+
+# Job progress stages reported by /job_status
+STAGE_QUEUED = "queued"
+STAGE_TRANSCRIPT = "transcript"
+STAGE_LLM = "llm"
+STAGE_DONE = "done"
+STAGE_ERROR = "error"
+
+FINISHED = (STAGE_DONE, STAGE_ERROR)
+
+_COLUMNS = ("job_id, video_id, user_id, params, status, result, error, status_code, "
+            "attempts, lease_expires_at, created_at, updated_at")
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no free slots"""
+
+
+class Job:
+    def __init__(self, job_id, video_id, user_id, params=None):
+        self.job_id = job_id
+        self.video_id = video_id
+        self.user_id = user_id
+        self.params = params or {}
+        self.status = STAGE_QUEUED
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.attempts = 1
+        self.lease_expires_at = 0.0
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls(row[0], row[1], row[2], json.loads(row[3]) if row[3] else {})
+        job.status = row[4]
+        job.result = json.loads(row[5]) if row[5] else None
+        job.error = row[6]
+        job.status_code = row[7]
+        job.attempts = row[8]
+        job.lease_expires_at = row[9]
+        job.created_at = row[10]
+        job.updated_at = row[11]
+        return job
+
+    def to_dict(self):
+        data = {
+            "job_id": self.job_id,
+            "video_id": self.video_id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+        if self.status == STAGE_DONE:
+            data["result"] = self.result
+        if self.status == STAGE_ERROR:
+            data["error"] = self.error
+            data["status_code"] = self.status_code
+        return data
+
+
+class JobManager:
+    """Bounded background worker pool for long-running video analyses.
+
+    Work is put on a fixed-size queue drained by ``max_workers`` daemon
+    threads, so a burst of requests cannot grow memory without limit.
+    Job state lives in the ``analysis_jobs`` table of cache.db, so any
+    gunicorn worker can report on a job another one accepted. The worker
+    running a job renews a lease on its row every ``lease_seconds / 3``;
+    if the lease lapses because that worker died or was restarted, the
+    next worker asked about the job runs it again, up to ``max_attempts``
+    times. Finished jobs are kept for ``result_ttl`` seconds so clients
+    can poll.
+
+    ``run(job)`` does the work: it should call ``set_stage`` as it
+    progresses and return a JSON-serializable result, or raise to mark
+    the job as failed. Everything it needs must be in ``job.params``.
+    """
+
+    def __init__(self, run, max_workers=4, max_queue=64, result_ttl=3600, lease_seconds=60, max_attempts=3):
+        self.run = run
+        self.max_workers = max_workers
+        self.result_ttl = result_ttl
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._started_pid = None
+        self._owner_id = None
+
+    def _owner(self):
+        # Per process and per manager, so a forked worker never renews its parent's jobs
+        with self._lock:
+            if self._owner_id is None or not self._owner_id.startswith(f"{os.getpid()}-"):
+                self._owner_id = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+            return self._owner_id
+
+    def _start(self):
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            # Threads don't survive a fork, and a forked child gets a fresh queue
+            if self._started_pid is not None:
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._started_pid = os.getpid()
+            for i in range(self.max_workers):
+                threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+            threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def submit(self, video_id, user_id, params=None):
+        """Record a new job, queue it on this worker and return it"""
+        self._start()
+        self._purge_expired()
+        job = Job(uuid.uuid4().hex, video_id, user_id, params)
+        job.lease_expires_at = job.created_at + self.lease_seconds
+        with transaction() as conn:
+            conn.execute(f"""
+                INSERT INTO analysis_jobs ({_COLUMNS}, owner)
+                VALUES (?, ?, ?, ?, ?, NULL, NULL, NULL, ?, ?, ?, ?, ?)
+            """, (job.job_id, video_id, user_id, json.dumps(job.params), job.status, job.attempts,
+                  job.lease_expires_at, job.created_at, job.updated_at, self._owner()))
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with transaction() as conn:
+                conn.execute("DELETE FROM analysis_jobs WHERE job_id = ?", (job.job_id,))
+            raise QueueFullError("Job queue is full, try again later")
+        return job
+
+    def get(self, job_id):
+        """The job's current state, whichever worker is running it; None if unknown or expired"""
+        row = query_one(f"SELECT {_COLUMNS} FROM analysis_jobs WHERE job_id = ?", (job_id,))
+        if row is None:
+            return None
+        job = Job.from_row(row)
+        if job.status not in FINISHED and job.lease_expires_at < time.time():
+            job = self._recover(job)
+        return job
+
+    def _recover(self, job):
+        """Take over a job whose worker stopped renewing its lease"""
+        now = time.time()
+        if job.attempts >= self.max_attempts:
+            self._finish(job, error="Job was interrupted too many times", status_code=500, owned=False)
+            return job
+        self._start()
+        with transaction() as conn:
+            claimed = conn.execute("""
+                UPDATE analysis_jobs
+                SET owner = ?, status = ?, attempts = attempts + 1, lease_expires_at = ?, updated_at = ?
+                WHERE job_id = ? AND status NOT IN (?, ?) AND lease_expires_at < ?
+            """, (self._owner(), STAGE_QUEUED, now + self.lease_seconds, now, job.job_id,
+                  STAGE_DONE, STAGE_ERROR, now)).rowcount
+        if not claimed:
+            # Another worker got there first
+            return self.get(job.job_id)
+        job.status = STAGE_QUEUED
+        job.attempts += 1
+        job.updated_at = now
+        log.warning("Re-running abandoned job %s (attempt %d)", job.job_id, job.attempts)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            # Let the lease lapse again so a less busy worker can pick it up; dropping
+            # ownership keeps our heartbeat from renewing a job we never queued
+            with transaction() as conn:
+                conn.execute("""
+                    UPDATE analysis_jobs SET owner = NULL, lease_expires_at = 0, attempts = attempts - 1
+                    WHERE job_id = ? AND owner = ?
+                """, (job.job_id, self._owner()))
+            job.attempts -= 1
+            job.lease_expires_at = 0
+        return job
+
+    def set_stage(self, job, stage):
+        job.status = stage
+        job.updated_at = time.time()
+        with transaction() as conn:
+            conn.execute("UPDATE analysis_jobs SET status = ?, updated_at = ? WHERE job_id = ? AND owner = ?",
+                         (stage, job.updated_at, job.job_id, self._owner()))
+
+    def _finish(self, job, result=None, error=None, status_code=None, owned=True):
+        job.status = STAGE_ERROR if error is not None else STAGE_DONE
+        job.result = result
+        job.error = error
+        job.status_code = status_code
+        job.updated_at = time.time()
+        sql = """
+            UPDATE analysis_jobs SET status = ?, result = ?, error = ?, status_code = ?, updated_at = ?
+            WHERE job_id = ?
+        """
+        params = [job.status, json.dumps(result) if result is not None else None, error, status_code,
+                  job.updated_at, job.job_id]
+        if owned:
+            sql += " AND owner = ?"
+            params.append(self._owner())
+        with transaction() as conn:
+            conn.execute(sql, params)
+
+    def stats(self):
+        rows = query_all("SELECT status, COUNT(*) FROM analysis_jobs GROUP BY status")
+        return {
+            "workers": self.max_workers,
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "jobs": {status: count for status, count in rows}
+        }
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._finish(job, result=self.run(job))
+            except Exception as e:
+                try:
+                    self._finish(job, error=str(e), status_code=getattr(e, "status_code", 500))
+                except Exception:
+                    log.exception("Could not record failure of job %s", job.job_id)
+            finally:
+                self._queue.task_done()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                self._renew_leases()
+            except Exception:
+                log.exception("Could not renew job leases")
+
+    def _renew_leases(self):
+        with transaction() as conn:
+            conn.execute("""
+                UPDATE analysis_jobs SET lease_expires_at = ?
+                WHERE owner = ? AND status NOT IN (?, ?)
+            """, (time.time() + self.lease_seconds, self._owner(), STAGE_DONE, STAGE_ERROR))
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.result_ttl
+        with transaction() as conn:
+            conn.execute("DELETE FROM analysis_jobs WHERE status IN (?, ?) AND updated_at < ?",
+                         (STAGE_DONE, STAGE_ERROR, cutoff))
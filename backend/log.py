@@ -0,0 +1,234 @@
+"""Structured logging that keeps I/O off the request thread.
+
+Records go onto an in-memory queue and are written to stdout by a
+background QueueListener, so a slow pipe under gunicorn never blocks a
+request. Lines are logfmt (``LOG_FORMAT=json`` for JSON) and carry the
+current request id. Extra key/value pairs are passed with
+``log.info("msg", extra=fields(key=value))``.
+
+Settings:
+    LOG_LEVEL              DEBUG, INFO (default), WARNING, ERROR
+    LOG_FORMAT             logfmt (default) or json
+    LOG_DEBUG_SAMPLE_RATE  fraction of DEBUG records kept (default 1.0)
+
+Each request also gets a RequestTrace (see ``start_trace``/``stage``)
+that collects per-stage durations and a few outcome fields for the
+single summary line logged when the request ends.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+class RequestTrace:
+    """Per-request id, stage timings and outcome fields"""
+
+    __slots__ = ("request_id", "started", "stages", "fields", "_lock")
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def start_trace(request_id=None):
+    """Begin a trace in the current context; returns a token for ``end_trace``"""
+    return _trace.set(RequestTrace(request_id))
+
+
+def end_trace(token):
+    trace = _trace.get()
+    try:
+        _trace.reset(token)
+    except ValueError:
+        # Ended from a different context than it was started in
+        _trace.set(None)
+    return trace
+
+
+def current_trace():
+    return _trace.get()
+
+
+def annotate(**values):
+    """Attach outcome fields (cache result, video id, ...) to the current request's summary"""
+    trace = _trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.fields.update(values)
+
+
+_stage_observers = []
+
+
+def add_stage_observer(observer):
+    """Also report every ``stage`` to ``observer.stage_started(name)`` and
+    ``observer.stage_finished(name, seconds, failed)``, inside requests or not"""
+    _stage_observers.append(observer)
+
+
+@contextmanager
+def stage(name):
+    """Time a block and add it to the current request's stage durations"""
+    for observer in _stage_observers:
+        observer.stage_started(name)
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        trace = _trace.get()
+        if trace is not None:
+            trace.add_stage(name, seconds)
+        for observer in _stage_observers:
+            observer.stage_finished(name, seconds, failed)
+
+
+def fields(**values):
+    """``extra=`` argument carrying structured key/value pairs for one record"""
+    return {"fields": values}
+
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record):
+        trace = _trace.get()
+        record.request_id = trace.request_id if trace is not None else None
+        return True
+
+
+class _SamplingFilter(logging.Filter):
+    """Keeps only ``rate`` of DEBUG records"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1.0 or random.random() < self.rate
+
+
+def _quote(value):
+    text = str(value)
+    if not text or any(c in text for c in ' ="\n'):
+        return json.dumps(text)
+    return text
+
+
+class LogfmtFormatter(logging.Formatter):
+    def format(self, record):
+        parts = [
+            "ts=" + self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level=" + record.levelname.lower(),
+            "logger=" + record.name
+        ]
+        if getattr(record, "request_id", None):
+            parts.append("request_id=" + record.request_id)
+        parts.append("msg=" + _quote(record.getMessage()))
+        for key, value in (getattr(record, "fields", None) or {}).items():
+            if isinstance(value, dict):
+                value = json.dumps(value, separators=(",", ":"))
+            parts.append(f"{key}={_quote(value)}")
+        line = " ".join(parts)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        if getattr(record, "request_id", None):
+            data["request_id"] = record.request_id
+        data.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records with their message rendered; lines are formatted on the listener thread"""
+
+    def prepare(self, record):
+        # Render args and tracebacks now, while they are still valid
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+_handler = None
+_lock = threading.Lock()
+
+
+def _start_listener():
+    """Start the writer thread with a fresh queue (also used in forked children)"""
+    global _listener
+    _handler.queue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if os.getenv("LOG_FORMAT", "logfmt").lower() == "json" else LogfmtFormatter())
+    _listener = logging.handlers.QueueListener(_handler.queue, output)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def configure_logging():
+    """Install the queue handler on the root logger; safe to call more than once"""
+    global _handler
+    with _lock:
+        if _handler is not None:
+            return
+        _handler = _DeferredQueueHandler(queue.SimpleQueue())
+        _handler.addFilter(_ContextFilter())
+        _handler.addFilter(_SamplingFilter(float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))))
+        root = logging.getLogger()
+        root.handlers = [_handler]
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        # werkzeug's per-request access line duplicates our request summary
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        _start_listener()
+        atexit.register(_stop_listener)
+        # The listener thread does not survive a fork (gunicorn --preload)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_start_listener)
+
+
+def get_logger(name):
+    return logging.getLogger(name)
@@ -0,0 +1,426 @@
+"""In-process counters, gauges and histograms in Prometheus text format.
+
+Updating a metric is a dict update under a lock, so it is safe to call on
+every request and in every pipeline stage. ``render(collect())`` produces
+the text served on /metrics.
+
+Under gunicorn each worker has its own registry. When ``METRICS_DIR`` is
+set, every process writes a snapshot of its values to
+``<METRICS_DIR>/<pid>.json`` every ``METRICS_FLUSH_INTERVAL`` seconds and
+``collect()`` merges all snapshots, so whichever worker answers a scrape
+reports totals for the whole server. Counters and histograms are summed
+over every file, including those of workers that have exited; gauges are
+summed over live workers only. A worker that reuses a dead worker's pid
+carries on from that file's counters, so totals never go backwards. Empty
+the directory when the server is (re)started.
+"""
+import atexit
+import bisect
+import json
+import os
+import threading
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        """``[(label_values, value), ...]``; the value's shape depends on the metric type"""
+        with self._lock:
+            return [(key, self._copy(value)) for key, value in self._values.items()]
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Bucketed observations; a sample is ``[per-bucket counts..., +Inf count, sum]``"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def _copy(self, value):
+        return list(value)
+
+
+class GaugeCallback:
+    """A gauge read from ``fn()`` at snapshot time; ``fn`` returns ``{label_values: value}``"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames, fn):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+
+    def reset(self):
+        pass
+
+    def samples(self):
+        return [(tuple(str(v) for v in key), value) for key, value in self.fn().items()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name, documentation, labelnames, fn):
+        return self._register(GaugeCallback(name, documentation, labelnames, fn))
+
+    def reset(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def snapshot(self):
+        """All current values as a JSON-serializable dict"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {}
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                # A broken callback must not take the whole endpoint down
+                continue
+            entry = {
+                "type": metric.kind,
+                "help": metric.documentation,
+                "labels": list(metric.labelnames),
+                "samples": [[list(key), value] for key, value in samples]
+            }
+            if isinstance(metric, Histogram):
+                entry["buckets"] = list(metric.buckets)
+            snapshot[metric.name] = entry
+        return snapshot
+
+
+def merge_snapshots(snapshots, include_gauges):
+    """Sum counters and histograms over ``snapshots``; gauges only where ``include_gauges(i)``"""
+    merged = {}
+    for i, snapshot in enumerate(snapshots):
+        keep_gauges = include_gauges(i)
+        for name, entry in snapshot.items():
+            if entry["type"] == "gauge" and not keep_gauges:
+                continue
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = dict(entry, samples={})
+            elif target["type"] != entry["type"] or target.get("buckets") != entry.get("buckets"):
+                # Written by a different version of the code; skip rather than mix
+                continue
+            for key, value in entry["samples"]:
+                key = tuple(key)
+                current = target["samples"].get(key)
+                if current is None:
+                    target["samples"][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target["samples"][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target["samples"][key] = current + value
+    for entry in merged.values():
+        entry["samples"] = list(entry["samples"].items())
+    return merged
+
+
+def render(snapshot):
+    """Prometheus text exposition format (version 0.0.4) for a snapshot"""
+    lines = []
+    for name in sorted(snapshot):
+        entry = snapshot[name]
+        labelnames = entry["labels"]
+        lines.append(f"# HELP {name} {entry['help']}")
+        lines.append(f"# TYPE {name} {entry['type']}")
+        for key, value in sorted(entry["samples"], key=lambda sample: tuple(sample[0])):
+            if entry["type"] == "histogram":
+                cumulative = 0
+                for bound, count in zip(entry["buckets"] + [float("inf")], value[:-1]):
+                    cumulative += count
+                    labels = _format_labels(labelnames, key, ("le", _format_value(float(bound))))
+                    lines.append(f"{name}_bucket{labels} {cumulative}")
+                labels = _format_labels(labelnames, key)
+                lines.append(f"{name}_sum{labels} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{labels} {cumulative}")
+            else:
+                lines.append(f"{name}{_format_labels(labelnames, key)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SnapshotWriter:
+    """Periodically writes this process's registry to ``<directory>/<pid>.json``"""
+
+    def __init__(self, registry, directory, interval=1.0):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._pid = None
+        self._base = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def start(self):
+        """Start writing for the current process; called again in forked children"""
+        with self._lock:
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._base = self._load_base()
+            self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+            self._thread.start()
+
+    def _load_base(self):
+        """Counters left behind by an earlier process with our pid"""
+        try:
+            with open(self._path(self._pid)) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {name: entry for name, entry in previous.items() if entry["type"] != "gauge"}
+
+    def write(self):
+        snapshot = self.registry.snapshot()
+        if self._base:
+            snapshot = merge_snapshots([self._base, snapshot], lambda i: i == 1)
+            for entry in snapshot.values():
+                entry["samples"] = [[list(key), value] for key, value in entry["samples"]]
+        path = self._path(self._pid)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def stop(self):
+        self._stop.set()
+        if self._pid == os.getpid():
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def collect(self):
+        """Merged snapshot of every process that has written to the directory"""
+        self.write()
+        snapshots, alive = [], []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+            try:
+                pid = int(filename[:-len(".json")])
+            except ValueError:
+                pid = None
+            alive.append(pid is not None and _pid_alive(pid))
+        return merge_snapshots(snapshots, lambda i: alive[i])
+
+
+registry = Registry()
+_writer = None
+
+
+def configure_metrics():
+    """Turn on cross-process aggregation if METRICS_DIR is set; safe to call more than once"""
+    global _writer
+    directory = os.getenv("METRICS_DIR") or os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if _writer is not None or not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    _writer = SnapshotWriter(registry, directory, float(os.getenv("METRICS_FLUSH_INTERVAL", "1.0")))
+    _writer.start()
+    atexit.register(lambda: _writer.stop())
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_after_fork)
+
+
+def _after_fork():
+    # Values inherited from the parent are already in the parent's file
+    registry.reset()
+    if _writer is not None:
+        _writer.start()
+
+
+def collect():
+    if _writer is not None:
+        return _writer.collect()
+    snapshot = registry.snapshot()
+    return merge_snapshots([snapshot], lambda i: True)
+
+
+def add_ratio(snapshot, source, name, documentation, label, numerator):
+    """Add a gauge ``name`` to a collected snapshot holding, per value of ``label``
+    in counter ``source``, the share of the count whose other labels satisfy ``numerator``.
+
+    Used for cache hit ratios so they can be read straight off /metrics.
+    """
+    entry = snapshot.get(source)
+    if entry is None:
+        return
+    index = entry["labels"].index(label)
+    totals, hits = {}, {}
+    for key, value in entry["samples"]:
+        group = key[index]
+        totals[group] = totals.get(group, 0) + value
+        if numerator(dict(zip(entry["labels"], key))):
+            hits[group] = hits.get(group, 0) + value
+    snapshot[name] = {
+        "type": "gauge",
+        "help": documentation,
+        "labels": [label],
+        "samples": [((group,), hits.get(group, 0) / total) for group, total in totals.items() if total]
+    }
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.counter(name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return registry.gauge(name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.histogram(name, documentation, labelnames, buckets)
+
+
+def gauge_callback(name, documentation, labelnames, fn):
+    return registry.gauge_callback(name, documentation, labelnames, fn)
+
+
+class StageMetrics:
+    """Stage observer (see ``log.add_stage_observer``) recording latency, errors and in-flight counts"""
+
+    def __init__(self, prefix="klarity_stage"):
+        self.duration = histogram(f"{prefix}_duration_seconds", "Time spent in each pipeline stage", ("stage",))
+        self.errors = counter(f"{prefix}_errors_total", "Pipeline stages that raised", ("stage",))
+        self.in_flight = gauge(f"{prefix}_in_flight", "Pipeline stages currently running", ("stage",))
+
+    def stage_started(self, name):
+        self.in_flight.inc(stage=name)
+
+    def stage_finished(self, name, seconds, failed):
+        self.in_flight.dec(stage=name)
+        self.duration.observe(seconds, stage=name)
+        if failed:
+            self.errors.inc(stage=name)
@@ -0,0 +1,178 @@
+"""Opt-in request profiling and a rolling list of the slowest requests.
+
+A profiled request has its thread's stack sampled every few milliseconds
+by a single background thread. The samples are written as a collapsed
+stack file (``frame;frame;frame count`` per line), which flamegraph.pl,
+speedscope and inferno read directly. Only the request's own thread is
+sampled: work handed to pools shows up as the request waiting on it.
+
+Nothing is sampled, and the sampler thread is not running, unless a
+request has been picked for profiling, so the cost with profiling off is
+a set lookup per request.
+"""
+import heapq
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+
+_labels = {}
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    label = _labels.get(code)
+    if label is None:
+        module = frame.f_globals.get("__name__") or os.path.basename(code.co_filename)
+        label = _labels[code] = f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+    return label
+
+
+def collapse(frame):
+    """One sample in collapsed form: outermost frame first, separated by ';'"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ";".join(labels)
+
+
+class StackSampler:
+    """Samples the stacks of registered threads every ``interval`` seconds.
+
+    The sampling thread starts with the first registered thread, sleeps on
+    a condition while nothing is registered, and is restarted after a fork.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._active = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def start(self, ident=None):
+        ident = ident or threading.get_ident()
+        with self._cond:
+            self._active[ident] = Counter()
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def stop(self, ident=None):
+        """Unregister a thread and return its Counter of collapsed stacks"""
+        ident = ident or threading.get_ident()
+        with self._cond:
+            return self._active.pop(ident, Counter())
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+                targets = list(self._active)
+            frames = sys._current_frames()
+            samples = [(ident, collapse(frames[ident])) for ident in targets if ident in frames and ident != me]
+            del frames
+            with self._cond:
+                for ident, stack in samples:
+                    stacks = self._active.get(ident)
+                    if stacks is not None:
+                        stacks[stack] += 1
+            time.sleep(self.interval)
+
+
+def write_collapsed(path, stacks):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    os.replace(tmp, path)
+
+
+class SlowRequests:
+    """The ``size`` slowest requests seen over roughly the last ``window`` seconds.
+
+    Entries go into the current window's min-heap; when the window ends it
+    becomes the previous one, so reports cover between one and two windows.
+    """
+
+    def __init__(self, size=20, window=3600, clock=time.monotonic):
+        self.size = size
+        self.window = window
+        self.clock = clock
+        self._current = []
+        self._previous = []
+        self._window_started = clock()
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _rotate(self):
+        now = self.clock()
+        if now - self._window_started >= self.window:
+            # Skipped a whole window: nothing recent is left to keep
+            self._previous = self._current if now - self._window_started < 2 * self.window else []
+            self._current = []
+            self._window_started = now
+
+    def record(self, duration, entry):
+        with self._lock:
+            self._rotate()
+            # The counter breaks ties so entries themselves are never compared
+            self._counter += 1
+            item = (duration, self._counter, entry)
+            if len(self._current) < self.size:
+                heapq.heappush(self._current, item)
+            elif duration > self._current[0][0]:
+                heapq.heapreplace(self._current, item)
+
+    def top(self):
+        with self._lock:
+            self._rotate()
+            items = heapq.nlargest(self.size, self._current + self._previous)
+        return [entry for _, _, entry in items]
+
+
+class RequestProfiler:
+    """Decides which requests to profile and writes their samples to ``directory``.
+
+    A request to one of ``endpoints`` is profiled with probability
+    ``sample_rate``, or always when it carries ``X-Profile: <admin_token>``
+    (the header is ignored while no token is configured).
+    """
+
+    def __init__(self, directory, endpoints, sample_rate=0.0, admin_token=None, interval=0.005):
+        self.directory = directory
+        self.endpoints = frozenset(endpoints)
+        self.sample_rate = sample_rate
+        self.admin_token = admin_token
+        self.sampler = StackSampler(interval)
+        self.profiled = 0
+
+    def should_profile(self, endpoint, header):
+        if endpoint not in self.endpoints:
+            return False
+        if header and self.admin_token and header == self.admin_token:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        self.sampler.start()
+
+    def finish(self, name):
+        """Stop sampling this thread and write its stacks; returns the file path, or None if empty"""
+        stacks = self.sampler.stop()
+        if not stacks:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{name}.folded")
+        write_collapsed(path, stacks)
+        self.profiled += 1
+        return path
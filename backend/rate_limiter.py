@@ -0,0 +1,240 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from db import get_connection, transaction
+
+
+# Priority lanes: lower numbers are served first
+INTERACTIVE = 0
+BATCH = 1
+LANE_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+_current_lane = contextvars.ContextVar("gemini_lane", default=INTERACTIVE)
+
+
+@contextmanager
+def use_lane(lane):
+    """Run the block's Gemini calls in the given priority lane"""
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def current_lane():
+    return _current_lane.get()
+
+
+class SystemClock:
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class FakeClock:
+    """Clock for tests: sleeping advances time instantly"""
+
+    def __init__(self, start=1000.0):
+        self.now = start
+        self._lock = threading.Lock()
+
+    def time(self):
+        with self._lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += seconds
+
+    def advance(self, seconds):
+        self.sleep(seconds)
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a caller could not get rate-limit capacity in time"""
+
+
+class TokenBucketLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared across processes.
+
+    Bucket levels and the queue of waiting callers live in cache.db, so
+    every gunicorn worker draws from the same quota. Callers queue in
+    priority order (lane, then arrival) and only the head of the queue may
+    take capacity. The batch lane also leaves ``batch_reserve`` of each
+    bucket free, so interactive requests arriving later still have room.
+    """
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute, batch_reserve=0.2,
+                 clock=None, poll_interval=0.05, max_sleep=1.0, waiter_ttl=60):
+        self.name = name
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self.batch_reserve = batch_reserve
+        self.clock = clock or SystemClock()
+        self.poll_interval = poll_interval
+        self.max_sleep = max_sleep
+        self.waiter_ttl = waiter_ttl
+        self._stats_lock = threading.Lock()
+        self._waits = {lane: {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "timeouts": 0}
+                       for lane in LANE_NAMES}
+
+    def _level(self, conn, bucket, capacity, now):
+        row = conn.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE name = ?", (bucket,)).fetchone()
+        if row is None:
+            return capacity
+        tokens, updated_at = row
+        return min(capacity, tokens + max(0.0, now - updated_at) * capacity / 60.0)
+
+    def _store(self, conn, bucket, tokens, now):
+        conn.execute("""
+            INSERT INTO rate_limit_buckets (name, tokens, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+        """, (bucket, tokens, now))
+
+    def _needs(self, lane, tokens):
+        """Bucket levels required before ``tokens`` may be taken in ``lane``"""
+        reserve = self.batch_reserve if lane == BATCH else 0.0
+        return (1 + reserve * self.request_capacity,
+                min(tokens, self.token_capacity) + reserve * self.token_capacity)
+
+    def _seconds_until(self, levels, needs):
+        """How long until refills bring both buckets up to ``needs``; 0 if they already are"""
+        return max(
+            (needs[0] - levels[0]) * 60.0 / self.request_capacity,
+            (needs[1] - levels[1]) * 60.0 / self.token_capacity,
+            0.0
+        )
+
+    def _levels(self, conn, now):
+        return (self._level(conn, f"{self.name}:requests", self.request_capacity, now),
+                self._level(conn, f"{self.name}:tokens", self.token_capacity, now))
+
+    def _head(self, conn):
+        row = conn.execute("""
+            SELECT id FROM rate_limit_waiters WHERE limiter = ?
+            ORDER BY lane, id LIMIT 1
+        """, (self.name,)).fetchone()
+        return row[0] if row else None
+
+    def _peek(self, lane, tokens, now):
+        """Read-only look at the queue: (head waiter id, seconds until our need is covered)"""
+        conn = get_connection()
+        return self._head(conn), self._seconds_until(self._levels(conn, now), self._needs(lane, tokens))
+
+    def _try_acquire(self, waiter_id, lane, tokens, now):
+        """One attempt under the write lock; returns (waiter_id, granted, is_head, seconds_to_wait)"""
+        with transaction() as conn:
+            conn.execute("DELETE FROM rate_limit_waiters WHERE limiter = ? AND expires_at < ?", (self.name, now))
+            if waiter_id is not None:
+                refreshed = conn.execute("UPDATE rate_limit_waiters SET expires_at = ? WHERE id = ?",
+                                         (now + self.waiter_ttl, waiter_id)).rowcount
+                if not refreshed:
+                    # Our entry expired while we weren't looking; rejoin the queue
+                    waiter_id = None
+            if waiter_id is None:
+                waiter_id = conn.execute("""
+                    INSERT INTO rate_limit_waiters (limiter, lane, enqueued_at, expires_at)
+                    VALUES (?, ?, ?, ?)
+                """, (self.name, lane, now, now + self.waiter_ttl)).lastrowid
+
+            levels = self._levels(conn, now)
+            wait = self._seconds_until(levels, self._needs(lane, tokens))
+            if self._head(conn) != waiter_id:
+                return waiter_id, False, False, wait
+            if wait > 0:
+                return waiter_id, False, True, wait
+
+            self._store(conn, f"{self.name}:requests", levels[0] - 1, now)
+            self._store(conn, f"{self.name}:tokens", levels[1] - min(tokens, self.token_capacity), now)
+            conn.execute("DELETE FROM rate_limit_waiters WHERE id = ?", (waiter_id,))
+            return waiter_id, True, True, 0.0
+
+    def _remove_waiter(self, waiter_id):
+        with transaction() as conn:
+            conn.execute("DELETE FROM rate_limit_waiters WHERE id = ?", (waiter_id,))
+
+    def _record(self, lane, waited, timed_out=False):
+        with self._stats_lock:
+            stats = self._waits[lane]
+            if timed_out:
+                stats["timeouts"] += 1
+                return
+            stats["count"] += 1
+            stats["total_seconds"] += waited
+            stats["max_seconds"] = max(stats["max_seconds"], waited)
+
+    def acquire(self, tokens=0, lane=None, timeout=None):
+        """Block until one request and ``tokens`` estimated tokens are available.
+
+        Uses the caller's lane (see ``use_lane``) unless one is given.
+        Returns the seconds spent queued; raises RateLimitTimeout after
+        ``timeout`` seconds.
+
+        Joining the queue and taking capacity are writes; waiting is not.
+        The head of the queue sleeps until the buckets will have refilled
+        enough, and everyone behind it polls with reads, backing off
+        exponentially from ``poll_interval`` to ``max_sleep``. The write
+        lock is only taken again to claim capacity that a read showed is
+        there, or to refresh the queue entry before ``waiter_ttl`` runs out.
+        """
+        lane = current_lane() if lane is None else lane
+        started = now = refreshed = self.clock.time()
+        waiter_id, granted, is_head, wait = self._try_acquire(None, lane, tokens, now)
+        backoff = self.poll_interval
+        try:
+            while not granted:
+                waited = now - started
+                if timeout is not None and waited + wait > timeout:
+                    self._record(lane, waited, timed_out=True)
+                    raise RateLimitTimeout(
+                        f"Rate limit capacity for {self.name} not available within {timeout}s")
+                if is_head:
+                    delay = max(wait, self.poll_interval)
+                else:
+                    delay = max(wait, backoff)
+                    backoff = min(backoff * 2, self.max_sleep)
+                self.clock.sleep(min(delay, self.max_sleep))
+
+                now = self.clock.time()
+                head, wait = self._peek(lane, tokens, now)
+                is_head = head == waiter_id
+                if (is_head and wait <= 0) or head is None or now - refreshed >= self.waiter_ttl / 3:
+                    waiter_id, granted, is_head, wait = self._try_acquire(waiter_id, lane, tokens, now)
+                    refreshed = now
+            waited = now - started
+            self._record(lane, waited)
+            return waited
+        finally:
+            if not granted:
+                self._remove_waiter(waiter_id)
+
+    def stats(self):
+        with self._stats_lock:
+            lanes = {}
+            for lane, stats in self._waits.items():
+                count = stats["count"]
+                lanes[LANE_NAMES[lane]] = {
+                    "acquired": count,
+                    "timeouts": stats["timeouts"],
+                    "avg_wait_seconds": round(stats["total_seconds"] / count, 4) if count else 0.0,
+                    "max_wait_seconds": round(stats["max_seconds"], 4)
+                }
+        return {
+            "requests_per_minute": self.request_capacity,
+            "tokens_per_minute": self.token_capacity,
+            "lanes": lanes
+        }
+
+
+# Rough size of a Gemini token in characters of English text
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(prompt, expected_output_tokens=1500):
+    """Rough Gemini token estimate: ~4 characters per token plus the expected reply"""
+    return len(prompt) // CHARS_PER_TOKEN + expected_output_tokens
@@ -0,0 +1,115 @@
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+
+
+class _VideoScenes:
+    """Scenes of one video as parallel arrays sorted by start time"""
+
+    __slots__ = ("starts", "ends", "titles", "texts", "version", "checked_at", "nbytes")
+
+    def __init__(self, rows, version):
+        self.starts = [row[0] for row in rows]
+        self.ends = [row[1] for row in rows]
+        self.titles = [row[2] for row in rows]
+        self.texts = [row[3] for row in rows]
+        self.version = version
+        self.checked_at = time.monotonic()
+        # Rough footprint: the text plus per-scene list and int overhead
+        self.nbytes = 64 + sum(len(t or "") + len(w or "") + 96 for t, w in zip(self.titles, self.texts))
+
+    def find(self, timestamp):
+        i = bisect_right(self.starts, timestamp) - 1
+        if i < 0 or self.ends[i] <= timestamp:
+            return None
+        return {
+            "scene_start": self.starts[i],
+            "scene_end": self.ends[i],
+            "scene_title": self.titles[i],
+            "what_happened": self.texts[i]
+        }
+
+
+class SceneIndex:
+    """Process-local LRU of per-video scene arrays answering timestamp lookups by binary search.
+
+    ``load_scenes(video_id)`` returns (scene_start, scene_end, scene_title,
+    what_happened) rows ordered by scene_start. ``load_version(video_id)``
+    returns a value that changes whenever the video's analysis is rewritten;
+    entries are revalidated against it every ``revalidate_seconds`` so
+    rewrites by other workers are picked up. Writes in this process should
+    call ``invalidate``.
+    """
+
+    def __init__(self, load_scenes, load_version, max_videos=512, max_bytes=32 * 1024 * 1024, revalidate_seconds=30):
+        self.load_scenes = load_scenes
+        self.load_version = load_version
+        self.max_videos = max_videos
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, video_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is not None:
+                self._entries.move_to_end(video_id)
+                if now - entry.checked_at < self.revalidate_seconds:
+                    self.hits += 1
+                    return entry
+
+        if entry is not None:
+            version = self.load_version(video_id)
+            if version == entry.version:
+                entry.checked_at = now
+                with self._lock:
+                    self.hits += 1
+                return entry
+        else:
+            version = self.load_version(video_id)
+
+        entry = _VideoScenes(self.load_scenes(video_id), version)
+        with self._lock:
+            self.misses += 1
+            old = self._entries.pop(video_id, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[video_id] = entry
+            self._bytes += entry.nbytes
+            while self._entries and (len(self._entries) > self.max_videos or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+        return entry
+
+    def lookup(self, video_id, timestamp):
+        """Return the scene containing ``timestamp``, or None"""
+        return self._get(video_id).find(timestamp)
+
+    def lookup_many(self, video_id, timestamps):
+        """Return the scene (or None) for each timestamp, in order"""
+        entry = self._get(video_id)
+        return [entry.find(timestamp) for timestamp in timestamps]
+
+    def invalidate(self, video_id):
+        with self._lock:
+            entry = self._entries.pop(video_id, None)
+            if entry is not None:
+                self._bytes -= entry.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "videos": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,238 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from db import transaction, query_one
+
+
+class CoalescingTimeout(Exception):
+    """Raised when a follower gives up waiting for another worker's result"""
+
+    status_code = 504
+
+
+class LeaderFailed(Exception):
+    """Raised to followers when another worker's run of the same work just failed"""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """In-process request coalescing.
+
+    The first caller for a key runs the work; concurrent callers for the
+    same key block until it finishes and receive the same result (or the
+    same exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Run ``fn()`` once per key; returns (result, shared)"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class DbSingleFlight:
+    """Cross-process request coalescing backed by a lock row in SQLite.
+
+    The worker that inserts the ``analysis_locks`` row for a key becomes the
+    leader. Everyone else polls ``load_result`` until the leader has written
+    its result, taking over if the leader releases the row without one or
+    its lease expires.
+
+    While the leader works, a background thread renews its lease every
+    ``lease_seconds / 3`` for up to ``max_hold`` seconds. A live leader
+    therefore keeps the key however long the work takes, and a crashed
+    one loses it within ``lease_seconds``. Followers wait for as long as
+    a leader can hold the key, ``max_hold + lease_seconds``, before they
+    give up.
+
+    If the leader raises, its lock row is kept for ``failure_ttl`` seconds
+    with the error message and status code. Followers, and callers that
+    arrive meanwhile, get a LeaderFailed with that error instead of each
+    repeating the failing work in turn.
+    """
+
+    def __init__(self, lease_seconds=30, poll_interval=0.25, max_hold=600, failure_ttl=10):
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_hold = max_hold
+        self.failure_ttl = failure_ttl
+        self.wait_timeout = max_hold + lease_seconds
+        self._held = {}
+        self._held_lock = threading.Lock()
+        self._renewer_pid = None
+        self._stats_lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.takeovers = 0
+        self.timeouts = 0
+        self.shared_failures = 0
+
+    def _new_token(self):
+        # Unique per acquisition, so two threads of one worker never release each other's lock
+        return f"{os.getpid()}-{threading.get_ident()}-{uuid.uuid4().hex[:12]}"
+
+    def _acquire(self, key, token):
+        now = time.time()
+        with transaction() as conn:
+            # Clear a lease abandoned by a crashed or hung worker
+            conn.execute("DELETE FROM analysis_locks WHERE lock_key = ? AND expires_at < ?", (key, now))
+            try:
+                conn.execute("""
+                    INSERT INTO analysis_locks (lock_key, owner, acquired_at, expires_at)
+                    VALUES (?, ?, ?, ?)
+                """, (key, token, now, now + self.lease_seconds))
+            except sqlite3.IntegrityError:
+                return False
+        with self._held_lock:
+            self._held[key] = (token, now)
+            self._start_renewer()
+        return True
+
+    def _release(self, key, token, error=None):
+        with self._held_lock:
+            self._held.pop(key, None)
+        with transaction() as conn:
+            if error is None:
+                conn.execute("DELETE FROM analysis_locks WHERE lock_key = ? AND owner = ?", (key, token))
+                return
+            conn.execute("""
+                UPDATE analysis_locks SET error = ?, status_code = ?, expires_at = ?
+                WHERE lock_key = ? AND owner = ?
+            """, (str(error) or type(error).__name__, getattr(error, "status_code", 500),
+                  time.time() + self.failure_ttl, key, token))
+
+    def _start_renewer(self):
+        # Called with _held_lock held; threads don't survive a fork, so start one per process
+        if self._renewer_pid != os.getpid():
+            self._renewer_pid = os.getpid()
+            threading.Thread(target=self._renew_leases, name="lease-renewer", daemon=True).start()
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            now = time.time()
+            with self._held_lock:
+                # Past max_hold the lease is left to expire, so a hung leader can't block a key forever
+                held = [(now + self.lease_seconds, key, token)
+                        for key, (token, acquired_at) in self._held.items() if now - acquired_at < self.max_hold]
+            if not held:
+                continue
+            try:
+                with transaction() as conn:
+                    conn.executemany("UPDATE analysis_locks SET expires_at = ? WHERE lock_key = ? AND owner = ?", held)
+            except Exception:
+                # Try again next round; the lease still has two thirds of its time left
+                continue
+
+    def _lock_state(self, key):
+        """``(error, status_code)`` of a live lock row (error is None while the leader works), or None"""
+        row = query_one("SELECT expires_at, error, status_code FROM analysis_locks WHERE lock_key = ?", (key,))
+        if row is None or row[0] < time.time():
+            return None
+        return row[1], row[2]
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def do(self, key, fn, load_result):
+        """Run ``fn()`` in at most one process per key; returns (result, shared).
+
+        ``load_result()`` must return the leader's stored result, or None if
+        it is not available yet.
+        """
+        deadline = time.time() + self.wait_timeout
+        waited = False
+        while True:
+            token = self._new_token()
+            if self._acquire(key, token):
+                if waited:
+                    self._count("takeovers")
+                else:
+                    self._count("leaders")
+                error = None
+                try:
+                    return fn(), False
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    self._release(key, token, error)
+
+            if not waited:
+                self._count("coalesced")
+                waited = True
+
+            while True:
+                state = self._lock_state(key)
+                if state is None:
+                    break
+                if state[0] is not None:
+                    self._count("shared_failures")
+                    raise LeaderFailed(state[0], state[1])
+                if time.time() > deadline:
+                    self._count("timeouts")
+                    raise CoalescingTimeout(f"Timed out waiting for analysis of {key} in another worker")
+                time.sleep(self.poll_interval)
+
+            result = load_result()
+            if result is not None:
+                return result, True
+            # The leader finished without storing a result; try to take over
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "takeovers": self.takeovers,
+                "timeouts": self.timeouts,
+                "shared_failures": self.shared_failures
+            }
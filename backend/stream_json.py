@@ -0,0 +1,121 @@
+import json
+
+
+class IncrementalJSONParser:
+    """Incremental parser for a streamed JSON object.
+
+    Feed it text fragments as they arrive; ``feed`` returns the events that
+    became complete:
+
+    - ("field", key, value) when a top-level non-array value is complete
+    - ("item", key, value) for each element of a top-level array
+    - ("end", key) when a top-level array closes
+
+    Anything before the opening brace (such as a ```json fence) is skipped.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._state = "start"
+        self._key = None
+        self._token_start = None
+        self.done = False
+
+    def _value(self, end):
+        return json.loads(self._text[self._token_start:end].strip())
+
+    def feed(self, fragment):
+        self._text += fragment
+        text = self._text
+        events = []
+        i = self._pos
+        while i < len(text) and not self.done:
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._state == "key_string":
+                        self._key = json.loads(text[self._token_start:i + 1])
+                        self._state = "colon"
+                i += 1
+                continue
+
+            state = self._state
+            if state == "start":
+                if c == "{":
+                    self._depth = 1
+                    self._state = "key"
+            elif state == "key":
+                if c == '"':
+                    self._in_string = True
+                    self._token_start = i
+                    self._state = "key_string"
+                elif c == "}":
+                    self.done = True
+            elif state == "colon":
+                if c == ":":
+                    self._state = "value_start"
+            elif state == "value_start":
+                if c == "[":
+                    self._depth = 2
+                    self._token_start = None
+                    self._state = "array"
+                elif not c.isspace():
+                    self._token_start = i
+                    self._state = "value"
+                    if c == "{":
+                        self._depth += 1
+                    elif c == '"':
+                        self._in_string = True
+            elif state == "value":
+                if c in "{[":
+                    self._depth += 1
+                elif c in "}]" and self._depth > 1:
+                    self._depth -= 1
+                elif c == '"':
+                    self._in_string = True
+                elif self._depth == 1 and c in ",}":
+                    events.append(("field", self._key, self._value(i)))
+                    self._state = "key"
+                    if c == "}":
+                        self.done = True
+            elif state == "array":
+                if self._depth == 2:
+                    if c in ",]":
+                        if self._token_start is not None:
+                            events.append(("item", self._key, self._value(i)))
+                            self._token_start = None
+                        if c == "]":
+                            events.append(("end", self._key))
+                            self._depth = 1
+                            self._state = "after_value"
+                    elif not c.isspace():
+                        if self._token_start is None:
+                            self._token_start = i
+                        if c in "{[":
+                            self._depth += 1
+                        elif c == '"':
+                            self._in_string = True
+                else:
+                    if c in "{[":
+                        self._depth += 1
+                    elif c in "}]":
+                        self._depth -= 1
+                    elif c == '"':
+                        self._in_string = True
+            elif state == "after_value":
+                if c == ",":
+                    self._state = "key"
+                elif c == "}":
+                    self.done = True
+            i += 1
+        self._pos = i
+        return events
@@ -0,0 +1,159 @@
+import json
+
+import pytest
+
+from analysis_schema import extract_json, repair_prompt, section_schema, validate_analysis
+
+
+SCENES = [
+    {"scene_start": 0, "scene_end": 60, "scene_title": "Opening", "what_happened": "The host introduces the topic."},
+    {"scene_start": 60, "scene_end": 120, "scene_title": "Demo", "what_happened": "A worked example."}
+]
+
+
+def analysis(**overrides):
+    data = {
+        "briefing": "A short talk about caching.",
+        "characters": [{"name": "Host", "role": "Presenter", "description": "Runs the show", "importance": 1}],
+        "theme_alerts": [],
+        "recaps": [],
+        "scenes": SCENES
+    }
+    data.update(overrides)
+    return data
+
+
+@pytest.mark.parametrize("text", [
+    json.dumps(analysis()),
+    "```json\n" + json.dumps(analysis()) + "\n```",
+    "Sure, here is the analysis:\n" + json.dumps(analysis()) + "\nLet me know if you need more.",
+    "[" + json.dumps(analysis()) + "]",
+    "\ufeff" + json.dumps(analysis()),
+    json.dumps(analysis())[:-1] + ",}",
+])
+def test_extract_json_finds_the_analysis(text):
+    assert extract_json(text)["briefing"] == "A short talk about caching."
+
+
+def test_extract_json_skips_nested_objects_before_the_analysis():
+    text = 'Example scene: {"scene_start": 1} and the answer: ' + json.dumps(analysis())
+    assert extract_json(text)["scenes"] == SCENES
+
+
+@pytest.mark.parametrize("text", ["", "no json here", '{"unrelated": 1}', None, 42])
+def test_extract_json_returns_none_without_an_analysis(text):
+    assert extract_json(text) is None
+
+
+def test_valid_analysis_has_no_invalid_sections():
+    cleaned, invalid = validate_analysis(analysis(), expected_scenes=2)
+    assert invalid == {}
+    assert cleaned["scenes"] == SCENES
+
+
+def test_empty_optional_sections_are_valid():
+    cleaned, invalid = validate_analysis(analysis(characters=[], theme_alerts=[], recaps=[]))
+    assert invalid == {}
+    assert cleaned["characters"] == []
+
+
+def test_entries_are_normalized_and_bad_ones_dropped():
+    data = analysis(characters=[
+        {"name": " Host ", "description": "d", "importance": "7"},
+        {"name": "", "description": "nameless"},
+        "not an object"
+    ], scenes=[
+        {"scene_start": "60s", "scene_end": "120", "what_happened": "Second"},
+        {"scene_start": 0, "scene_end": 60, "what_happened": "First"},
+        {"scene_start": 90, "scene_end": 30, "what_happened": "Backwards"}
+    ])
+    cleaned, invalid = validate_analysis(data)
+    assert invalid == {}
+    assert cleaned["characters"] == [{"name": "Host", "role": "", "description": "d", "importance": 3}]
+    assert [scene["what_happened"] for scene in cleaned["scenes"]] == ["First", "Second"]
+    assert cleaned["scenes"][1]["scene_start"] == 60.0
+
+
+def test_required_and_malformed_sections_are_flagged():
+    _, invalid = validate_analysis(analysis(briefing="  ", scenes=[], recaps="none", characters=[{"bad": 1}]))
+    assert invalid == {
+        "briefing": "missing or empty",
+        "scenes": "empty",
+        "recaps": "not a list",
+        "characters": "no valid entries"
+    }
+
+
+def test_short_scenes_are_flagged():
+    _, invalid = validate_analysis(analysis(), expected_scenes=5)
+    assert invalid == {"scenes": "2 of 5 scenes"}
+
+
+def test_only_requested_sections_are_checked():
+    cleaned, invalid = validate_analysis({"scenes": SCENES}, sections=("scenes",))
+    assert set(cleaned) == {"scenes"}
+    assert invalid == {}
+
+
+def test_repair_prompt_and_schema_cover_only_the_invalid_sections():
+    invalid = {"scenes": "2 of 5 scenes", "briefing": "missing or empty"}
+    prompt = repair_prompt("Analyze this.", invalid)
+    assert prompt.startswith("Analyze this.")
+    assert '"briefing", "scenes"' in prompt
+    assert section_schema(invalid)["propertyOrdering"] == ["briefing", "scenes"]
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """Replace call_gemini with a script of replies; records the prompts it was sent"""
+    import app
+    replies = []
+    prompts = []
+
+    def fake_call_gemini(prompt, response_schema=None, usage=None):
+        prompts.append(prompt)
+        return replies.pop(0)
+
+    monkeypatch.setattr(app, "call_gemini", fake_call_gemini)
+    monkeypatch.setattr(app, "GEMINI_REPAIR_ATTEMPTS", 1)
+    return app, replies, prompts
+
+
+def test_repair_fills_in_a_missing_section(gemini):
+    app, replies, prompts = gemini
+    replies += [json.dumps(analysis(briefing="")), json.dumps({"briefing": "Repaired."})]
+    result = app.request_analysis("Analyze this.", expected_scenes=2)
+    assert result["briefing"] == "Repaired."
+    assert len(prompts) == 2
+
+
+def test_short_scenes_are_kept_once_repairs_run_out(gemini):
+    app, replies, prompts = gemini
+    short = json.dumps(analysis(scenes=SCENES[:1]))
+    replies += [short, json.dumps({"scenes": SCENES[:1]})]
+    result = app.request_analysis("Analyze this.", expected_scenes=4)
+    assert "error" not in result
+    assert result["scenes"] == SCENES[:1]
+    assert len(prompts) == 2
+
+
+def test_repair_keeps_the_longer_scene_list(gemini):
+    app, replies, _ = gemini
+    replies += [json.dumps(analysis(scenes=SCENES)), json.dumps({"scenes": SCENES[:1]})]
+    result = app.request_analysis("Analyze this.", expected_scenes=4)
+    assert result["scenes"] == SCENES
+
+
+def test_empty_scenes_after_repair_are_an_error(gemini):
+    app, replies, _ = gemini
+    replies += [json.dumps(analysis(scenes=[])), json.dumps({"scenes": []})]
+    result = app.request_analysis("Analyze this.", expected_scenes=2)
+    assert result == {"error": "Gemini returned an unusable analysis: scenes empty"}
+
+
+def test_gemini_errors_during_repair_keep_what_was_usable(gemini):
+    app, replies, _ = gemini
+    replies += [json.dumps(analysis(characters=[{"bad": 1}])), {"error": "Gemini API error"}]
+    result = app.request_analysis("Analyze this.", expected_scenes=2)
+    assert result["characters"] == []
+    assert result["scenes"] == SCENES
@@ -0,0 +1,58 @@
+import json
+
+from catalog import Catalog
+
+
+def movie(movie_id):
+    return {"id": movie_id, "title": movie_id.title()}
+
+
+MOVIES = {
+    "action": [movie("a1"), movie("a2"), movie("a3"), movie("a4")],
+    "comedy": [movie("c1"), movie("c2")],
+    "horror": [movie("h1"), movie("h2"), movie("h3")]
+}
+
+
+def recommended(catalog, score):
+    body, _ = catalog.recommendations(score)
+    return {genre: m["id"] for genre, m in json.loads(body)["recommendations"].items()}
+
+
+def test_level_picks_the_same_position_in_every_genre():
+    catalog = Catalog(MOVIES)
+    assert recommended(catalog, 1.0) == {"action": "a1", "comedy": "c1", "horror": "h1"}
+    assert recommended(catalog, 2.7) == {"action": "a2", "comedy": "c2", "horror": "h2"}
+
+
+def test_levels_past_a_short_genre_fall_back_to_first_movies():
+    catalog = Catalog(MOVIES)
+    first = {"action": "a1", "comedy": "c1", "horror": "h1"}
+    assert recommended(catalog, 3.0) == first
+    assert recommended(catalog, 100.0) == first
+    assert recommended(catalog, 0.2) == first
+
+
+def test_browse_rows_leave_out_the_recommended_movie():
+    body, _ = Catalog(MOVIES).recommendations(2.0)
+    genres = json.loads(body)["genres"]
+    assert [m["id"] for m in genres["comedy"]] == ["c1"]
+    assert [m["id"] for m in genres["action"]] == ["a1", "a3", "a4"]
+
+
+def test_body_carries_the_score_and_etag_tracks_the_body():
+    catalog = Catalog(MOVIES)
+    body, etag = catalog.recommendations(1.5)
+    assert json.loads(body)["complexity_score"] == 1.5
+    assert catalog.recommendations(1.5)[1] == etag
+    assert catalog.recommendations(1.7)[1] != etag
+    assert catalog.recommendations(2.0)[1] != catalog.recommendations(1.0)[1]
+
+
+def test_details_are_looked_up_by_id():
+    catalog = Catalog(MOVIES)
+    assert catalog.get("c2") == (movie("c2"), "comedy")
+    assert catalog.title("h3") == "H3"
+    assert catalog.get("missing") is None
+    body, _ = catalog.details["a1"]
+    assert json.loads(body) == {"genre": "action", "movie": movie("a1"), "status": "success"}
@@ -0,0 +1,32 @@
+import pytest
+
+
+@pytest.fixture
+def client(fresh_db):
+    import app
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize("origin", ["https://klarity-frontend.vercel.app", "http://localhost:3000"])
+def test_frontend_origins_can_read_the_etag(client, origin):
+    response = client.get("/get_recommendations", headers={"Origin": origin})
+    assert response.headers["Access-Control-Allow-Origin"] == origin
+    exposed = [h.strip().lower() for h in response.headers["Access-Control-Expose-Headers"].split(",")]
+    assert "etag" in exposed
+    assert response.headers["ETag"]
+
+
+@pytest.mark.parametrize("origin", ["https://klarity-frontend.vercel.app", "http://localhost:3000"])
+def test_frontend_origins_may_send_if_none_match(client, origin):
+    response = client.options("/process_video_stream", headers={
+        "Origin": origin,
+        "Access-Control-Request-Method": "POST",
+        "Access-Control-Request-Headers": "content-type, if-none-match"
+    })
+    allowed = response.headers["Access-Control-Allow-Headers"].lower()
+    assert "if-none-match" in allowed
+
+
+def test_other_origins_are_not_allowed(client):
+    response = client.get("/get_recommendations", headers={"Origin": "https://example.com"})
+    assert "Access-Control-Allow-Origin" not in response.headers
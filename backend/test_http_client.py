@@ -0,0 +1,142 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from http_client import HttpClient, RetryPolicy, UpstreamError
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers each request with the next (status, headers) in the server's script, then 200s"""
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits += 1
+            status, headers = self.server.script.pop(0) if self.server.script else (200, {})
+        body = b"x" * 64
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.script = []
+    server.hits = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(limit=1, max_attempts=3):
+    sleeps = []
+    client = HttpClient(default_limit=limit, policy=RetryPolicy(max_attempts=max_attempts, base_delay=0.5),
+                        acquire_timeout=0.2, sleep=sleeps.append)
+    return client, sleeps
+
+
+def test_buffered_responses_release_the_host_slot(stub):
+    _, url = stub
+    client, _ = make_client(limit=1)
+    for _ in range(3):
+        assert client.get(url, timeout=5).status_code == 200
+
+
+def test_streamed_response_holds_the_host_slot_until_closed(stub):
+    _, url = stub
+    client, _ = make_client(limit=1)
+    response = client.get(url, timeout=5, stream=True)
+    with pytest.raises(UpstreamError) as info:
+        client.get(url, timeout=5)
+    assert info.value.reason == "concurrency_limit"
+
+    response.close()
+    response.close()
+    assert client.get(url, timeout=5).status_code == 200
+    # Closing twice must not free a second slot
+    held = client.get(url, timeout=5, stream=True)
+    with pytest.raises(UpstreamError):
+        client.get(url, timeout=5)
+    held.close()
+
+
+def test_streamed_response_as_context_manager_releases_the_slot(stub):
+    _, url = stub
+    client, _ = make_client(limit=1)
+    with client.get(url, timeout=5, stream=True) as response:
+        assert response.status_code == 200
+    assert client.get(url, timeout=5).status_code == 200
+
+
+def test_retries_server_errors_then_succeeds(stub):
+    server, url = stub
+    server.script = [(503, {}), (502, {})]
+    client, sleeps = make_client(limit=1)
+    assert client.get(url, timeout=5).status_code == 200
+    assert server.hits == 3
+    assert len(sleeps) == 2
+    assert all(0 <= s <= 1.0 for s in sleeps)
+
+
+def test_streamed_retries_do_not_leak_slots(stub):
+    server, url = stub
+    server.script = [(503, {}), (503, {})]
+    client, _ = make_client(limit=1)
+    with client.get(url, timeout=5, stream=True) as response:
+        assert response.status_code == 200
+    assert client.get(url, timeout=5).status_code == 200
+
+
+def test_retry_after_is_honoured(stub):
+    server, url = stub
+    server.script = [(429, {"Retry-After": "2"})]
+    client, sleeps = make_client(limit=1)
+    assert client.get(url, timeout=5).status_code == 200
+    assert sleeps == [2.0]
+
+
+def test_gives_up_after_max_attempts(stub):
+    server, url = stub
+    server.script = [(500, {})] * 5
+    client, sleeps = make_client(limit=1, max_attempts=3)
+    with pytest.raises(UpstreamError) as info:
+        client.get(url, timeout=5)
+    assert info.value.reason == "server_error"
+    assert info.value.status_code == 500
+    assert info.value.attempts == 3
+    assert server.hits == 3
+    assert len(sleeps) == 2
+
+
+def test_client_errors_are_returned_without_retrying(stub):
+    server, url = stub
+    server.script = [(404, {})]
+    client, sleeps = make_client(limit=1)
+    assert client.get(url, timeout=5).status_code == 404
+    assert server.hits == 1
+    assert sleeps == []
+
+
+def test_connection_errors_are_reported(stub):
+    server, url = stub
+    server.shutdown()
+    server.server_close()
+    client, _ = make_client(limit=1, max_attempts=2)
+    with pytest.raises(UpstreamError) as info:
+        client.get(url, timeout=2)
+    assert info.value.reason == "connection"
+    assert info.value.attempts == 2
+    # The failed attempts must not have kept the slot
+    with pytest.raises(UpstreamError) as info:
+        client.get(url, timeout=2)
+    assert info.value.reason == "connection"
@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+from db import transaction
+from jobs import STAGE_DONE, STAGE_ERROR, STAGE_QUEUED, JobManager
+
+
+def wait_for(manager, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = manager.get(job_id)
+        if job.status in (STAGE_DONE, STAGE_ERROR):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def expire(job_id):
+    """Make a job look like its worker died"""
+    with transaction() as conn:
+        conn.execute("UPDATE analysis_jobs SET owner = 'gone', lease_expires_at = 0 WHERE job_id = ?", (job_id,))
+
+
+def test_jobs_run_and_report_their_result(fresh_db):
+    manager = JobManager(lambda job: {"video_id": job.video_id, **job.params})
+    job = manager.submit("abc", "user", {"complexity_score": 1.5})
+    done = wait_for(manager, job.job_id)
+    assert done.result == {"video_id": "abc", "complexity_score": 1.5}
+    assert manager.stats()["jobs"] == {STAGE_DONE: 1}
+
+
+def test_failures_are_recorded_with_their_status_code(fresh_db):
+    class Boom(Exception):
+        status_code = 400
+
+    def run(job):
+        raise Boom("no transcript")
+
+    manager = JobManager(run)
+    job = wait_for(manager, manager.submit("abc", "user").job_id)
+    assert (job.status, job.error, job.status_code) == (STAGE_ERROR, "no transcript", 400)
+
+
+def test_other_workers_see_the_job(fresh_db):
+    release = threading.Event()
+    runner = JobManager(lambda job: release.wait(5) and "ok")
+    job = runner.submit("abc", "user")
+    observer = JobManager(lambda job: "not me")
+    assert observer.get(job.job_id).status == STAGE_QUEUED
+    release.set()
+    assert wait_for(observer, job.job_id).result == "ok"
+
+
+def test_abandoned_jobs_are_run_again(fresh_db):
+    release = threading.Event()
+    stalled = JobManager(lambda job: release.wait(5) and "stalled", lease_seconds=3600)
+    job = stalled.submit("abc", "user")
+    expire(job.job_id)
+
+    rescuer = JobManager(lambda job: "rescued", lease_seconds=3600)
+    done = wait_for(rescuer, job.job_id)
+    assert done.result == "rescued"
+    assert done.attempts == 2
+    release.set()
+
+
+def test_jobs_interrupted_too_often_fail(fresh_db):
+    manager = JobManager(lambda job: "ok", max_attempts=1)
+    job = wait_for(manager, manager.submit("abc", "user").job_id)
+    with transaction() as conn:
+        conn.execute("UPDATE analysis_jobs SET status = ? WHERE job_id = ?", (STAGE_QUEUED, job.job_id))
+    expire(job.job_id)
+    job = manager.get(job.job_id)
+    assert job.status == STAGE_ERROR
+    assert job.status_code == 500
+
+
+def test_recovery_with_a_full_queue_leaves_the_job_for_another_worker(fresh_db):
+    # No worker threads, so the single queue slot stays taken
+    busy = JobManager(lambda job: "busy", max_workers=0, max_queue=1, lease_seconds=3600)
+    busy.submit("filler", "user")
+    orphan = JobManager(lambda job: "orphan", max_workers=0, lease_seconds=3600).submit("abc", "user")
+    expire(orphan.job_id)
+
+    job = busy.get(orphan.job_id)
+    assert job.status == STAGE_QUEUED
+    assert job.attempts == 1
+    # The busy worker's heartbeat must not keep the job it couldn't queue alive
+    busy._renew_leases()
+
+    rescuer = JobManager(lambda job: "rescued", lease_seconds=3600)
+    done = wait_for(rescuer, orphan.job_id)
+    assert done.result == "rescued"
+    assert done.attempts == 2
@@ -0,0 +1,158 @@
+import pytest
+
+from db import transaction
+from rate_limiter import BATCH, INTERACTIVE, FakeClock, RateLimitTimeout, TokenBucketLimiter
+
+
+class RecordingClock(FakeClock):
+    """FakeClock that remembers how long each sleep was"""
+
+    def __init__(self):
+        super().__init__()
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        super().sleep(seconds)
+
+
+def make_limiter(rpm=60, tpm=60000, **kwargs):
+    clock = RecordingClock()
+    return TokenBucketLimiter("test", rpm, tpm, clock=clock, **kwargs), clock
+
+
+def drain(limiter, lane=INTERACTIVE):
+    for _ in range(int(limiter.request_capacity)):
+        assert limiter.acquire(lane=lane) == 0
+
+
+def add_waiter(limiter, lane, now):
+    """Queue a caller from another process that never gets around to polling"""
+    with transaction() as conn:
+        return conn.execute("""
+            INSERT INTO rate_limit_waiters (limiter, lane, enqueued_at, expires_at) VALUES (?, ?, ?, ?)
+        """, (limiter.name, lane, now, now + 3600)).lastrowid
+
+
+def waiters(limiter):
+    with transaction() as conn:
+        return conn.execute("SELECT COUNT(*) FROM rate_limit_waiters WHERE limiter = ?",
+                            (limiter.name,)).fetchone()[0]
+
+
+def test_burst_up_to_capacity_then_waits_for_refill(fresh_db):
+    limiter, clock = make_limiter(rpm=60)
+    drain(limiter)
+    # One request refills every second
+    assert limiter.acquire() == pytest.approx(1.0)
+    assert waiters(limiter) == 0
+
+
+def test_buckets_refill_over_time(fresh_db):
+    limiter, clock = make_limiter(rpm=60)
+    drain(limiter)
+    clock.advance(30)
+    for _ in range(30):
+        assert limiter.acquire() == 0
+    assert limiter.acquire() > 0
+
+
+def test_refill_is_capped_at_capacity(fresh_db):
+    limiter, clock = make_limiter(rpm=10)
+    drain(limiter)
+    clock.advance(3600)
+    drain(limiter)
+    assert limiter.acquire() > 0
+
+
+def test_token_bucket_limits_large_prompts(fresh_db):
+    limiter, clock = make_limiter(rpm=600, tpm=1000)
+    assert limiter.acquire(tokens=600) == 0
+    # 200 more tokens at 1000 per minute
+    assert limiter.acquire(tokens=600) == pytest.approx(12.0)
+
+
+def test_head_sleeps_until_capacity_instead_of_polling(fresh_db):
+    limiter, clock = make_limiter(rpm=6, max_sleep=60)
+    drain(limiter)
+    assert limiter.acquire() == pytest.approx(10.0)
+    assert clock.sleeps == [pytest.approx(10.0)]
+
+
+def test_timeout_gives_up_early_and_leaves_the_queue(fresh_db):
+    limiter, clock = make_limiter(rpm=6)
+    drain(limiter)
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(timeout=5)
+    # The refill was 10s away, so there was no point sleeping first
+    assert clock.sleeps == []
+    assert waiters(limiter) == 0
+    assert limiter.stats()["lanes"]["interactive"]["timeouts"] == 1
+
+
+def test_batch_lane_leaves_headroom_for_interactive(fresh_db):
+    limiter, clock = make_limiter(rpm=10, batch_reserve=0.2)
+    for _ in range(8):
+        assert limiter.acquire(lane=BATCH) == 0
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(lane=BATCH, timeout=1)
+    for _ in range(2):
+        assert limiter.acquire(lane=INTERACTIVE) == 0
+
+
+def test_interactive_waiters_go_ahead_of_earlier_batch_waiters(fresh_db):
+    limiter, clock = make_limiter(rpm=60, batch_reserve=0)
+    drain(limiter)
+    add_waiter(limiter, BATCH, clock.time())
+    assert limiter.acquire(lane=INTERACTIVE) == pytest.approx(1.0)
+    assert waiters(limiter) == 1
+
+
+def test_waiters_behind_the_head_back_off_and_only_read(fresh_db, monkeypatch):
+    limiter, clock = make_limiter(rpm=60, poll_interval=0.05, max_sleep=1.0)
+    add_waiter(limiter, INTERACTIVE, clock.time())
+    writes = []
+    original = limiter._try_acquire
+
+    def counting(*args):
+        writes.append(args)
+        return original(*args)
+
+    monkeypatch.setattr(limiter, "_try_acquire", counting)
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(lane=BATCH, timeout=10)
+    # Joining the queue is the only write; everything after it was a read
+    assert len(writes) == 1
+    assert clock.sleeps == sorted(clock.sleeps)
+    assert clock.sleeps[-1] == 1.0
+    assert len(clock.sleeps) < 20
+    assert waiters(limiter) == 1
+
+
+def test_long_waits_keep_the_queue_entry_alive(fresh_db, monkeypatch):
+    limiter, clock = make_limiter(rpm=60, waiter_ttl=3)
+    add_waiter(limiter, INTERACTIVE, clock.time())
+    ids = []
+    original = limiter._try_acquire
+
+    def recording(*args):
+        result = original(*args)
+        ids.append(result[0])
+        return result
+
+    monkeypatch.setattr(limiter, "_try_acquire", recording)
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(lane=BATCH, timeout=10)
+    # Refreshed about once a second, and never lost its place in the queue
+    assert len(ids) > 3
+    assert len(set(ids)) == 1
+
+
+def test_stats_report_waits_per_lane(fresh_db):
+    limiter, clock = make_limiter(rpm=60)
+    drain(limiter)
+    limiter.acquire()
+    lanes = limiter.stats()["lanes"]
+    assert lanes["interactive"]["acquired"] == 61
+    assert lanes["interactive"]["max_wait_seconds"] == pytest.approx(1.0)
+    assert lanes["batch"]["acquired"] == 0
@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+from singleflight import DbSingleFlight, LeaderFailed, SingleFlight
+
+
+class Upstream(Exception):
+    status_code = 503
+
+
+def start_leader(flight, key, fn):
+    """Run ``flight.do`` on a thread and wait until it holds the lock"""
+    outcome = {}
+    started = threading.Event()
+
+    def lead():
+        def work():
+            started.set()
+            return fn()
+        try:
+            outcome["result"] = flight.do(key, work, lambda: None)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    assert started.wait(5)
+    return thread, outcome
+
+
+def test_in_process_callers_share_one_run():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return "done"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", work))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while flight.coalesced < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == [1]
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+
+
+def test_followers_get_the_leaders_stored_result(fresh_db):
+    flight = DbSingleFlight(poll_interval=0.01)
+    release = threading.Event()
+    stored = {}
+
+    def work():
+        release.wait(5)
+        stored["k"] = "analysis"
+        return "analysis"
+
+    thread, outcome = start_leader(flight, "k", work)
+    follower = threading.Thread(target=lambda: outcome.setdefault(
+        "follower", flight.do("k", lambda: "ran again", lambda: stored.get("k"))))
+    follower.start()
+    while flight.coalesced < 1:
+        time.sleep(0.01)
+    release.set()
+    thread.join()
+    follower.join()
+    assert outcome["result"] == ("analysis", False)
+    assert outcome["follower"] == ("analysis", True)
+
+
+def test_followers_get_the_leaders_failure_instead_of_rerunning(fresh_db):
+    flight = DbSingleFlight(poll_interval=0.01, failure_ttl=60)
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise Upstream("Gemini is rate limiting us")
+
+    thread, outcome = start_leader(flight, "k", fail)
+    reruns = []
+    errors = []
+
+    def follow():
+        try:
+            flight.do("k", lambda: reruns.append(1), lambda: None)
+        except LeaderFailed as e:
+            errors.append(e)
+
+    followers = [threading.Thread(target=follow) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while flight.coalesced < 3:
+        time.sleep(0.01)
+    release.set()
+    thread.join()
+    for follower in followers:
+        follower.join()
+
+    assert isinstance(outcome["error"], Upstream)
+    assert reruns == []
+    assert [(str(e), e.status_code) for e in errors] == [("Gemini is rate limiting us", 503)] * 3
+    assert flight.stats()["shared_failures"] == 3
+
+
+def test_a_failure_is_only_remembered_for_failure_ttl(fresh_db):
+    flight = DbSingleFlight(poll_interval=0.01, failure_ttl=0.2)
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        flight.do("k", fail, lambda: None)
+    with pytest.raises(LeaderFailed) as info:
+        flight.do("k", lambda: "fresh", lambda: None)
+    assert info.value.status_code == 500
+
+    time.sleep(0.25)
+    assert flight.do("k", lambda: "fresh", lambda: None) == ("fresh", False)
+    # Success leaves nothing behind
+    assert flight.do("k", lambda: "again", lambda: None) == ("again", False)
@@ -0,0 +1,103 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from log import get_logger
+
+
+log = get_logger("title_resolver")
+
+
+class TitleResolver:
+    """Deduplicating background resolver for video titles.
+
+    ``request`` queues video ids and returns immediately. A single
+    dispatcher thread drains the queue in batches of up to ``batch_size``,
+    resolves each batch with ``max_workers`` concurrent ``resolve`` calls
+    and hands all the results to ``write_back`` at once, so a batch costs
+    one database transaction. Ids already queued or being resolved are
+    not queued again.
+    """
+
+    def __init__(self, resolve, write_back, max_workers=8, batch_size=32):
+        self.resolve = resolve
+        self.write_back = write_back
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self._pending = []
+        self._known = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self.resolved = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.batches = 0
+
+    def _start(self):
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="title-resolver")
+            self._thread = threading.Thread(target=self._dispatch, name="title-dispatcher", daemon=True)
+            self._thread.start()
+
+    def request(self, video_ids):
+        """Queue ids for resolution; returns how many were newly queued"""
+        queued = 0
+        with self._cond:
+            self._start()
+            for video_id in video_ids:
+                if video_id in self._known:
+                    self.deduplicated += 1
+                    continue
+                self._known.add(video_id)
+                self._pending.append(video_id)
+                queued += 1
+            if queued:
+                self._cond.notify()
+        return queued
+
+    def _resolve_one(self, video_id):
+        try:
+            return video_id, self.resolve(video_id)
+        except Exception as e:
+            log.error("Error resolving title for %s: %s", video_id, e)
+            return video_id, None
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+
+            results = list(self._executor.map(self._resolve_one, batch))
+            titles = {video_id: title for video_id, title in results if title}
+            try:
+                if titles:
+                    self.write_back(titles)
+            except Exception as e:
+                log.error("Error writing back %d titles: %s", len(titles), e)
+                titles = {}
+            finally:
+                with self._cond:
+                    self._known.difference_update(batch)
+                    self.batches += 1
+                    self.resolved += len(titles)
+                    self.failed += len(batch) - len(titles)
+                    self._cond.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Block until nothing is queued or in flight; returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._known, timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._pending),
+                "in_flight": len(self._known) - len(self._pending),
+                "resolved": self.resolved,
+                "failed": self.failed,
+                "deduplicated": self.deduplicated,
+                "batches": self.batches
+            }
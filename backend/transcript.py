@@ -0,0 +1,108 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Rough characters-per-token ratio used for token-based windows
+CHARS_PER_TOKEN = 4
+
+
+class Transcript:
+    """Array-backed transcript.
+
+    Start times and durations live in typed arrays (NumPy when available)
+    and all entry texts live in one space-separated buffer with offsets, so
+    the text of any run of entries is a single slice. Entry ``i`` spans
+    ``text[offsets[i]:offsets[i + 1] - 1]``.
+    """
+
+    __slots__ = ("starts", "durations", "text", "offsets")
+
+    def __init__(self, starts, durations, text, offsets):
+        self.starts = starts
+        self.durations = durations
+        self.text = text
+        self.offsets = offsets
+
+    @classmethod
+    def from_arrays(cls, texts, starts, durations):
+        texts = list(texts)
+        text = " ".join(texts)
+        lengths = [len(t) + 1 for t in texts]
+        if np is not None:
+            offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            return cls(np.asarray(starts, dtype=np.float64), np.asarray(durations, dtype=np.float64), text, offsets)
+        offsets = array("q", [0])
+        offsets.extend(accumulate(lengths))
+        return cls(array("d", starts), array("d", durations), text, offsets)
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Build from YouTubeTranscriptApi-style [{"text", "start", "duration"}] entries"""
+        if isinstance(entries, cls):
+            return entries
+        return cls.from_arrays(
+            [e["text"] for e in entries],
+            [e["start"] for e in entries],
+            [e["duration"] for e in entries]
+        )
+
+    def __len__(self):
+        return len(self.starts)
+
+    def entry_text(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1] - 1]
+
+    def texts(self):
+        return [self.entry_text(i) for i in range(len(self))]
+
+    def to_entries(self):
+        return [{"text": self.entry_text(i), "start": float(self.starts[i]), "duration": float(self.durations[i])}
+                for i in range(len(self))]
+
+    def _chunks(self, bounds):
+        chunks = []
+        for first, stop in zip(bounds, bounds[1:]):
+            last = stop - 1
+            chunks.append({
+                "start": float(self.starts[first]),
+                "end": float(self.starts[last] + self.durations[last]),
+                "text": self.text[int(self.offsets[first]):int(self.offsets[stop]) - 1]
+            })
+        return chunks
+
+    def chunk_by_time(self, chunk_duration=150):
+        """Split into windows of ``chunk_duration`` seconds of real start time"""
+        n = len(self)
+        if n == 0:
+            return []
+        first_start = float(self.starts[0])
+        last_start = float(self.starts[n - 1])
+        edge_count = int((last_start - first_start) // chunk_duration)
+        if np is not None:
+            edges = first_start + chunk_duration * np.arange(1, edge_count + 1)
+            cuts = np.unique(np.searchsorted(self.starts, edges, side="left")).tolist()
+        else:
+            cuts = sorted({bisect_left(self.starts, first_start + chunk_duration * k) for k in range(1, edge_count + 1)})
+        return self._chunks([0] + [c for c in cuts if 0 < c < n] + [n])
+
+    def chunk_by_tokens(self, max_tokens=1000):
+        """Split into windows of roughly ``max_tokens`` estimated tokens each"""
+        n = len(self)
+        if n == 0:
+            return []
+        if np is not None:
+            tokens = np.cumsum((np.diff(self.offsets) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+            edges = max_tokens * np.arange(1, int(tokens[-1] // max_tokens) + 1)
+            cuts = np.unique(np.searchsorted(tokens, edges, side="right")).tolist()
+        else:
+            lengths = (self.offsets[i + 1] - self.offsets[i] for i in range(n))
+            tokens = list(accumulate((length + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN for length in lengths))
+            cuts = sorted({bisect_right(tokens, max_tokens * k) for k in range(1, tokens[-1] // max_tokens + 1)})
+        return self._chunks([0] + [c for c in cuts if 0 < c < n] + [n])
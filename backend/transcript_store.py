@@ -0,0 +1,68 @@
+import sys
+import time
+import zlib
+from array import array
+
+from db import transaction, query_one
+from transcript import Transcript
+
+
+# Entry texts are joined with a separator that can't appear in captions
+TEXT_SEPARATOR = "\x00"
+
+
+def _pack_floats(values):
+    packed = array("d", values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return zlib.compress(packed.tobytes())
+
+
+def _unpack_floats(blob):
+    values = array("d")
+    values.frombytes(zlib.decompress(blob))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def pack_transcript(transcript):
+    """Pack a Transcript (or list of entries) into (text, starts, durations) compressed blobs"""
+    transcript = Transcript.from_entries(transcript)
+    text = TEXT_SEPARATOR.join(t.replace(TEXT_SEPARATOR, " ") for t in transcript.texts())
+    return (
+        zlib.compress(text.encode("utf-8")),
+        _pack_floats(transcript.starts),
+        _pack_floats(transcript.durations)
+    )
+
+
+def unpack_transcript(text_blob, starts_blob, durations_blob):
+    """Inverse of pack_transcript: returns a Transcript"""
+    text = zlib.decompress(text_blob).decode("utf-8")
+    texts = text.split(TEXT_SEPARATOR) if text else []
+    return Transcript.from_arrays(texts, _unpack_floats(starts_blob), _unpack_floats(durations_blob))
+
+
+def save_transcript(video_id, transcript, language="en"):
+    text_blob, starts_blob, durations_blob = pack_transcript(transcript)
+    with transaction() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO transcripts
+            (video_id, language, entry_count, text_blob, starts_blob, durations_blob, fetched_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (video_id, language, len(transcript), text_blob, starts_blob, durations_blob, time.time()))
+
+
+def load_transcript(video_id, language="en", max_age=None):
+    """Return the stored Transcript, or None if missing or older than ``max_age`` seconds"""
+    row = query_one("""
+        SELECT text_blob, starts_blob, durations_blob, fetched_at
+        FROM transcripts
+        WHERE video_id = ? AND language = ?
+    """, (video_id, language))
+    if row is None:
+        return None
+    if max_age is not None and time.time() - row[3] > max_age:
+        return None
+    return unpack_transcript(row[0], row[1], row[2])
@@ -0,0 +1,132 @@
+"""Pre-warm video_cache for a list of YouTube URLs or video ids.
+
+Usage:
+    python warm_cache.py urls.txt --workers 4
+    cat urls.txt | python warm_cache.py -
+
+Gemini calls run in the batch lane of the shared rate limiter, so warm-up
+work yields to interactive /process_video traffic. Each video is analyzed
+under the same cross-worker lock as live requests, so a video being
+analyzed for a user is waited for rather than analyzed twice, and each
+analysis is cached as soon as it is done.
+
+Ids that already have an up-to-date analysis are skipped, so an
+interrupted run can simply be started again. Videos that failed are
+recorded in the state file and skipped on later runs unless
+--retry-failed is given.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import app
+from rate_limiter import BATCH, use_lane
+
+
+def read_video_ids(lines):
+    """Extract video ids from URLs (or bare ids), dropping blanks, comments and duplicates"""
+    seen = set()
+    ids = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        video_id = app.get_video_id(line) if ("/" in line or "." in line) else line
+        if video_id and video_id not in seen:
+            seen.add(video_id)
+            ids.append(video_id)
+    return ids
+
+
+def load_state(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"failed": {}}
+
+
+def save_state(path, state):
+    if not path:
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def analyze(video_id):
+    """Fetch, analyze and cache one video, or wait for the worker already doing so.
+
+    Downloaded transcripts are stored too. Raises VideoProcessingError or
+    CoalescingTimeout on failure.
+    """
+    with use_lane(BATCH):
+        result, _ = app.video_db_flight.do(
+            video_id,
+            lambda: app.run_analysis(video_id, 1.0, lambda stage: None),
+            lambda: app.get_cached_analysis(video_id)
+        )
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-warm the video analysis cache")
+    parser.add_argument("input", nargs="?", default="-", help="file with one URL or video id per line, or - for stdin")
+    parser.add_argument("--workers", type=int, default=4, help="videos processed in parallel")
+    parser.add_argument("--state-file", default=".warm_cache_state.json", help="where failures are recorded between runs")
+    parser.add_argument("--retry-failed", action="store_true", help="retry ids that failed on a previous run")
+    args = parser.parse_args(argv)
+
+    if args.input == "-":
+        video_ids = read_video_ids(sys.stdin)
+    else:
+        with open(args.input) as f:
+            video_ids = read_video_ids(f)
+
+    state = load_state(args.state_file)
+    already_cached = app.cached_video_ids(video_ids)
+    todo = [v for v in video_ids if v not in already_cached
+            and (args.retry_failed or v not in state["failed"])]
+    print(f"{len(video_ids)} ids: {len(already_cached)} already cached, "
+          f"{len(video_ids) - len(already_cached) - len(todo)} previously failed, {len(todo)} to process")
+
+    done = 0
+    failed = 0
+    started = time.monotonic()
+
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        futures = {executor.submit(analyze, video_id): video_id for video_id in todo}
+        for future in as_completed(futures):
+            video_id = futures[future]
+            try:
+                future.result()
+                state["failed"].pop(video_id, None)
+                done += 1
+            except Exception as e:
+                state["failed"][video_id] = str(e)
+                failed += 1
+                print(f"FAILED {video_id}: {e}")
+            finished = done + failed
+            if finished % 10 == 0 or finished == len(todo):
+                save_state(args.state_file, state)
+                print(f"[{finished}/{len(todo)}] ok={done} failed={failed}")
+    except KeyboardInterrupt:
+        print("Interrupted; finished analyses are already cached")
+        executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        save_state(args.state_file, state)
+        executor.shutdown(wait=False)
+
+    elapsed = time.monotonic() - started
+    rate = done / elapsed * 60 if elapsed > 0 else 0.0
+    print(f"Done in {elapsed:.1f}s: {done} cached, {failed} failed, "
+          f"{len(already_cached)} skipped ({rate:.1f} videos/min)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
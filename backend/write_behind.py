@@ -0,0 +1,156 @@
+import threading
+
+from log import get_logger
+
+
+log = get_logger("write_behind")
+
+
+def keep_latest(old, new):
+    return new
+
+
+class WriteBehindBuffer:
+    """Coalescing write-behind buffer for small, frequent database writes.
+
+    Writes are queued under a (kind, key) pair; a later write to the same
+    pair is folded into the pending one with that kind's ``merge``
+    function (the latest value wins by default). A daemon thread hands
+    everything pending to ``flush_fn({kind: [(key, value), ...]})`` every
+    ``flush_interval`` seconds, or sooner once ``max_batch`` entries are
+    pending, so each flush is one transaction.
+
+    At most ``max_pending`` entries are buffered. Past that, ``put``
+    waits up to ``max_wait`` seconds for a flush and then flushes in the
+    caller's thread, so writes slow down instead of piling up. A failed
+    flush puts its entries back to be retried on the next one.
+    """
+
+    def __init__(self, flush_fn, flush_interval=0.2, max_batch=200, max_pending=5000, max_wait=1.0):
+        self.flush_fn = flush_fn
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self._merges = {}
+        self._pending = {}
+        self._count = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed_entries = 0
+        self.flush_errors = 0
+        self.backpressure_waits = 0
+
+    def register(self, kind, merge=keep_latest):
+        """Declare a kind of write and how two pending writes for one key combine"""
+        self._merges[kind] = merge
+        self._pending.setdefault(kind, {})
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _add(self, kind, key, value):
+        """Fold one entry into the pending set; caller holds the condition"""
+        entries = self._pending[kind]
+        if key in entries:
+            entries[key] = self._merges[kind](entries[key], value)
+            return False
+        entries[key] = value
+        self._count += 1
+        return True
+
+    def put(self, kind, key, value):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind buffer is closed")
+            self._start()
+            self.writes += 1
+            if key in self._pending[kind]:
+                self.coalesced += 1
+                self._add(kind, key, value)
+                return
+            if self._count >= self.max_pending:
+                self.backpressure_waits += 1
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: self._count < self.max_pending, self.max_wait)
+            self._add(kind, key, value)
+            full = self._count >= self.max_pending
+            if self._count >= self.max_batch:
+                self._cond.notify_all()
+        if full:
+            self.flush()
+
+    def pending(self, kind, key):
+        """The not-yet-flushed value for ``key``, or None"""
+        with self._cond:
+            return self._pending[kind].get(key)
+
+    def flush(self):
+        """Write everything pending now; returns the number of entries written"""
+        with self._flush_lock:
+            with self._cond:
+                if not self._count:
+                    return 0
+                batch = {kind: list(entries.items()) for kind, entries in self._pending.items() if entries}
+                for entries in self._pending.values():
+                    entries.clear()
+                count = self._count
+                self._count = 0
+                self._cond.notify_all()
+            try:
+                self.flush_fn(batch)
+            except Exception as e:
+                log.error("Write-behind flush of %d entries failed, will retry: %s", count, e)
+                with self._cond:
+                    self.flush_errors += 1
+                    # Entries written since are newer, so they are merged on top
+                    for kind, entries in batch.items():
+                        newer = self._pending[kind]
+                        self._pending[kind] = {}
+                        self._count -= len(newer)
+                        for key, value in entries:
+                            self._add(kind, key, value)
+                        for key, value in newer.items():
+                            self._add(kind, key, value)
+                return 0
+            with self._cond:
+                self.flushes += 1
+                self.flushed_entries += count
+            return count
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._count >= self.max_batch, self.flush_interval)
+                if self._closed:
+                    return
+            self.flush()
+
+    def close(self):
+        """Stop the flush thread and write out whatever is still pending"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": self._count,
+                "max_pending": self.max_pending,
+                "writes": self.writes,
+                "coalesced": self.coalesced,
+                "flushes": self.flushes,
+                "flushed_entries": self.flushed_entries,
+                "flush_errors": self.flush_errors,
+                "backpressure_waits": self.backpressure_waits
+            }
@@ -0,0 +1,144 @@
+import html
+import json
+import re
+import threading
+from urllib.parse import quote
+
+from http_client import http_client
+from log import get_logger
+
+
+log = get_logger("youtube_title")
+
+
+OEMBED_URL = "https://www.youtube.com/oembed?url={watch_url}&format=json"
+WATCH_URL = "https://www.youtube.com/watch?v={video_id}"
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# Both patterns work on raw bytes so chunks never need decoding up front
+TITLE_TAG_RE = re.compile(rb"<title[^>]*>([^<]*)</title>", re.IGNORECASE)
+JSON_TITLE_RE = re.compile(rb'"title":"((?:[^"\\]|\\.)*)"')
+# Longest match we expect to span a chunk boundary
+MAX_MATCH_BYTES = 4096
+
+
+def _clean_tag_title(raw):
+    title = html.unescape(raw.decode("utf-8", "replace")).strip()
+    if title.endswith(" - YouTube"):
+        title = title[:-len(" - YouTube")].strip()
+    # Consent and error pages are titled just "YouTube"
+    return None if title in ("", "YouTube") else title
+
+
+def _clean_json_title(raw):
+    try:
+        title = json.loads(b'"' + raw + b'"')
+    except ValueError:
+        return None
+    return title.strip() or None
+
+
+class TitleMatcher:
+    """Incremental matcher for a title in a stream of HTML chunks.
+
+    ``feed`` returns the title as soon as a ``<title>`` tag or a
+    ``"title":"..."`` JSON field has been seen, whichever comes first, and
+    None while more input is needed. Only the last ``MAX_MATCH_BYTES`` of
+    earlier chunks are kept so matches that straddle chunks still work.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+
+    def feed(self, chunk):
+        data = self._buffer + chunk
+        candidates = []
+        for pattern, clean in ((TITLE_TAG_RE, _clean_tag_title), (JSON_TITLE_RE, _clean_json_title)):
+            for match in pattern.finditer(data):
+                title = clean(match.group(1))
+                if title:
+                    candidates.append((match.start(), title))
+                    break
+        if candidates:
+            return min(candidates)[1]
+        self._buffer = data[-MAX_MATCH_BYTES:]
+        return None
+
+
+class TitleFetcher:
+    """Resolves YouTube titles with as little downloading as possible.
+
+    Tries the oEmbed JSON endpoint first; if that fails, streams the watch
+    page through a TitleMatcher and closes the connection as soon as a
+    title is found. ``fetch`` returns ``(title, source, bytes_read)``.
+    """
+
+    def __init__(self, client=http_client, oembed_url=OEMBED_URL, watch_url=WATCH_URL,
+                 timeout=10, chunk_size=16 * 1024, max_page_bytes=2 * 1024 * 1024):
+        self.client = client
+        self.oembed_url = oembed_url
+        self.watch_url = watch_url
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.max_page_bytes = max_page_bytes
+        self._lock = threading.Lock()
+        self._stats = {"oembed": 0, "watch_page": 0, "not_found": 0, "bytes_read": 0}
+
+    def _fetch_oembed(self, video_id):
+        url = self.oembed_url.format(watch_url=quote(self.watch_url.format(video_id=video_id), safe=""))
+        response = self.client.get(url, headers={"User-Agent": USER_AGENT}, timeout=self.timeout)
+        try:
+            body = response.content
+            if response.status_code != 200:
+                return None, len(body)
+            title = json.loads(body).get("title")
+            return (title.strip() or None) if isinstance(title, str) else None, len(body)
+        except ValueError:
+            return None, len(response.content)
+        finally:
+            response.close()
+
+    def _fetch_watch_page(self, video_id):
+        url = self.watch_url.format(video_id=video_id)
+        response = self.client.get(url, headers={"User-Agent": USER_AGENT}, timeout=self.timeout, stream=True)
+        bytes_read = 0
+        try:
+            if response.status_code != 200:
+                return None, 0
+            matcher = TitleMatcher()
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                bytes_read += len(chunk)
+                title = matcher.feed(chunk)
+                if title or bytes_read >= self.max_page_bytes:
+                    return title, bytes_read
+            return None, bytes_read
+        finally:
+            # Closing mid-body drops the connection instead of draining the rest of the page
+            response.close()
+
+    def fetch(self, video_id):
+        bytes_read = 0
+        for source, fetch in (("oembed", self._fetch_oembed), ("watch_page", self._fetch_watch_page)):
+            try:
+                title, read = fetch(video_id)
+            except Exception as e:
+                log.info("Title lookup via %s failed for %s: %s", source, video_id, e)
+                continue
+            bytes_read += read
+            if title:
+                self._record(source, bytes_read)
+                return title, source, bytes_read
+        self._record("not_found", bytes_read)
+        return None, None, bytes_read
+
+    def _record(self, outcome, bytes_read):
+        with self._lock:
+            self._stats[outcome] += 1
+            self._stats["bytes_read"] += bytes_read
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["oembed"] + stats["watch_page"] + stats["not_found"]
+        stats["avg_bytes_read"] = round(stats["bytes_read"] / lookups) if lookups else 0
+        return stats
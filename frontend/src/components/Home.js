@@ -2,6 +2,9 @@ import React, { useState, useRef, useEffect } from 'react';
 import { motion, AnimatePresence } from 'framer-motion';
 import { API_ENDPOINTS } from '../config/api';
 
+// Last analysis fetched per URL with its ETag, so a repeat fetch can be answered with 304
+const analysisCache = new Map();
+
 // Extract YouTube video ID from URL
 const getYouTubeVideoId = (url) => {
   const regExp = /^.*((youtu.be\/)|(v\/)|(\/u\/\w\/)|(embed\/)|(watch\?))\??v?=?([^#&?]*).*/;
@@ -276,13 +279,20 @@ const Home = () => {
     try {
       const controller = new AbortController();
       const timeoutId = setTimeout(() => controller.abort(), 30000); // 30 second timeout
+      const cachedAnalysis = analysisCache.get(youtubeUrl);
       
-      const response = await fetch(API_ENDPOINTS.PROCESS_VIDEO, {
+      // Cached analyses come back as plain JSON (or 304), new ones as server-sent events
+      const headers = { 
+        'Content-Type': 'application/json',
+        'Accept': 'application/json, text/event-stream'
+      };
+      if (cachedAnalysis) {
+        headers['If-None-Match'] = cachedAnalysis.etag;
+      }
+      
+      const response = await fetch(API_ENDPOINTS.PROCESS_VIDEO_STREAM, {
         method: 'POST',
-        headers: { 
-          'Content-Type': 'application/json',
-          'Accept': 'application/json'
-        },
+        headers,
         body: JSON.stringify({ 
           youtube_url: youtubeUrl,
           user_id: 'default_user'
@@ -290,23 +300,83 @@ const Home = () => {
         signal: controller.signal
       });
       
-      clearTimeout(timeoutId);
+      const showAnalysis = (data) => {
+        console.log('Backend response:', data);
+        setVideoData(data);
+        setClickCount(0); // Reset click count for new video
+        // Fetch history after successful video analysis
+        fetchHistory();
+      };
+      
+      if (response.status === 304 && cachedAnalysis) {
+        clearTimeout(timeoutId);
+        showAnalysis(cachedAnalysis.data);
+        return;
+      }
       
       if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
+        clearTimeout(timeoutId);
+        const errorData = await response.json().catch(() => null);
+        throw new Error(errorData && errorData.error ? errorData.error : `HTTP error! status: ${response.status}`);
       }
       
-      const data = await response.json();
-      console.log('Backend response:', data);
+      if ((response.headers.get('Content-Type') || '').includes('application/json')) {
+        const data = await response.json();
+        clearTimeout(timeoutId);
+        const etag = response.headers.get('ETag');
+        if (etag) {
+          analysisCache.set(youtubeUrl, { etag, data });
+        }
+        showAnalysis(data);
+        return;
+      }
       
-      if (data.error) {
-        alert(data.error);
-      } else {
-        setVideoData(data);
-        setClickCount(0); // Reset click count for new video
-        // Fetch history after successful video analysis
-        fetchHistory();
+      // Results arrive as server-sent events: show each part as soon as it lands
+      let partial = { briefing: '', characters: [], theme_alerts: [], recaps: [], scenes: [] };
+      const listKeys = { character: 'characters', scene: 'scenes', theme_alert: 'theme_alerts', recap: 'recaps' };
+      
+      const handleEvent = (eventName, data) => {
+        // Any event means the backend is working on it, so stop the request timeout
+        clearTimeout(timeoutId);
+        if (eventName === 'status') {
+          console.log('Analysis stage:', data);
+        } else if (eventName === 'error') {
+          throw new Error(data.error || 'Video analysis failed');
+        } else if (eventName === 'done') {
+          showAnalysis(data);
+        } else {
+          if (listKeys[eventName]) {
+            const key = listKeys[eventName];
+            partial = { ...partial, [key]: [...partial[key], data] };
+          } else {
+            partial = { ...partial, [eventName]: data };
+          }
+          setVideoData(partial);
+          setIsLoading(false);
+        }
+      };
+      
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          const rawEvent = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+          let eventName = 'message';
+          let dataText = '';
+          rawEvent.split('\n').forEach((line) => {
+            if (line.startsWith('event:')) eventName = line.slice(6).trim();
+            else if (line.startsWith('data:')) dataText += line.slice(5).trim();
+          });
+          if (dataText) handleEvent(eventName, JSON.parse(dataText));
+        }
       }
+      clearTimeout(timeoutId);
     } catch (error) {
       console.error('Backend error:', error);
       if (error.name === 'AbortError') {
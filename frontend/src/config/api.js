@@ -3,6 +3,7 @@ const API_BASE_URL = process.env.REACT_APP_API_URL || 'http://localhost:5000';
 
 export const API_ENDPOINTS = {
   PROCESS_VIDEO: `${API_BASE_URL}/process_video`,
+  PROCESS_VIDEO_STREAM: `${API_BASE_URL}/process_video_stream`,
   GET_HISTORY: `${API_BASE_URL}/get_history`,
   GET_RECOMMENDATIONS: `${API_BASE_URL}/get_recommendations`,
   GET_MOVIE_DETAILS: `${API_BASE_URL}/get_movie_details`,